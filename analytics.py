@@ -0,0 +1,203 @@
+# Corpus level attention analytics in one streaming pass
+#
+# Runs a split through a checkpoint with an attn over attn head and keeps, in
+# memory bounded by the vocab size, per word and per POS tag statistics of the
+# attn over attn weight, attention concentration split by correctness, and
+# the top-k most concentrated and most confident wrong samples. Writes to
+# --analytics_out:
+#   words.tsv          word, count, mean attn, lift, argmax rate, by lift
+#   postags.tsv        same per POS tag
+#   concentration.json per (true, pred) group: entropy, max weight, histograms
+#   examples.jsonl     top-k samples with their most attended words
+# python analytics.py --ckpt_name giga_all_attn_pos --data_dir ... --pickle ... --postags --analytics_split train --analytics_out giga_attn/
+import os, json, heapq
+import numpy as np
+from utils import HParams, load_saved_model, session_config, make_batches
+from utils import eval_batch_size, data_info, load_trigger_data, one_hot
+from utils import load_data
+from call_model import call_model
+
+SPLITS = {'train': 0, 'valid': 4, 'test': 8}
+BINS = 20
+
+class TokenStats():
+  """ Sums over the tokens of each id, vectorised with np.bincount """
+  def __init__(self, size):
+    self.size = size
+    self.count = np.zeros(size)
+    self.attn = np.zeros(size)
+    self.attn_sq = np.zeros(size)
+    self.lift = np.zeros(size)
+    self.argmax = np.zeros(size)
+
+  def update(self, ids, attn, lift, top):
+    """ Flat arrays over the valid tokens of a batch """
+    add = lambda w: np.bincount(ids, weights=w, minlength=self.size)[:self.size]
+    self.count += np.bincount(ids, minlength=self.size)[:self.size]
+    self.attn += add(attn)
+    self.attn_sq += add(attn**2)
+    self.lift += add(lift)
+    self.argmax += add(top)
+
+  def table(self, names, min_count):
+    """ Rows of ids seen at least `min_count` times, highest mean lift first """
+    seen = np.nonzero(self.count >= max(min_count, 1))[0]
+    n = self.count[seen]
+    mean = self.attn[seen] / n
+    std = np.sqrt(np.maximum(self.attn_sq[seen] / n - mean**2, 0))
+    lift = self.lift[seen] / n
+    order = np.argsort(-lift)
+    return [(names(i), int(c), m, s, l, a / c) for i, c, m, s, l, a in
+            zip(seen[order], n[order], mean[order], std[order], lift[order],
+                self.argmax[seen][order])]
+
+class Concentration():
+  """ Per group sums and fixed bin histograms of per sample statistics """
+  def __init__(self, num_classes):
+    self.num_classes = num_classes
+    self.groups = {}
+
+  def update(self, keys, entropy, max_w):
+    for key in np.unique(keys):
+      sel = keys == key
+      g = self.groups.setdefault(int(key), {'n': 0, 'entropy': 0., 'max': 0.,
+          'entropy_hist': np.zeros(BINS, np.int64), 'max_hist': np.zeros(BINS, np.int64)})
+      g['n'] += int(sel.sum())
+      g['entropy'] += float(entropy[sel].sum())
+      g['max'] += float(max_w[sel].sum())
+      for stat, hist in [(entropy[sel], 'entropy_hist'), (max_w[sel], 'max_hist')]:
+        bins = np.minimum((stat * BINS).astype(np.int64), BINS - 1)
+        g[hist] += np.bincount(bins, minlength=BINS)
+
+  def summary(self):
+    out = {}
+    for key, g in sorted(self.groups.items()):
+      y_true, y_pred = divmod(key, self.num_classes)
+      out["true{}_pred{}".format(y_true, y_pred)] = {
+          'n': g['n'], 'correct': y_true == y_pred,
+          'mean_norm_entropy': g['entropy'] / g['n'],
+          'mean_max_weight': g['max'] / g['n'],
+          'norm_entropy_hist': g['entropy_hist'].tolist(),
+          'max_weight_hist': g['max_hist'].tolist()}
+    return out
+
+class TopK():
+  """ The k samples of highest score, a heap of (score, index) """
+  def __init__(self, k):
+    self.k = k
+    self.heap = []
+
+  def update(self, scores, index):
+    for s, i in zip(scores, index):
+      if len(self.heap) < self.k:
+        heapq.heappush(self.heap, (float(s), int(i)))
+      elif s > self.heap[0][0]:
+        heapq.heapreplace(self.heap, (float(s), int(i)))
+
+  def items(self):
+    return sorted(self.heap, reverse=True)
+
+class Analytics():
+  """ Accumulates the statistics of batches of attn over attn """
+  def __init__(self, vocab_size, postag_size, num_classes, k):
+    self.words = TokenStats(vocab_size)
+    self.tags = TokenStats(max(postag_size, 1))
+    self.concentration = Concentration(num_classes)
+    self.concentrated = TopK(k)
+    self.wrong = TopK(k)
+
+  def update(self, x, x_tags, x_len, aoa, y_prob, y_pred, y_true, index):
+    """ One batch, `index` the position of its samples in the split """
+    x_len = np.minimum(x_len, aoa.shape[1])
+    valid = np.arange(aoa.shape[1])[None, :] < x_len[:, None]
+    # Weight relative to uniform over the valid tokens, 1 is uniform
+    lift = aoa * x_len[:, None]
+    top = np.zeros_like(aoa)
+    masked = np.where(valid, aoa, -np.inf)
+    top[np.arange(len(aoa)), masked.argmax(axis=1)] = 1
+    self.words.update(x[valid], aoa[valid], lift[valid], top[valid])
+    self.tags.update(x_tags[valid], aoa[valid], lift[valid], top[valid])
+
+    # Concentration over the valid tokens, renormalised
+    p = np.where(valid, aoa, 0)
+    p = p / np.maximum(p.sum(axis=1, keepdims=True), 1e-12)
+    ent = -(p * np.log(np.maximum(p, 1e-12))).sum(axis=1)
+    norm_ent = ent / np.log(np.maximum(x_len, 2))
+    max_w = p.max(axis=1)
+    self.concentration.update(y_true.astype(np.int64) * self.concentration.num_classes + y_pred, norm_ent, max_w)
+
+    self.concentrated.update(max_w, index)
+    wrong = y_pred != y_true
+    self.wrong.update(y_prob[wrong].max(axis=1), index[wrong])
+
+def run(hp, sess, model, x, x_tags, x_len, y, extra, stats):
+  """ Stream the split through the model, sample positions last in each batch """
+  fetch = [model.attn_over_attn, model.y_prob, model.y_pred, model.y_true]
+  for batch in make_batches(x, x_tags, x_len, y, eval_batch_size(hp), shuffle=False,
+                            extra=tuple(extra) + (np.arange(len(x)),)):
+    aoa, y_prob, y_pred, y_true = call_model(sess, model, batch[:-1], fetch, 1, 1, mode=0)
+    stats.update(batch[0], batch[1], batch[2], aoa, y_prob, y_pred, y_true, batch[-1])
+
+def write_table(path, header, rows):
+  with open(path, "w") as f:
+    f.write("\t".join(header) + "\n")
+    for row in rows:
+      f.write("\t".join(r if isinstance(r, str) else
+                        "{:.6g}".format(r) for r in row) + "\n")
+
+def example(i, score, x, x_len, y, aoa_rank, inv_vocab):
+  words = [inv_vocab.get(int(w), str(w)) for w in x[i][:x_len[i]]]
+  return {'index': i, 'score': score, 'y_true': int(y[i]),
+          'sent': " ".join(words),
+          'top_words': [words[j] for j in aoa_rank if j < len(words)]}
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.analytics_out is None:
+    raise ValueError("Set --analytics_out")
+  if hp.triggers is not None:
+    emb, word_idx_map, data, postag_size, extra = load_trigger_data(hp, load_data)
+    tag_idx_map = None
+  else:
+    emb, word_idx_map, data, postag_size, tag_idx_map = load_data(hp.data_dir,
+                                  hp.pickle, tagged=hp.postags, tag_map=True)
+    extra = ((), (), ())
+  inv_vocab = data_info(emb, word_idx_map)
+  # POS tag names from the vocab of preprocess.py, else the tag ids
+  tag_names = {v: k for k, v in (tag_idx_map or {}).items()}
+
+  sess, model, model_hp, _ = load_saved_model(emb, hp, postag_size,
+                                        hp.ckpt_name, session_config(hp))
+  if getattr(model, 'attn_over_attn', None) is None or getattr(model_hp, 'prune_tokens', False):
+    raise ValueError("Analytics need an attn over attn head without token pruning")
+  start = SPLITS[hp.analytics_split]
+  x, x_tags, x_len, y = data[start:start+4]
+  split_extra = extra[start // 4]
+  stats = Analytics(len(emb), postag_size or int(x_tags.max()) + 1,
+                    model_hp.num_classes, hp.analytics_topk)
+  run(model_hp, sess, model, x, x_tags, x_len, y, split_extra, stats)
+
+  os.makedirs(hp.analytics_out, exist_ok=True)
+  header = ['name', 'count', 'mean_attn', 'std_attn', 'mean_lift', 'argmax_rate']
+  write_table(os.path.join(hp.analytics_out, 'words.tsv'), header,
+      stats.words.table(lambda i: inv_vocab.get(int(i), str(i)), hp.analytics_min_count))
+  write_table(os.path.join(hp.analytics_out, 'postags.tsv'), header,
+      stats.tags.table(lambda i: tag_names.get(int(i), str(i)), 1))
+  with open(os.path.join(hp.analytics_out, 'concentration.json'), "w") as f:
+    json.dump(stats.concentration.summary(), f, indent=2)
+
+  # Examples are run again for their attention, k samples only
+  with open(os.path.join(hp.analytics_out, 'examples.jsonl'), "w") as f:
+    for kind, top in [('concentrated', stats.concentrated), ('wrong', stats.wrong)]:
+      items = top.items()
+      if len(items) == 0: continue
+      ids = np.array([i for _, i in items])
+      batch = (x[ids], x_tags[ids], x_len[ids], one_hot(y[ids])) + \
+                                        tuple(e[ids] for e in split_extra)
+      aoa = call_model(sess, model, batch, model.attn_over_attn, 1, 1, mode=0)
+      for (score, i), a in zip(items, aoa):
+        row = example(i, score, x, x_len, y, np.argsort(-a)[:5], inv_vocab)
+        row['kind'] = kind
+        f.write(json.dumps(row) + "\n")
+  print("Wrote analytics of {} {} samples to {}".format(len(x),
+                                      hp.analytics_split, hp.analytics_out))
@@ -0,0 +1,91 @@
+# Throughput autotuner: thread pools, length buckets and batch size
+#
+# Each setting is benchmarked with short train and inference runs in a fresh
+# forked process, for its own thread pools and peak RSS. Knobs are tuned one
+# at a time, keeping the best of each, and the result is written to --tuned
+# which HParams reads as defaults on later runs:
+# python autotune.py --model AttnAttnSum --data_dir ... --pickle ... --tune_for eval
+import os, json, copy, resource
+from multiprocessing import get_context
+import tensorflow as tf
+import numpy as np
+from utils import HParams, load_model, session_config, load_trigger_data
+from utils import load_data
+from call_model import benchmark
+
+# Data of the benchmarks, set before forking so workers share it
+bench_data = {}
+
+def run_config(hp):
+  """ Returns train samples/sec, inference samples/sec and peak RSS in MB """
+  emb, postag_size = bench_data['emb'], bench_data['postag_size']
+  with tf.Graph().as_default(), tf.Session(config=session_config(hp)) as sess:
+    model, _, model_hp, _ = load_model(sess, emb, hp, postag_size)
+    model_hp.update('batch_size', hp.batch_size)
+    train_rate, eval_rate = benchmark(model_hp, sess, model, bench_data['data'],
+                                      hp.tune_steps, bench_data['extra'])
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  return train_rate, eval_rate, rss
+
+def measure(hp, **knobs):
+  """ run_config with `knobs` set, in a forked process """
+  hp = copy.deepcopy(hp)
+  for k, v in knobs.items():
+    hp.update(k, v)
+  with get_context('fork').Pool(1) as pool:
+    res = pool.apply(run_config, (hp,))
+  print('{} | train/sec: {:.0f} | eval/sec: {:.0f} | peak RSS MB: {:.0f}'
+                                                      .format(knobs, *res))
+  return res
+
+def tune(hp, best, name, candidates, target):
+  """ Best value of knob `name`, the others fixed at `best` """
+  rates = {}
+  for value in candidates:
+    knobs = dict(best, **{name: value})
+    train_rate, eval_rate, rss = measure(hp, **knobs)
+    if hp.tune_max_rss > 0 and rss > hp.tune_max_rss: continue
+    rates[json.dumps(value)] = train_rate if target == 'train' else eval_rate
+  if len(rates) == 0:
+    raise ValueError("No {} fits in --tune_max_rss".format(name))
+  return json.loads(max(rates, key=rates.get))
+
+def length_buckets(x_len, n):
+  """ Boundaries splitting the lengths in `n` buckets of about equal size """
+  bounds = np.percentile(x_len, np.linspace(0, 100, n+1)[1:-1])
+  return sorted(set(int(b) for b in bounds)) or None
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.triggers is not None:
+    emb, word_idx_map, data, postag_size, extra = load_trigger_data(hp, load_data)
+  else:
+    emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
+    extra = None
+  bench_data.update(emb=emb, postag_size=postag_size, data=data, extra=extra)
+
+  cpus = os.cpu_count()
+  threads = sorted(set([2**i for i in range(cpus.bit_length()) if 2**i <= cpus] + [cpus]))
+  best = {'intra_threads': hp.intra_threads, 'inter_threads': hp.inter_threads}
+  # Training and inference have their own batch size and length buckets
+  train = hp.tune_for == 'train'
+  batch_key = 'batch_size' if train else 'eval_batch_size'
+  bucket_key = 'buckets' if train else 'eval_buckets'
+  best[batch_key] = getattr(hp, batch_key) or hp.batch_size
+  best[bucket_key] = getattr(hp, bucket_key)
+
+  best['intra_threads'] = tune(hp, best, 'intra_threads', threads, hp.tune_for)
+  best['inter_threads'] = tune(hp, best, 'inter_threads', [1, 2, 4], hp.tune_for)
+  best[bucket_key] = tune(hp, best, bucket_key,
+              [None] + [length_buckets(data[2], n) for n in (2, 4, 8)], hp.tune_for)
+  best[batch_key] = tune(hp, best, batch_key, [16, 32, 64, 128, 256, 512],
+                                                                  hp.tune_for)
+
+  # The training batch size and length buckets change what is learned, and
+  # later runs read the file as defaults, training included: only report them
+  tuned = dict(best)
+  if train:
+    for key in [batch_key, bucket_key]:
+      print("Fastest training {}: {}, not written".format(key, tuned.pop(key)))
+  with open(hp.tuned, "w") as f: json.dump(tuned, f, indent=2)
+  print("Wrote {}: {}".format(hp.tuned, tuned))
@@ -0,0 +1,123 @@
+# Content addressed cache of model outputs for repeated inputs
+import os, hashlib, shelve
+from collections import OrderedDict
+import numpy as np
+from ckpt_store import manifest_path
+
+def checkpoint_id(hp):
+  """ Id of a saved model, changes whenever its tar or manifest is rewritten """
+  if getattr(hp, 'ckpt_store', None):
+    path = manifest_path(hp.ckpt_store, hp.ckpt_name)
+  else:
+    path = hp.ckpt_dir + "/" + hp.ckpt_name + ".tar"
+  stat = os.stat(path)
+  return "{}:{}:{}".format(hp.ckpt_name, stat.st_size, stat.st_mtime_ns)
+
+class PredictionCache():
+  """
+  Per sample model outputs keyed by a sha1 of the padded word ids, POS ids,
+  length, extra inputs and the checkpoint id. Recently used entries are kept
+  in memory up to `max_bytes`, the least recently used evicted first. With
+  `disk_path` every entry is also written to a shelve file, which outlives
+  evictions and the process
+  """
+  entry_overhead = 200 # bytes of key, tuple and dict slot per entry
+
+  def __init__(self, ckpt_id, max_bytes=256*2**20, disk_path=None):
+    self.ckpt_id = ckpt_id.encode()
+    self.max_bytes = max_bytes
+    self.bytes = 0
+    self.mem = OrderedDict()
+    self.disk = shelve.open(disk_path) if disk_path is not None else None
+    self.hits = 0
+    self.disk_hits = 0
+    self.dupes = 0
+    self.misses = 0
+
+  def keys(self, batch):
+    """ Key of every sample of a batch as built by make_batches """
+    x, postags, x_len = batch[0], batch[1], batch[2]
+    extra = batch[4:]
+    keys = []
+    for i in range(len(x)):
+      h = hashlib.sha1(self.ckpt_id)
+      h.update(np.ascontiguousarray(x[i]).tobytes())
+      h.update(np.ascontiguousarray(postags[i]).tobytes())
+      h.update(np.int64(x_len[i]).tobytes())
+      for e in extra:
+        h.update(np.ascontiguousarray(e[i]).tobytes())
+      keys.append(h.hexdigest())
+    return keys
+
+  def get(self, key):
+    """ Outputs of one sample, or None """
+    value = self.mem.get(key)
+    if value is not None:
+      self.mem.move_to_end(key)
+      self.hits += 1
+      return value
+    if self.disk is not None and key in self.disk:
+      value = self.disk[key]
+      self.put(key, value, write_disk=False)
+      self.disk_hits += 1
+      return value
+    return None
+
+  def put(self, key, value, write_disk=True):
+    """ Store the tuple of arrays `value`, evicting old entries over budget """
+    if key in self.mem: return
+    self.mem[key] = value
+    self.bytes += entry_bytes(value) + self.entry_overhead
+    while self.bytes > self.max_bytes and len(self.mem) > 1:
+      _, old = self.mem.popitem(last=False)
+      self.bytes -= entry_bytes(old) + self.entry_overhead
+    if write_disk and self.disk is not None:
+      self.disk[key] = value
+
+  def run(self, batch, fn):
+    """
+    Outputs for a batch, calling `fn` only on the samples not cached, each
+    distinct sample once.
+    Args:
+      batch: tuple of arrays as yielded by make_batches
+      fn: maps a sub batch to a list of output arrays, one row per sample
+    Returns:
+      list of output arrays for the whole batch
+    """
+    keys = self.keys(batch)
+    rows = [None] * len(keys)
+    missing = OrderedDict() # key: positions in the batch
+    for i, key in enumerate(keys):
+      if key in missing:
+        missing[key].append(i)
+        self.dupes += 1
+        continue
+      rows[i] = self.get(key)
+      if rows[i] is None: missing[key] = [i]
+
+    if len(missing) > 0:
+      self.misses += len(missing)
+      first = [ids[0] for ids in missing.values()]
+      outputs = fn(tuple(a[first] for a in batch))
+      for j, (key, ids) in enumerate(missing.items()):
+        value = tuple(out[j] for out in outputs)
+        self.put(key, value)
+        for i in ids: rows[i] = value
+    return [np.stack(col) for col in zip(*rows)]
+
+  def hit_rate(self):
+    """ Fraction of samples served without running the model """
+    total = self.hits + self.disk_hits + self.dupes + self.misses
+    return (total - self.misses) / total if total > 0 else 0.
+
+  def stats(self):
+    return {'hits': self.hits, 'disk_hits': self.disk_hits,
+            'dupes': self.dupes, 'misses': self.misses,
+            'hit_rate': self.hit_rate(), 'entries': len(self.mem),
+            'mem_mb': self.bytes / 2**20}
+
+  def close(self):
+    if self.disk is not None: self.disk.close()
+
+def entry_bytes(value):
+  return sum(a.nbytes for a in value)
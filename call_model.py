@@ -1,7 +1,10 @@
 # Author: Andre Cianflone
 import tensorflow as tf
-from model import PairWiseAttn, AttnAttn, ConvAttn
+from model import PairWiseAttn, AttnAttn, ConvAttn, AccumStep
 from utils import Progress, make_batches, calc_num_batches, save_model, load_model, one_hot
+from utils import load_saved_model, save_latest, load_latest, eval_batch_size
+from utils import stratified_subsample, BalancedSampler
+import copy, time
 import numpy as np
 from pydoc import locate
 from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
@@ -11,12 +14,21 @@ import matplotlib.pyplot as plt
 import sys
 # np.random.seed(seed=random_seed)
 
-def train_model(params, sess, saver, model, result, data):
+def train_model(params, sess, saver, model, result, data, extra=None):
+  """
+  Train and checkpoint on best validation. `extra` holds per split tuples of
+  arrays batched along with the data, such as trigger ids
+  """
   trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
                                                           teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
 
   global hp
   hp = params
+  # Several heads over one encoder, or replicas, each tracked on its own
+  if hasattr(model, 'heads'):
+    return train_multi_head(params, sess, model, data, extra, saver)
+
   if result is not None:
     best_acc = result['va_acc']
     te_acc = result['te_acc']
@@ -25,38 +37,225 @@ def train_model(params, sess, saver, model, result, data):
     best_acc = 0
     te_acc = 0
     epoch = 0
-  prog = Progress(calc_num_batches(trX, hp.batch_size), best_acc, te_acc)
   best_epoch = 0
+  end_epoch = epoch + hp.max_epochs
+  start_batch = 0
+
+  # Latest checkpoint, kept apart from the best model for preemption
+  latest_every = getattr(hp, 'latest_every', 0)
+  latest_saver = tf.train.Saver(max_to_keep=2)
+  state = load_latest(sess, latest_saver, hp) if getattr(hp, 'resume', False)\
+                                                                    else None
+  if state is not None:
+    best_acc, te_acc = state['best_acc'], state['te_acc']
+    epoch, best_epoch = state['epoch'], state['best_epoch']
+    end_epoch, start_batch = state['end_epoch'], state['batch']
+  prog = Progress(calc_num_batches(trX, hp.batch_size), best_acc, te_acc,
+                                                                epoch=epoch)
+  # Fixed validation subsample for staged evaluation
+  stage = None
+  if getattr(hp, 'stage_frac', 0) > 0:
+    # The bound of staged_accuracy is the binomial one of an accuracy
+    if params.score != 'acc':
+      raise ValueError("--stage_frac needs --score acc, not " + params.score)
+    stage = stratified_subsample(vaY, hp.stage_frac)
+
+  sampler = train_sampler(hp, trY)
+
+  # Warm started encoder frozen for the first steps
+  freeze = getattr(hp, 'freeze_encoder_steps', 0) if hasattr(model, 'optimize_head') else 0
+  step = sess.run(model.global_step)
+  # Micro batches run, counted across epochs for gradient accumulation
+  micro, costs = 0, []
 
   # Begin training and occasional validation
-  for epoch in range(epoch, epoch+hp.max_epochs):
+  for epoch in range(epoch, end_epoch):
     prog.epoch_start()
-    for batch in make_batches(trX, trXTags, trXlen, trY, hp.batch_size,
-                                                  shuffle=True, seed=epoch):
-      fetch = [model.optimize, model.cost, model.global_step]
+    prog.current_batch = start_batch
+    batches = make_batches(trX, trXTags, trXlen, trY, hp.batch_size,
+                    shuffle=True, seed=epoch, extra=tr_ex, start=start_batch,
+                    buckets=getattr(hp, 'buckets', None), sampler=sampler)
+    for batch_num, batch in enumerate(batches, start_batch):
+      optimize = model.optimize_head if step < freeze else model.optimize
+      optimize, applied = step_op(optimize, micro)
+      micro += 1
+      fetch = [optimize, model.cost, model.global_step]
       _, cost, step = call_model(\
           sess, model, batch, fetch, hp.keep_prob, hp.rnn_in_keep_prob, mode=1)
-      prog.print_train(cost)
+      costs.append(cost)
+      if not applied: continue
+      prog.print_train(np.mean(costs), len(costs))
+      costs = []
       if step%hp.eval_every==0:
-        va_acc = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, params.score)
+        if stage is not None:
+          va_acc, full = staged_accuracy(sess, vaX, vaXTags, vaXlen, vaY,
+                                model, params.score, va_ex, stage, best_acc)
+        else:
+          va_acc, full = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, params.score, va_ex), True
         # If best!
-        if va_acc>best_acc:
+        if full and va_acc>best_acc:
           best_acc = va_acc
           best_epoch = epoch
-          te_acc = accuracy(sess, teX, teXTags, teXlen, teY, model, params.score)
+          te_acc = accuracy(sess, teX, teXTags, teXlen, teY, model, params.score, te_ex)
           result = {'va_acc':va_acc, 'te_acc':te_acc, 'epoch':epoch}
           save_model(sess, saver, hp, result, step, if_global_best=1)
           prog.test_best_val(te_acc)
         prog.print_eval(va_acc)
+      if latest_every and step%latest_every==0:
+        save_latest(sess, latest_saver, hp, {'step':int(step), 'epoch':epoch,
+          'batch':batch_num+1, 'best_acc':float(best_acc),
+          'te_acc':float(te_acc), 'best_epoch':best_epoch,
+          'end_epoch':end_epoch})
+    start_batch = 0
     # Early stop check
     if epoch - best_epoch > hp.early_stop: break
   prog.train_end()
   print('Best epoch {}, acc: {}'.format(best_epoch+1, best_acc))
 
 
-def accuracy(sess, teX, teXTags, teXlen, teY, model, score='acc'):
+def train_multi_head(params, sess, model, data, extra=None, saver=None):
+  """
+  Train all heads of a MultiHead model from one encoder pass per batch. Every
+  head has its own best validation score, and on a new best is exported as a
+  standalone RNN_base checkpoint named `<ckpt_name>_<head>`. The heads of a
+  Replicas model are its replicas, exported as `<ckpt_name>_r<i>`, and their
+  ensemble is tracked too, saved whole as `<ckpt_name>` with `saver`
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+
+  global hp
+  hp = params
+  names = model.head_names
+  export_params = {name: head_params(hp, name) for name in names}
+  savers = {name: tf.train.Saver(model.head_var_list(name)) for name in names}
+  replicas = hasattr(model, 'replicas')
+  if replicas:
+    export_params = {name: replica_params(hp, name) for name in names}
+    names = names + ['ensemble']
+    export_params['ensemble'], savers['ensemble'] = hp, saver
+  best_acc = {name: 0 for name in names}
+  te_acc = {name: 0 for name in names}
+  best_epoch = {name: 0 for name in names}
+  alternate = getattr(hp, 'multi_loss', 'sum') == 'alternate'
+  sampler = train_sampler(hp, trY)
+  prog = Progress(calc_num_batches(trX, hp.batch_size), track_best=False)
+
+  # Begin training and occasional validation
+  i, micro, costs = 0, 0, []
+  for epoch in range(hp.max_epochs):
+    prog.epoch_start()
+    for batch in make_batches(trX, trXTags, trXlen, trY, hp.batch_size,
+                                      shuffle=True, seed=epoch, extra=tr_ex,
+                                      buckets=getattr(hp, 'buckets', None),
+                                      sampler=sampler):
+      if alternate:
+        optimize = model.heads[i % len(names)].optimize
+      else:
+        optimize = model.optimize
+      optimize, applied = step_op(optimize, micro)
+      micro += 1
+      fetch = [optimize, model.cost, model.global_step]
+      _, cost, step = call_model(\
+          sess, model, batch, fetch, hp.keep_prob, hp.rnn_in_keep_prob, mode=1)
+      costs.append(cost)
+      if not applied: continue
+      # Alternating heads take turns per update
+      i += 1
+      prog.print_train(np.mean(costs), len(costs))
+      costs = []
+      if step%hp.eval_every==0:
+        va_acc = accuracy_heads(sess, vaX, vaXTags, vaXlen, vaY, model,
+                                                          params.score, va_ex)
+        improved = [name for name in names if va_acc[name] > best_acc[name]]
+        if len(improved) > 0:
+          te_all = accuracy_heads(sess, teX, teXTags, teXlen, teY, model,
+                                                          params.score, te_ex)
+        for name in improved:
+          best_acc[name] = va_acc[name]
+          best_epoch[name] = epoch
+          te_acc[name] = te_all[name]
+          result = {'va_acc':va_acc[name], 'te_acc':te_acc[name], 'epoch':epoch}
+          save_model(sess, savers[name], export_params[name], result, step)
+        prog.print_eval_heads(va_acc, best_acc, te_acc)
+    # Early stop once no head improves
+    if epoch - max(best_epoch.values()) > hp.early_stop: break
+  prog.train_end()
+  for name in names:
+    print('{}: best epoch {}, acc: {}, test: {}'.format(
+                   name, best_epoch[name]+1, best_acc[name], te_acc[name]))
+  if replicas:
+    # Seed spread of the replicas, as of separate runs
+    va = [best_acc[name] for name in model.head_names]
+    te = [te_acc[name] for name in model.head_names]
+    print('{} replicas: acc {:.4f} +- {:.4f}, test {:.4f} +- {:.4f}'.format(
+                    len(va), np.mean(va), np.std(va), np.mean(te), np.std(te)))
+
+def step_op(optimize, micro):
+  """
+  Op to train on the `micro`-th batch and whether it updates the weights.
+  With gradient accumulation, only every accum_steps-th batch applies them
+  """
+  if not isinstance(optimize, AccumStep):
+    return optimize, True
+  if (micro + 1) % hp.accum_steps == 0:
+    return optimize.apply, True
+  return optimize.accumulate, False
+
+def train_sampler(hp, trY):
+  """ Class balanced sampler of the training split if `hp.balance` is sample """
+  if getattr(hp, 'balance', None) != 'sample': return None
+  return BalancedSampler(trY, hp.balance_ratio, hp.balance_replace)
+
+def head_params(params, name):
+  """ HParams for the standalone RNN_base export of head `name` """
+  head_hp = copy.deepcopy(params)
+  head_hp.update('model', 'RNN_base')
+  head_hp.update('head', name)
+  head_hp.update('heads', None)
+  head_hp.update('ckpt_name', params.ckpt_name + '_' + name)
+  return head_hp
+
+def replica_params(params, name):
+  """ HParams for the standalone export of replica `name` """
+  replica_hp = copy.deepcopy(params)
+  replica_hp.update('model', params.replica_model)
+  replica_hp.update('replicas', 0)
+  replica_hp.update('ckpt_name', params.ckpt_name + '_' + name)
+  return replica_hp
+
+def accuracy(sess, teX, teXTags, teXlen, teY, model, score='acc', extra=(),
+                                                                  cache=None):
   """ Return accuracy """
-  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model)
+  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY,
+                                                          model, extra, cache)
+  return score_preds(y_prob, y_pred, y_true, score)
+
+def staged_accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, score, extra,
+                                                              sub, best):
+  """
+  Validation score of the subsample `sub` first. If its upper confidence
+  bound, with finite population correction, is below `best` the model can't
+  be a new best and the estimate is returned, else the full set score
+  Returns:
+    score, whether it is from the full set
+  """
+  n, N = len(sub), len(vaX)
+  est = accuracy(sess, vaX[sub], vaXTags[sub], vaXlen[sub], vaY[sub], model,
+                                      score, tuple(e[sub] for e in extra))
+  half = hp.stage_z * np.sqrt(est * (1 - est) / n * (N - n) / max(N - 1, 1))
+  if est + half < best:
+    return est, False
+  return accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, score, extra), True
+
+def accuracy_heads(sess, teX, teXTags, teXlen, teY, model, score='acc', extra=()):
+  """ Return dict of accuracy per head, from a single pass """
+  preds = get_pred_true_heads(sess, teX, teXTags, teXlen, teY, model, extra)
+  return {name: score_preds(*preds[name], score=score) for name in preds}
+
+def score_preds(y_prob, y_pred, y_true, score='acc'):
+  """ Score predictions with accuracy, f1 or auc """
   if score == 'acc':
     res = accuracy_score(y_true, y_pred)
   elif score == 'f1':
@@ -67,33 +266,95 @@ def accuracy(sess, teX, teXTags, teXlen, teY, model, score='acc'):
     res = roc_auc_score(y_true, y_scores)
   return res
 
-def get_pred_true(sess, teX, teXTags, teXlen, teY, model):
+def get_pred_true(sess, teX, teXTags, teXlen, teY, model, extra=(), cache=None):
   """
-  Get two numpy arrays
+  Get two numpy arrays. With a `cache.PredictionCache`, only samples not seen
+  before by this checkpoint are run
   """
-  fetch = [model.batch_size, model.cost, model.y_pred, model.y_true, model.y_prob]
+  fetch = [model.batch_size, model.y_pred, model.y_true, model.y_prob]
   y_pred = np.zeros(teX.shape[0])
   y_true = np.zeros(teX.shape[0])
   y_prob = np.zeros((teX.shape[0],2))
+  # With eval buckets, run grouped by length bucket and put results back in
+  # order after
+  order = None
+  if getattr(hp, 'eval_buckets', None):
+    order = np.argsort(np.digitize(teXlen, hp.eval_buckets), kind='mergesort')
+    teX, teXTags, teXlen, teY = teX[order], teXTags[order], teXlen[order], teY[order]
+    extra = tuple(e[order] for e in extra)
   start_id = 0
-  for batch in make_batches(teX, teXTags, teXlen, teY, hp.batch_size, shuffle=False):
-    result = call_model(sess, model, batch, fetch, 1, 1, mode=0)
+  for batch in make_batches(teX, teXTags, teXlen, teY, eval_batch_size(hp),
+                                                  shuffle=False, extra=extra):
+    if cache is not None:
+      result = cached_pred_true(sess, model, batch, cache)
+    else:
+      result = call_model(sess, model, batch, fetch, 1, 1, mode=0)
     batch_size                           = result[0]
-    cost                                 = result[1]
-    y_pred[start_id:start_id+batch_size] = result[2]
-    y_true[start_id:start_id+batch_size] = result[3]
-    y_prob[start_id:start_id+batch_size] = result[4]
+    y_pred[start_id:start_id+batch_size] = result[1]
+    y_true[start_id:start_id+batch_size] = result[2]
+    y_prob[start_id:start_id+batch_size] = result[3]
     start_id += batch_size
 
+  if order is not None:
+    inverse = np.argsort(order)
+    y_prob, y_pred, y_true = y_prob[inverse], y_pred[inverse], y_true[inverse]
   return y_prob, y_pred, y_true
 
-def call_model(sess, model, batch, fetch, keep_prob, rnn_in_keep_prob, mode):
-  """ Calls models and yields results per batch """
+def cached_pred_true(sess, model, batch, cache):
+  """ Batch size, y_pred, y_true and y_prob like the fetch of get_pred_true """
+  run = lambda b: [call_model(sess, model, b, model.y_prob, 1, 1, mode=0)]
+  y_prob, = cache.run(batch, run)
+  return len(y_prob), np.argmax(y_prob, 1), np.argmax(batch[3], 1), y_prob
+
+def get_logits(sess, teX, teXTags, teXlen, teY, model, extra=()):
+  """ Unnormalized class scores for every sample """
+  logits = np.zeros((teX.shape[0], hp.num_classes))
+  start_id = 0
+  for batch in make_batches(teX, teXTags, teXlen, teY, eval_batch_size(hp),
+                                                  shuffle=False, extra=extra):
+    result = call_model(sess, model, batch, model.logits, 1, 1, mode=0)
+    logits[start_id:start_id+len(result)] = result
+    start_id += len(result)
+  return logits
+
+def get_pred_true_heads(sess, teX, teXTags, teXlen, teY, model, extra=()):
+  """
+  Get numpy arrays (y_prob, y_pred, y_true) for every head of a MultiHead
+  model, fetched together so the encoder runs once per batch. For Replicas
+  also of the ensemble, from the replicas' probabilities
+  """
+  fetch = [model.batch_size, model.y_true]
+  for head in model.heads:
+    fetch += [head.y_pred, head.y_prob]
+  y_true = np.zeros(teX.shape[0])
+  y_pred = {head.name: np.zeros(teX.shape[0]) for head in model.heads}
+  y_prob = {head.name: np.zeros((teX.shape[0],2)) for head in model.heads}
+  start_id = 0
+  for batch in make_batches(teX, teXTags, teXlen, teY, eval_batch_size(hp),
+                                                  shuffle=False, extra=extra):
+    result = call_model(sess, model, batch, fetch, 1, 1, mode=0)
+    batch_size = result[0]
+    end_id = start_id+batch_size
+    y_true[start_id:end_id] = result[1]
+    for i, head in enumerate(model.heads):
+      y_pred[head.name][start_id:end_id] = result[2+2*i]
+      y_prob[head.name][start_id:end_id] = result[3+2*i]
+    start_id = end_id
+
+  if hasattr(model, 'replicas'):
+    y_prob['ensemble'] = np.mean([y_prob[head.name] for head in model.heads], axis=0)
+    y_pred['ensemble'] = np.argmax(y_prob['ensemble'], axis=1)
+  return {name: (y_prob[name], y_pred[name], y_true) for name in y_pred}
+
+def call_model(sess, model, batch, fetch, keep_prob, rnn_in_keep_prob, mode,
+                                                                  feed=None):
+  """ Calls models and yields results per batch, `feed` adds to the feed """
   x     = batch[0]
   x_tags= batch[1]
   x_len = batch[2]
   y     = batch[3]
-  feed = {
+  feed = dict(feed or {})
+  feed.update({
            model.keep_prob        : keep_prob,
            model.rnn_in_keep_prob : rnn_in_keep_prob,
            model.mode             : mode, # 1 for train, 0 for testing
@@ -101,13 +362,218 @@ def call_model(sess, model, batch, fetch, keep_prob, rnn_in_keep_prob, mode):
            model.postags          : x_tags,
            model.input_len        : x_len,
            model.labels           : y
-         }
-  # if hasattr(model, 'postags'):
-    # feed[model.postags] = x_tags
+         })
+  # Extra inputs such as trigger ids follow the 4 standard arrays
+  for placeholder, value in zip(getattr(model, 'extra_inputs', []), batch[4:]):
+    feed[placeholder] = value
 
   result = sess.run(fetch,feed)
   return result
 
+def timed_score(sess, teX, teXTags, teXlen, teY, model, score='acc', extra=()):
+  """ Returns score and samples per second over the set """
+  t1 = time.time()
+  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model, extra)
+  rate = len(teX) / (time.time() - t1)
+  return score_preds(y_prob, y_pred, y_true, score), rate
+
+def distill_setup(params, emb, postag_size, data, extra=None):
+  """
+  Load the teacher `hp.distill_from` and compute its temperature softened
+  probabilities on the training set, appended to the training extra arrays
+  so call_model feeds them to the student's `soft_labels`
+  Returns:
+    the new extra, and the teacher's (test score, samples per second)
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  global hp
+  hp = params
+
+  sess, teacher, _, _ = load_saved_model(emb, params, postag_size, params.distill_from)
+  logits = get_logits(sess, trX, trXTags, trXlen, trY, teacher, tr_ex)
+  soft = np.exp((logits - logits.max(axis=1, keepdims=True)) / params.distill_temp)
+  soft /= soft.sum(axis=1, keepdims=True)
+  teacher_res = timed_score(sess, teX, teXTags, teXlen, teY, teacher, params.score, te_ex)
+  sess.close()
+  return (tr_ex + (soft,), va_ex, te_ex), teacher_res
+
+def report_distill(params, emb, postag_size, data, extra, teacher_res):
+  """ Print test score and throughput of the best student against the teacher """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  sess, student, _, _ = load_saved_model(emb, params, postag_size, params.ckpt_name)
+  student_res = timed_score(sess, teX, teXTags, teXlen, teY, student, params.score, te_ex)
+  sess.close()
+  for name, (res, rate) in [('teacher', teacher_res), ('student', student_res)]:
+    print('{}: test {}: {:.4f} | samples/sec: {:.0f}'.format(name, params.score, res, rate))
+  print('speedup: {:.2f}x'.format(student_res[1] / teacher_res[1]))
+
+def prune_curve(params, sess, model, data, thresholds, extra=None):
+  """
+  Test score, samples per second and fraction of tokens kept at each word gate
+  threshold of a model built with --prune_tokens
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  global hp
+  hp = params
+  fetch = [model.y_prob, model.y_pred, model.y_true, model.kept_tokens]
+  curve = []
+  for threshold in thresholds:
+    y_prob, y_pred, y_true, kept = [], [], [], 0
+    t1 = time.time()
+    for batch in make_batches(teX, teXTags, teXlen, teY, eval_batch_size(hp),
+                                                  shuffle=False, extra=te_ex):
+      result = call_model(sess, model, batch, fetch, 1, 1, mode=0,
+                                      feed={model.prune_threshold: threshold})
+      y_prob.append(result[0])
+      y_pred.append(result[1])
+      y_true.append(result[2])
+      kept += result[3].sum()
+    rate = len(teX) / (time.time() - t1)
+    res = score_preds(np.concatenate(y_prob), np.concatenate(y_pred),
+                      np.concatenate(y_true), params.score)
+    curve.append((threshold, res, rate, kept / teXlen.sum()))
+    print('threshold: {:.3f} | test {}: {:.4f} | samples/sec: {:.0f} | kept: {:.3f}'
+                              .format(threshold, params.score, res, rate, curve[-1][3]))
+  return curve
+
+def benchmark(params, sess, model, data, steps, extra=None):
+  """
+  Training and inference samples per second, each over `steps` batches after
+  a warm up batch. Training steps change the weights, use a throwaway model
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  global hp
+  hp = params
+  batches = make_batches(trX, trXTags, trXlen, trY, hp.batch_size,
+              shuffle=True, extra=tr_ex, buckets=getattr(hp, 'buckets', None))
+  n, t1 = 0, time.time()
+  for i, batch in enumerate(batches):
+    if i == 1: t1 = time.time()
+    fetch = [step_op(model.optimize, i)[0], model.cost]
+    call_model(sess, model, batch, fetch, hp.keep_prob, hp.rnn_in_keep_prob, mode=1)
+    if i > 0: n += len(batch[0])
+    if i == steps: break
+  # No batch after the warm up one, with steps 0 or a single batch
+  train_rate = n / (time.time() - t1) if n > 0 else 0.
+
+  # Inference on validation, warm up on one batch
+  size = min(len(vaX), steps * eval_batch_size(hp))
+  warm = eval_batch_size(hp)
+  va = (vaX, vaXTags, vaXlen, vaY)
+  get_pred_true(sess, *[a[:warm] for a in va], model, tuple(e[:warm] for e in va_ex))
+  t1 = time.time()
+  get_pred_true(sess, *[a[:size] for a in va], model, tuple(e[:size] for e in va_ex))
+  eval_rate = size / (time.time() - t1)
+  return train_rate, eval_rate
+
+def compression_scores(params, sess, model, data, extra=None):
+  """
+  Validation and test score, and test samples per second after a warm up
+  batch, to compare compression levels
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  global hp
+  hp = params
+  va_acc = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, hp.score, va_ex)
+  warm = eval_batch_size(hp)
+  te = (teX, teXTags, teXlen, teY)
+  get_pred_true(sess, *[a[:warm] for a in te], model, tuple(e[:warm] for e in te_ex))
+  te_acc, rate = timed_score(sess, teX, teXTags, teXlen, teY, model, hp.score, te_ex)
+  return {'va_acc': va_acc, 'te_acc': te_acc, 'samples_sec': rate}
+
+def margin(y_prob):
+  """ Difference between the two most probable classes of each sample """
+  top = np.sort(y_prob, axis=1)
+  return top[:,-1] - top[:,-2]
+
+def calibrate_threshold(cheap_prob, cheap_pred, exp_pred, y_true, max_loss):
+  """
+  Lowest margin threshold sending the fewest samples to the expensive model
+  while the cascade accuracy stays within `max_loss` of the expensive model.
+  Samples with margin < threshold are routed to the expensive model
+  Returns:
+    threshold, fraction of samples routed
+  """
+  m = margin(cheap_prob)
+  order = np.argsort(m, kind='mergesort')
+  m = m[order]
+  cheap_ok = (cheap_pred == y_true)[order]
+  exp_ok = (exp_pred == y_true)[order]
+  n = len(m)
+  # Accuracy when the k lowest margins are routed, for k in 0..n
+  gain = np.concatenate([[0], np.cumsum(exp_ok.astype(int) - cheap_ok)])
+  acc = (cheap_ok.sum() + gain) / n
+  # Only cut between distinct margins, so the threshold routes exactly k
+  cut = np.concatenate([[True], m[1:] > m[:-1], [True]])
+  ok = cut & (exp_ok.mean() - acc <= max_loss)
+  k = np.argmax(ok)
+  threshold = m[k] if k < n else np.inf
+  return threshold, k / n
+
+def cascade_pred_true(cheap_sess, cheap, sess, model, teX, teXTags, teXlen,
+                                                  teY, threshold, extra=()):
+  """
+  Predict with the cheap model, then run the expensive one only on samples
+  with margin below `threshold`. Returns y_prob, y_pred, y_true and the
+  fraction of samples routed
+  """
+  y_prob, y_pred, y_true = get_pred_true(cheap_sess, teX, teXTags, teXlen,
+                                                          teY, cheap, extra)
+  idx = np.where(margin(y_prob) < threshold)[0]
+  if len(idx) > 0:
+    sub_ex = tuple(e[idx] for e in extra)
+    prob, pred, _ = get_pred_true(sess, teX[idx], teXTags[idx], teXlen[idx],
+                                                  teY[idx], model, sub_ex)
+    y_prob[idx] = prob
+    y_pred[idx] = pred
+  return y_prob, y_pred, y_true, len(idx) / len(teX)
+
+def run_cascade(params, sess, model, emb, postag_size, data, extra=None):
+  """
+  Cascade of the cheap checkpoint `hp.cascade_cheap` in front of the loaded
+  model. The margin threshold is calibrated on validation for an accuracy
+  loss of at most `hp.cascade_loss`, then test score and throughput of the
+  cascade are compared to the expensive model alone
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
+  global hp
+  hp = params
+
+  cheap_sess, cheap, _, _ = load_saved_model(emb, params, postag_size,
+                                                        params.cascade_cheap)
+  # Calibrate on validation
+  va_prob, va_pred, va_true = get_pred_true(cheap_sess, vaX, vaXTags, vaXlen,
+                                                          vaY, cheap, va_ex)
+  _, va_exp_pred, _ = get_pred_true(sess, vaX, vaXTags, vaXlen, vaY, model, va_ex)
+  threshold, va_routed = calibrate_threshold(va_prob, va_pred, va_exp_pred,
+                                                va_true, params.cascade_loss)
+  print('threshold: {:.4f} | validation routed: {:.3f}'.format(threshold, va_routed))
+
+  # Test, expensive model alone then the cascade
+  exp_res = timed_score(sess, teX, teXTags, teXlen, teY, model, params.score, te_ex)
+  t1 = time.time()
+  y_prob, y_pred, y_true, routed = cascade_pred_true(cheap_sess, cheap, sess,
+                    model, teX, teXTags, teXlen, teY, threshold, te_ex)
+  rate = len(teX) / (time.time() - t1)
+  cascade_res = (score_preds(y_prob, y_pred, y_true, params.score), rate)
+  cheap_sess.close()
+  for name, (res, rate) in [('expensive', exp_res), ('cascade', cascade_res)]:
+    print('{}: test {}: {:.4f} | samples/sec: {:.0f}'.format(name, params.score, res, rate))
+  print('test routed: {:.3f} | speedup: {:.2f}x'.format(routed,
+                                              cascade_res[1] / exp_res[1]))
+
 def sample_to_sent(x, inv_vocab):
   """ Swap integers in `x` for words, retun list of words"""
   inv_vocab[0] = '<pad>'
@@ -147,6 +613,7 @@ def vert_bar_chart(sent, attn, y_pred, y_true, name):
   plt.clf()
 
 def examine_attn(hp, sess, model, vocab, inv_vocab, data, name):
+  """ Plot attn of a random test sample, needs a model built with --full_attn """
   fetch = [model.col_attn, model.row_attn, model.attn_over_attn, model.y_pred, model.y_true]
   trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
                                                           teY, teYActual = data
@@ -166,7 +633,7 @@ def examine_attn(hp, sess, model, vocab, inv_vocab, data, name):
   print(sent)
   pass
 
-def save_results(sess, data, model, params):
+def save_results(sess, data, model, params, extra=None, cache=None):
   """
   Save results to a csv file with 3 columns:
   | test prediction binary | true binary | true string
@@ -175,19 +642,20 @@ def save_results(sess, data, model, params):
   hp = params
   trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
                                                           teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
 
-  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model)
+  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model, te_ex, cache)
 
   with open('result', 'a') as f:
-    val_acc = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, score='acc')
-    val_f1 = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, score='f1')
-    test_acc = accuracy(sess, teX, teXTags, teXlen, teY, model, score='acc')
-    test_f1 = accuracy(sess, teX, teXTags, teXlen, teY, model, score='f1')
-    test_auc = accuracy(sess, teX, teXTags, teXlen, teY, model, score='auc')
+    val_acc = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, 'acc', va_ex, cache)
+    val_f1 = accuracy(sess, vaX, vaXTags, vaXlen, vaY, model, 'f1', va_ex, cache)
+    test_acc = accuracy(sess, teX, teXTags, teXlen, teY, model, 'acc', te_ex, cache)
+    test_f1 = accuracy(sess, teX, teXTags, teXlen, teY, model, 'f1', te_ex, cache)
+    test_auc = accuracy(sess, teX, teXTags, teXlen, teY, model, 'auc', te_ex, cache)
     l = "{},{},{},{},{},{}\n".format(hp.ckpt_name, val_acc, val_f1, test_acc, test_f1, test_auc)
     f.write(l)
 
-def save_all_test_results(sess, data, model, params):
+def save_all_test_results(sess, data, model, params, extra=None, cache=None):
   """
   Save results to a csv file with 3 columns:
   | test prediction binary | true binary | true string
@@ -196,13 +664,14 @@ def save_all_test_results(sess, data, model, params):
   hp = params
   trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
                                                           teY, teYActual = data
+  tr_ex, va_ex, te_ex = extra or ((), (), ())
 
-  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model)
+  y_prob, y_pred, y_true = get_pred_true(sess, teX, teXTags, teXlen, teY, model, te_ex, cache)
 
   filename = hp.ckpt_name + "_res.csv"
 
   with open(filename, 'w') as f:
-    f.write(hp.ckpt_name, true, actual_label\n")
+    f.write("pred, true, actual_label\n")
     for i, _ in enumerate(y_pred):
       l = "{}, {}, {}\n".format(y_pred[i], y_true[i], teYActual[i])
       f.write(l)
@@ -0,0 +1,318 @@
+# Content addressed checkpoint store, deduplicated across runs
+#
+# Checkpoints are cut in chunks named by the sha1 of their content, so what
+# runs have in common is stored once: the embedding constant of every meta
+# graph, variables a warm start or frozen encoder left unchanged, pickles...
+# Each variable tensor is chunked on its own from its first byte, and big
+# constants are cut out of the meta graph the same way, so equal tensors give
+# equal chunks wherever they sit in the files. Chunks are compressed with zstd
+# if installed, else zlib at its fastest level. A manifest per ckpt_name
+# lists its chunks:
+#   <store>/chunks/ab/cdef...      compressed chunk of sha1 abcdef...
+#   <store>/manifests/<name>.json  variables, meta graph and other files
+# With --ckpt_store, save_model and load_model use the store instead of tars.
+# Existing tars are moved in with:
+# python ckpt_store.py migrate --store ckpts/store ckpts/*.tar
+import os, json, hashlib, zlib, tarfile, tempfile, shutil, argparse, time
+import tensorflow as tf
+import numpy as np
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+CHUNK_BYTES = 2**20
+# Meta graph constants of at least this size are stored as chunks of their own
+CONST_BYTES = 2**16
+ZLIB, ZSTD = b'z', b's'
+# Unreferenced chunks written or reused this recently may belong to a
+# checkpoint being saved, whose manifest isn't written yet: they are kept
+GRACE = 3600
+
+def manifest_path(root, name):
+  return os.path.join(root, 'manifests', name + '.json')
+
+def write_atomic(path, data):
+  """ Write through a temp file, a chunk or manifest on disk is always whole """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = "{}.{}.tmp".format(path, os.getpid())
+  with open(tmp_path, "wb") as f: f.write(data)
+  os.replace(tmp_path, path)
+
+class CheckpointStore():
+  """
+  Chunks are written, or touched if already stored, before the manifest
+  referencing them, so a crash leaves at worst unreferenced chunks, removed
+  by gc. Overwriting or removing a checkpoint removes its old chunks no other
+  manifest uses and no put wrote or touched within GRACE seconds, gc the rest
+  """
+  def __init__(self, root):
+    self.root = root
+    self.raw = 0     # bytes given to put_bytes
+    self.written = 0 # compressed bytes of new chunks
+
+  def chunk_path(self, key):
+    return os.path.join(self.root, 'chunks', key[:2], key[2:])
+
+  def compress(self, data):
+    if zstandard is not None:
+      return ZSTD + zstandard.ZstdCompressor(level=3).compress(data)
+    return ZLIB + zlib.compress(data, 1)
+
+  def decompress(self, blob):
+    codec, body = blob[:1], blob[1:]
+    if codec == ZSTD:
+      if zstandard is None:
+        raise ImportError("Chunk compressed with zstd, install zstandard")
+      return zstandard.ZstdDecompressor().decompress(body)
+    return zlib.decompress(body)
+
+  def put_bytes(self, data):
+    """ Store `data` as chunks, only those not stored yet. Returns their keys """
+    keys = []
+    view = memoryview(data)
+    for start in range(0, len(data), CHUNK_BYTES):
+      chunk = view[start:start+CHUNK_BYTES]
+      key = hashlib.sha1(chunk).hexdigest()
+      path = self.chunk_path(key)
+      if not self.touch(path):
+        blob = self.compress(chunk)
+        write_atomic(path, blob)
+        self.written += len(blob)
+      self.raw += len(chunk)
+      keys.append(key)
+    return keys
+
+  def touch(self, path):
+    """ Mark a stored chunk as in use now, False if it isn't stored """
+    try:
+      os.utime(path)
+      return True
+    except FileNotFoundError:
+      return False
+
+  def get_bytes(self, keys):
+    parts = []
+    for key in keys:
+      with open(self.chunk_path(key), "rb") as f:
+        chunk = self.decompress(f.read())
+      if hashlib.sha1(chunk).hexdigest() != key:
+        raise IOError("Corrupt chunk " + key)
+      parts.append(chunk)
+    return b''.join(parts)
+
+  def put_variables(self, prefix):
+    """ Each variable of the TF checkpoint `prefix`, chunked on its own """
+    reader = tf.train.NewCheckpointReader(prefix)
+    records = []
+    for name in sorted(reader.get_variable_to_shape_map()):
+      arr = np.ascontiguousarray(reader.get_tensor(name))
+      records.append({'name': name, 'dtype': arr.dtype.str,
+                      'shape': list(arr.shape),
+                      'chunks': self.put_bytes(arr.tobytes())})
+    return records
+
+  def write_variables(self, records, prefix):
+    """ Write the variables of `records` as a TF checkpoint at `prefix` """
+    with tf.Graph().as_default(), tf.Session() as sess:
+      variables, feed = {}, {}
+      for i, r in enumerate(records):
+        arr = np.frombuffer(self.get_bytes(r['chunks']),
+                            dtype=np.dtype(r['dtype'])).reshape(r['shape'])
+        value = tf.placeholder(arr.dtype, arr.shape)
+        # Checkpoint names set by the saver, op names need not match
+        variables[r['name']] = tf.Variable(value, name='var{}'.format(i))
+        feed[value] = arr
+      sess.run(tf.variables_initializer(list(variables.values())), feed)
+      tf.train.Saver(variables).save(sess, prefix, write_meta_graph=False,
+                                                        write_state=False)
+
+  def put_meta(self, path):
+    """ Meta graph chunks and {node name: chunks} of its big constants """
+    meta = tf.MetaGraphDef()
+    with open(path, "rb") as f: meta.ParseFromString(f.read())
+    consts = {}
+    for node in meta.graph_def.node:
+      if node.op != 'Const': continue
+      tensor = node.attr['value'].tensor
+      if len(tensor.tensor_content) >= CONST_BYTES:
+        consts[node.name] = self.put_bytes(tensor.tensor_content)
+        tensor.tensor_content = b''
+    return self.put_bytes(meta.SerializeToString()), consts
+
+  def get_meta(self, keys, consts):
+    meta = tf.MetaGraphDef()
+    meta.ParseFromString(self.get_bytes(keys))
+    for node in meta.graph_def.node:
+      if node.name in consts:
+        node.attr['value'].tensor.tensor_content = self.get_bytes(consts[node.name])
+    return meta.SerializeToString()
+
+  def put(self, name, directory):
+    """
+    Store checkpoint `name` from the files under `directory`, as written by
+    save_model or extracted from its tar. The TF `checkpoint` state file is
+    not kept, the index is rebuilt with the variables
+    """
+    raw = self.raw
+    manifest = {'name': name, 'files': {}, 'consts': {}}
+    for root, _, files in os.walk(directory):
+      for f in sorted(files):
+        path = os.path.join(root, f)
+        if f == 'checkpoint' or f.endswith('.index'): continue
+        if '.data-' in f:
+          if 'model' in manifest: continue # other shard, same checkpoint
+          prefix = path.split('.data-')[0]
+          manifest['model'] = os.path.basename(prefix)
+          manifest['variables'] = self.put_variables(prefix)
+        elif f.endswith('.meta'):
+          manifest['meta'] = f
+          manifest['files'][f], manifest['consts'] = self.put_meta(path)
+        else:
+          with open(path, "rb") as fh: manifest['files'][f] = self.put_bytes(fh.read())
+    if 'model' not in manifest:
+      raise ValueError("No variables found for checkpoint " + name)
+    manifest['bytes'] = self.raw - raw
+
+    old = self.manifest(name) if self.exists(name) else None
+    write_atomic(manifest_path(self.root, name),
+                 json.dumps(manifest, indent=1).encode())
+    if old is not None:
+      self.remove_unused(manifest_keys(old) - manifest_keys(manifest))
+    return manifest
+
+  def extract(self, name, directory):
+    """
+    Write checkpoint `name` to `directory` as save_model laid it out before
+    tarring. Returns the path prefix of the variables
+    """
+    manifest = self.manifest(name)
+    for f, keys in manifest['files'].items():
+      if f == manifest.get('meta'):
+        data = self.get_meta(keys, manifest['consts'])
+      else:
+        data = self.get_bytes(keys)
+      with open(os.path.join(directory, f), "wb") as fh: fh.write(data)
+    prefix = os.path.join(directory, manifest['model'])
+    self.write_variables(manifest['variables'], prefix)
+    return prefix
+
+  def exists(self, name):
+    return os.path.exists(manifest_path(self.root, name))
+
+  def manifest(self, name):
+    with open(manifest_path(self.root, name)) as f: return json.load(f)
+
+  def names(self):
+    directory = os.path.join(self.root, 'manifests')
+    if not os.path.exists(directory): return []
+    return sorted(f[:-len('.json')] for f in os.listdir(directory)
+                                                    if f.endswith('.json'))
+
+  def used_keys(self):
+    keys = set()
+    for name in self.names():
+      keys |= manifest_keys(self.manifest(name))
+    return keys
+
+  def remove_unused(self, keys, grace=GRACE):
+    """
+    Remove chunks of `keys` referenced by no manifest, unless written or
+    touched in the last `grace` seconds. Returns bytes freed
+    """
+    return sum(remove_stale(self.chunk_path(key), grace)
+                                      for key in keys - self.used_keys())
+
+  def remove(self, name):
+    keys = manifest_keys(self.manifest(name))
+    os.remove(manifest_path(self.root, name))
+    self.remove_unused(keys)
+
+  def gc(self, grace=GRACE):
+    """
+    Remove chunks no manifest references, older than `grace` seconds so the
+    chunks of a checkpoint being saved are left alone. Returns bytes freed
+    """
+    used, freed = self.used_keys(), 0
+    for root, _, files in os.walk(os.path.join(self.root, 'chunks')):
+      for f in files:
+        if os.path.basename(root) + f in used: continue
+        freed += remove_stale(os.path.join(root, f), grace)
+    return freed
+
+  def stats(self):
+    """ Bytes of all checkpoints before dedup and compression, and on disk """
+    logical = sum(self.manifest(name)['bytes'] for name in self.names())
+    physical = 0
+    for root, _, files in os.walk(os.path.join(self.root, 'chunks')):
+      physical += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return {'checkpoints': len(self.names()), 'logical_mb': logical / 2**20,
+            'stored_mb': physical / 2**20,
+            'ratio': logical / physical if physical > 0 else 0.}
+
+def remove_stale(path, grace):
+  """ Remove `path` if not modified in `grace` seconds, returns bytes freed """
+  try:
+    if time.time() - os.path.getmtime(path) < grace: return 0
+    size = os.path.getsize(path)
+    os.remove(path)
+  except FileNotFoundError:
+    return 0
+  return size
+
+def manifest_keys(manifest):
+  keys = set()
+  for chunks in manifest['files'].values(): keys.update(chunks)
+  for chunks in manifest['consts'].values(): keys.update(chunks)
+  for r in manifest['variables']: keys.update(r['chunks'])
+  return keys
+
+def same_variables(prefix_a, prefix_b):
+  """ True if both TF checkpoints hold the same variables and values """
+  a = tf.train.NewCheckpointReader(prefix_a)
+  b = tf.train.NewCheckpointReader(prefix_b)
+  names = a.get_variable_to_shape_map()
+  if names != b.get_variable_to_shape_map(): return False
+  return all(np.array_equal(a.get_tensor(n), b.get_tensor(n)) for n in names)
+
+def migrate(store, tar_path, remove_tar=False):
+  """ Store the checkpoint of a save_model tar, named like the tar """
+  name = os.path.basename(tar_path)[:-len('.tar')]
+  tmp_dir, out_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+  try:
+    with tarfile.open(tar_path) as tar: tar.extractall(tmp_dir)
+    store.put(name, tmp_dir)
+    if remove_tar:
+      # Only once the stored copy reads back the same
+      prefix = store.extract(name, out_dir)
+      data = [os.path.join(r, f) for r, _, fs in os.walk(tmp_dir)
+                                            for f in fs if '.data-' in f]
+      if not same_variables(data[0].split('.data-')[0], prefix):
+        raise IOError("Stored {} differs from its tar, tar kept".format(name))
+      os.remove(tar_path)
+  finally:
+    shutil.rmtree(tmp_dir)
+    shutil.rmtree(out_dir)
+  return name
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('command', choices=['migrate', 'gc', 'stats'])
+  parser.add_argument('tars', nargs='*', help='tars to migrate')
+  parser.add_argument('--store', type=str, required=True)
+  parser.add_argument('--remove_tars', action='store_true', default=False,
+                      help='remove each tar once its stored copy is checked')
+  parser.add_argument('--grace', type=int, default=GRACE,
+                      help='gc keeps unreferenced chunks younger than this, sec')
+  args = parser.parse_args()
+  store = CheckpointStore(args.store)
+
+  if args.command == 'migrate':
+    for tar_path in args.tars:
+      raw, written = store.raw, store.written
+      name = migrate(store, tar_path, args.remove_tars)
+      print("{}: {:.1f} MB, {:.1f} MB new chunks".format(name,
+                    (store.raw - raw) / 2**20, (store.written - written) / 2**20))
+  elif args.command == 'gc':
+    print("Freed {:.1f} MB".format(store.gc(args.grace) / 2**20))
+  print(store.stats())
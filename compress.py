@@ -0,0 +1,214 @@
+# Post training compression of the LSTM encoder and dense layers
+#
+# For each level in --compress_levels, keeps that fraction of the LSTM hidden
+# units, those of largest weight magnitude, and factors the LSTM kernels and
+# dense weights to that fraction of their rank with an SVD, where it saves
+# multiply-adds. Each level is saved as checkpoint <ckpt_name>_c<percent>,
+# its hyper params set so the model classes build the smaller layers, then
+# optionally fine tuned for --compress_finetune epochs and reloaded to report
+# its scores and inference speed:
+# python compress.py --ckpt_name wsj_natural --data_dir ... --pickle ... --compress_levels 0.75 0.5 0.25 --compress_finetune 2
+import copy, json
+import tensorflow as tf
+import numpy as np
+from utils import HParams, load_model, load_saved_model, save_model
+from utils import session_config, load_trigger_data, load_data
+from call_model import train_model, compression_scores
+from model import ENCODER_SCOPES, EMB_VARS
+
+def model_values(sess, model):
+  """ Trainable variables and the global step, optimizer slots left out """
+  variables = tf.trainable_variables() + [model.global_step]
+  return {var.op.name: value for var, value in
+                          zip(variables, sess.run(variables))}
+
+def variable_shapes(hp, emb, postag_size):
+  """ Shape of each variable of the model `hp` builds, in a throwaway graph """
+  with tf.Graph().as_default(), tf.Session() as sess:
+    hp = copy.deepcopy(hp)
+    hp.update('load_saved', False)
+    load_model(sess, emb, hp, postag_size)
+    return {var.op.name: var.shape.as_list() for var in tf.global_variables()}
+
+def param_count(values):
+  """ Weights excluding the embedding """
+  return int(sum(v.size for name, v in values.items()
+                      if name.split('/')[-1] not in EMB_VARS + ['global_step']))
+
+def encoder_cells(values):
+  """ Scopes of the encoder LSTM cells, forward first as in the encoded outputs """
+  cells = [name[:-len('/kernel')] for name in values
+              if name.endswith('lstm_cell/kernel')
+              and name.split('/')[0] in ENCODER_SCOPES]
+  return sorted(cells, key=lambda cell: '/bw/' in cell)
+
+def unit_scores(kernel, h_depth):
+  """
+  L2 norm of the weights into each hidden unit, its columns of the 4 gates,
+  plus of its recurrent weights out, its kernel row
+  """
+  gates = kernel.reshape(kernel.shape[0], 4, h_depth)
+  incoming = np.sqrt((gates**2).sum(axis=(0, 1)))
+  outgoing = np.linalg.norm(kernel[-h_depth:], axis=1)
+  return incoming + outgoing
+
+def prune_plan(values, keep):
+  """
+  Hidden units of each encoder cell kept at fraction `keep`, and the index of
+  the kept units in the encoded outputs, cells concatenated
+  """
+  cells = encoder_cells(values)
+  if len(cells) == 0:
+    raise ValueError("Hidden unit pruning needs an LSTMCell encoder")
+  h_depth = values[cells[0] + '/kernel'].shape[1] // 4
+  units = max(1, int(round(h_depth * keep)))
+  kept, enc_index = {}, []
+  for i, cell in enumerate(cells):
+    scores = unit_scores(values[cell + '/kernel'], h_depth)
+    kept[cell] = np.sort(np.argsort(-scores)[:units])
+    enc_index.append(i * h_depth + kept[cell])
+  return {'cells': kept, 'enc_index': np.concatenate(enc_index),
+          'old_h': h_depth * len(cells), 'new_h': units * len(cells),
+          'units': units}
+
+def slice_value(name, value, shape, plan):
+  """
+  `value` of variable `name` cut to `shape` by `plan`: cell kernels lose the
+  recurrent rows and gate columns of pruned units, other variables the
+  pruned units along each axis sized by the encoded outputs
+  """
+  if plan is None or list(value.shape) == list(shape):
+    return value
+  cell = name.rsplit('/', 1)[0]
+  if cell in plan['cells']:
+    h_depth = value.shape[-1] // 4
+    kept = plan['cells'][cell]
+    cols = np.concatenate([g * h_depth + kept for g in range(4)])
+    if value.ndim == 1:
+      return value[cols]
+    in_depth = value.shape[0] - h_depth
+    rows = np.concatenate([np.arange(in_depth), in_depth + kept])
+    return value[np.ix_(rows, cols)]
+  for axis, (old, new) in enumerate(zip(value.shape, shape)):
+    if old == new: continue
+    if old != plan['old_h'] or new != plan['new_h']:
+      raise ValueError("Can't cut {} from {} to {}".format(name, value.shape, shape))
+    value = np.take(value, plan['enc_index'], axis=axis)
+  return value
+
+def factor(weights, rank):
+  """ u [in, rank], v [rank, out] with u.v the best rank `rank` approximation """
+  u, s, vt = np.linalg.svd(weights, full_matrices=False)
+  root = np.sqrt(s[:rank])
+  return u[:, :rank] * root, root[:, None] * vt[:rank]
+
+def choose_ranks(shapes, keep, cell_type):
+  """
+  `hp.low_rank` of dense weights and LSTM kernels at fraction `keep` of their
+  full rank, where two factors are smaller than the matrix. Output layers,
+  [in, num_classes], are left whole
+  """
+  ranks = {}
+  for name, shape in shapes.items():
+    scope, var = name.rsplit('/', 1)
+    is_dense = var == 'weights' and 'class_log' not in scope
+    is_cell = var == 'kernel' and scope.endswith('lstm_cell') and cell_type == 'LSTMCell'
+    if len(shape) != 2 or not (is_dense or is_cell): continue
+    rank = max(1, int(round(min(shape) * keep)))
+    if rank * sum(shape) < shape[0] * shape[1]:
+      ranks[scope] = rank
+  return ranks
+
+def compressed_values(values, shapes, plan):
+  """ Values of the compressed model's variables, from the source model's """
+  new, factors = {}, {}
+  for name, shape in shapes.items():
+    if name in values:
+      new[name] = slice_value(name, values[name], shape, plan)
+    elif name[-2:] in ('_u', '_v') and name[:-2] in values:
+      base = name[:-2]
+      if base not in factors:
+        full = [shapes[base + '_u'][0], shapes[base + '_v'][1]]
+        whole = slice_value(base, values[base], full, plan)
+        factors[base] = [f.astype(whole.dtype)
+                          for f in factor(whole, shapes[base + '_u'][1])]
+      new[name] = factors[base][0 if name.endswith('_u') else 1]
+  return new
+
+def compress(hp, src_hp, values, keep, emb, postag_size, data, extra):
+  """ Build, save, optionally fine tune, compression level `keep` """
+  new_hp = copy.deepcopy(src_hp)
+  name = "{}_c{}".format(src_hp.ckpt_name, int(round(keep * 100)))
+  for k, v in [('ckpt_name', name), ('load_saved', False), ('warm_start', None),
+               ('low_rank', None), ('max_epochs', hp.compress_finetune)]:
+    new_hp.update(k, v)
+  plan = None
+  if 'units' in hp.compress_methods:
+    if src_hp.parallel:
+      raise ValueError("Hidden unit pruning needs a single encoder, not --parallel")
+    plan = prune_plan(values, keep)
+    new_hp.update('cell_units', plan['units'])
+  if 'low_rank' in hp.compress_methods:
+    shapes = variable_shapes(new_hp, emb, postag_size)
+    new_hp.update('low_rank', choose_ranks(shapes, keep, new_hp.cell_type))
+  shapes = variable_shapes(new_hp, emb, postag_size)
+  new_values = compressed_values(values, shapes, plan)
+
+  with tf.Graph().as_default(), tf.Session(config=session_config(hp)) as sess:
+    model, saver, new_hp, _ = load_model(sess, emb, new_hp, postag_size)
+    missing = [var.op.name for var in tf.trainable_variables()
+                                    if var.op.name not in new_values]
+    if len(missing) > 0:
+      raise ValueError("No source weights for {}".format(missing))
+    for var in tf.global_variables():
+      if var.op.name in new_values:
+        var.load(new_values[var.op.name], sess)
+    scores = compression_scores(new_hp, sess, model, data, extra)
+    result = {'va_acc': scores['va_acc'], 'te_acc': scores['te_acc'], 'epoch': 0}
+    save_model(sess, saver, new_hp, result, new_values['global_step'])
+    # Overwrites the checkpoint only on a better validation score
+    if hp.compress_finetune > 0:
+      train_model(new_hp, sess, saver, model, result, data, extra)
+  return new_hp
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.triggers is not None:
+    emb, word_idx_map, data, postag_size, extra = load_trigger_data(hp, load_data)
+  else:
+    emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
+    extra = None
+
+  sess, model, src_hp, _ = load_saved_model(emb, hp, postag_size,
+                                        hp.ckpt_name, session_config(hp))
+  if getattr(src_hp, 'low_rank', None):
+    raise ValueError("{} is already compressed, start from the original"
+                                                      .format(hp.ckpt_name))
+  with sess.graph.as_default():
+    values = model_values(sess, model)
+    base = compression_scores(src_hp, sess, model, data, extra)
+  sess.close()
+  base.update(level=1.0, ckpt_name=hp.ckpt_name, params=param_count(values))
+  report = [base]
+
+  for keep in hp.compress_levels:
+    new_hp = compress(hp, src_hp, values, keep, emb, postag_size, data, extra)
+    # Scores of the saved checkpoint, as the model classes load it
+    sess, model, new_hp, _ = load_saved_model(emb, hp, postag_size,
+                                        new_hp.ckpt_name, session_config(hp))
+    with sess.graph.as_default():
+      row = compression_scores(new_hp, sess, model, data, extra)
+      row.update(level=keep, ckpt_name=new_hp.ckpt_name,
+                 params=param_count(model_values(sess, model)))
+    sess.close()
+    report.append(row)
+
+  print("{:>6} {:>10} {:>8} {:>8} {:>12} {:>8}".format(
+          'level', 'params', 'va', 'te', 'samples/sec', 'speedup'))
+  for row in report:
+    print("{:>6.2f} {:>10} {:>8.4f} {:>8.4f} {:>12.0f} {:>8.2f}".format(
+          row['level'], row['params'], row['va_acc'], row['te_acc'],
+          row['samples_sec'], row['samples_sec'] / base['samples_sec']))
+  path = "{}/{}_compress.json".format(hp.ckpt_dir, hp.ckpt_name)
+  with open(path, "w") as f: json.dump(report, f, indent=2)
+  print("Wrote " + path)
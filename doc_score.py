@@ -0,0 +1,153 @@
+# Sliding window scoring of long documents, each token encoded once
+#
+# Documents are the lines of --doc_in, tokenised (and POS tagged) as by
+# preprocess.py, so --pickle must be a vocab it wrote, that of the
+# checkpoint's training data. Windows of max_seq_len tokens every --doc_stride
+# tokens are scored by the checkpoint's head, like samples cut out of the
+# document. The unidirectional LSTM runs once over each document,
+# max_seq_len tokens at a time with its state carried over, and the head of
+# each window reads the cached encoder outputs of its tokens. A token is then
+# encoded once instead of once per window covering it, and its encoding has
+# seen the document from its start rather than from the window start.
+# --doc_stateless encodes each window on its own instead, to compare. One
+# json line per document written to --doc_out:
+# python doc_score.py --ckpt_name giga_again_uni --pickle processed/giga_again/processed.pkl --postags --doc_in docs.txt --doc_out docs.jsonl --doc_stride 20
+import json, time
+import numpy as np
+from utils import HParams, load_saved_model, session_config, eval_batch_size
+from preprocess import tokenize, tag, load_vocab, PAD, UNK
+
+def read_docs(hp, word_idx_map, tag_idx_map):
+  """ Word ids and POS tag ids of each document, as int32 arrays """
+  remove = set(w.lower() for w in (hp.remove_words or []))
+  with open(hp.doc_in, encoding='utf-8') as f:
+    for line in f:
+      tokens = [w for w in tokenize(line.strip()) if w.lower() not in remove]
+      ids = np.array([word_idx_map.get(w, UNK) for w in tokens], dtype=np.int32)
+      if tag_idx_map is None:
+        tags = np.zeros(len(tokens), dtype=np.int32)
+      else:
+        tags = np.array([tag_idx_map.get(t, PAD) for t in tag(tokens)], dtype=np.int32)
+      yield ids, tags
+
+def window_starts(length, size, stride):
+  """ Start of each window, the last one ending with the document """
+  if length <= size:
+    return [0]
+  starts = list(range(0, length - size + 1, stride))
+  if starts[-1] + size < length:
+    starts.append(length - size)
+  return starts
+
+def base_feed(model):
+  return {model.keep_prob: 1, model.rnn_in_keep_prob: 1, model.mode: 0}
+
+def encode_docs(sess, model, hp, docs):
+  """
+  Encoder outputs [length, h_size] of each document. Documents are batched,
+  each run encodes the next max_seq_len tokens of those not done, from the
+  LSTM state the previous run ended with
+  """
+  size = hp.max_seq_len
+  outs = [np.zeros((len(ids), model.encoder_h_size), np.float32) for ids, _ in docs]
+  c = np.zeros((len(docs), hp.cell_units), np.float32)
+  h = np.zeros((len(docs), hp.cell_units), np.float32)
+  for start in range(0, max(len(ids) for ids, _ in docs), size):
+    active = [i for i, (ids, _) in enumerate(docs) if len(ids) > start]
+    x = np.zeros((len(active), size), np.int32)
+    x_tags = np.zeros((len(active), size), np.int32)
+    x_len = np.zeros(len(active), np.int32)
+    for j, i in enumerate(active):
+      ids, tags = docs[i][0][start:start+size], docs[i][1][start:start+size]
+      x[j, :len(ids)], x_tags[j, :len(ids)], x_len[j] = ids, tags, len(ids)
+    feed = base_feed(model)
+    feed.update({model.inputs: x, model.postags: x_tags, model.input_len: x_len,
+                 model.init_state.c: c[active], model.init_state.h: h[active]})
+    enc, state = sess.run([model.encoded_outputs, model.encoded_state], feed)
+    c[active], h[active] = state.c, state.h
+    for j, i in enumerate(active):
+      outs[i][start:start+x_len[j]] = enc[j, :x_len[j]]
+  return outs
+
+def score_windows(sess, model, hp, docs, stride, encs=None):
+  """
+  Class probabilities of every window of every document. With the encoder
+  outputs `encs` the head reads their window, else windows are encoded anew
+  Returns:
+    per document, its window starts and [windows, classes] probabilities
+  """
+  size = hp.max_seq_len
+  windows = [(d, s) for d, (ids, _) in enumerate(docs)
+                    for s in window_starts(len(ids), size, stride)]
+  probs = []
+  batch_size = eval_batch_size(hp)
+  for b in range(0, len(windows), batch_size):
+    batch = windows[b:b+batch_size]
+    x = np.zeros((len(batch), size), np.int32)
+    x_tags = np.zeros((len(batch), size), np.int32)
+    x_len = np.zeros(len(batch), np.int32)
+    enc = np.zeros((len(batch), size, model.encoder_h_size), np.float32)
+    for j, (d, s) in enumerate(batch):
+      ids, tags = docs[d][0][s:s+size], docs[d][1][s:s+size]
+      x[j, :len(ids)], x_tags[j, :len(ids)], x_len[j] = ids, tags, len(ids)
+      if encs is not None:
+        enc[j, :len(ids)] = encs[d][s:s+size]
+    feed = base_feed(model)
+    feed.update({model.inputs: x, model.postags: x_tags, model.input_len: x_len})
+    # Fed encoder outputs cut the graph before the LSTM
+    if encs is not None:
+      feed[model.encoded_outputs] = enc
+    probs.append(sess.run(model.y_prob, feed))
+  probs = np.concatenate(probs) if len(probs) > 0 else np.zeros((0, 2))
+  per_doc = [([], []) for _ in docs]
+  for (d, s), p in zip(windows, probs):
+    per_doc[d][0].append(s)
+    per_doc[d][1].append(p)
+  return per_doc
+
+def check_model(hp, model):
+  if model.init_state is None or getattr(hp, 'parallel', False):
+    raise ValueError("State carry needs a single unidirectional LSTMCell "
+                     "encoder, use --doc_stateless")
+  if len(getattr(model, 'extra_inputs', [])) > 0:
+    raise ValueError("Document scoring doesn't feed extra inputs")
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.doc_in is None or hp.doc_out is None:
+    raise ValueError("Set --doc_in and --doc_out")
+  # Word and POS tag ids, and UNK, of the vocab of preprocess.py only, the
+  # dataset itself is not needed
+  emb, word_idx_map, tag_idx_map = load_vocab(hp.pickle)
+  postag_size = len(tag_idx_map) + 1 if hp.postags else 0
+  if not hp.postags: tag_idx_map = None
+  sess, model, model_hp, _ = load_saved_model(emb, hp, postag_size,
+                                        hp.ckpt_name, session_config(hp))
+  if not hp.doc_stateless:
+    check_model(model_hp, model)
+  stride = hp.doc_stride or model_hp.max_seq_len // 2
+
+  docs_done, tokens, n_windows, t1 = 0, 0, 0, time.time()
+  reader = enumerate(read_docs(hp, word_idx_map, tag_idx_map))
+  with open(hp.doc_out, "w") as out:
+    while True:
+      lines = [doc for _, doc in zip(range(hp.doc_batch), reader)]
+      if len(lines) == 0: break
+      # Documents without tokens get no line
+      lines = [(n, doc) for n, doc in lines if len(doc[0]) > 0]
+      if len(lines) == 0: continue
+      docs = [doc for _, doc in lines]
+      encs = None if hp.doc_stateless else encode_docs(sess, model, model_hp, docs)
+      for (n, (ids, _)), (starts, probs) in zip(lines,
+                          score_windows(sess, model, model_hp, docs, stride, encs)):
+        pos = [float(p[1]) for p in probs]
+        best = int(np.argmax(pos))
+        out.write(json.dumps({'doc': n, 'tokens': len(ids),
+                  'starts': starts, 'y_prob': pos, 'max_prob': pos[best],
+                  'best_start': starts[best], 'y_pred': int(pos[best] >= 0.5)}) + "\n")
+        docs_done += 1
+        tokens += len(ids)
+        n_windows += len(starts)
+      sec = time.time() - t1
+      print("{} docs, {} windows, {:.0f} tokens/sec".format(docs_done,
+                                                    n_windows, tokens / sec))
@@ -0,0 +1,101 @@
+# Export trained models for serving without the training code
+import os, json
+import numpy as np
+import tensorflow as tf
+from np_model import NumpyModel
+from quant import QuantizedEmbedding
+
+def export_weights(sess, model, hp, postag_size, path):
+  """
+  Write all trainable variables, the embedding and the hyper params to a
+  single numpy `.npz` file, readable by `np_model.NumpyModel`
+  """
+  weights = {}
+  emb_rows = getattr(model, 'emb_rows', None)
+  for var in tf.trainable_variables():
+    if var is model.embedding_tensor or var is emb_rows: continue
+    weights[var.op.name] = sess.run(var)
+  # Embedding is a variable if trainable, the raw matrix otherwise
+  if isinstance(model.embedding_tensor, np.ndarray):
+    weights['embedding'] = model.embedding_tensor.astype(np.float32)
+  elif isinstance(model.embedding_tensor, QuantizedEmbedding):
+    weights['embedding'] = model.embedding_tensor.decode()
+  else:
+    weights['embedding'] = sess.run(model.embedding_tensor)
+  # Trained rows of a partly trainable embedding
+  if emb_rows is not None:
+    weights['embedding'][hp.emb_train_ids] = sess.run(emb_rows)
+
+  params = {k: v for k, v in vars(hp).items() if is_jsonable(v)}
+  params['head'] = getattr(model, 'head_name', None)
+  params['postag_size'] = postag_size
+  weights['__hp__'] = np.array(json.dumps(params))
+  np.savez(path, **weights)
+
+def export_saved_model(sess, model, export_dir):
+  """
+  SavedModel with the input placeholders and probability/prediction outputs.
+  Dropout keep probabilities are inputs, feed 1.0 at inference
+  """
+  inputs = {
+      'inputs'           : model.inputs,
+      'postags'          : model.postags,
+      'input_len'        : model.input_len,
+      'keep_prob'        : model.keep_prob,
+      'rnn_in_keep_prob' : model.rnn_in_keep_prob,
+      'mode'             : model.mode
+      }
+  for i, placeholder in enumerate(getattr(model, 'extra_inputs', [])):
+    inputs['extra{}'.format(i)] = placeholder
+  outputs = {'y_prob': model.y_prob, 'y_pred': model.y_pred}
+  tf.saved_model.simple_save(sess, export_dir, inputs, outputs)
+
+def check_parity(sess, model, path, x, postags, x_len):
+  """ Max absolute difference of y_prob between TF and numpy on a batch """
+  feed = {
+      model.inputs           : x,
+      model.postags          : postags,
+      model.input_len        : x_len,
+      model.keep_prob        : 1.0,
+      model.rnn_in_keep_prob : 1.0,
+      model.mode             : 0
+      }
+  tf_prob = sess.run(model.y_prob, feed)
+  np_prob = NumpyModel(path).predict(x, postags, x_len)
+  return np.max(np.abs(tf_prob - np_prob))
+
+def export_model(sess, model, hp, postag_size, export_dir, data, n_check=256):
+  """
+  Write `export_dir`/saved_model and `export_dir`/weights.npz, then check the
+  numpy runtime against TF on the first `n_check` test samples
+  """
+  trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,\
+                                                          teY, teYActual = data
+  if not os.path.exists(export_dir): os.makedirs(export_dir)
+  export_saved_model(sess, model, os.path.join(export_dir, 'saved_model'))
+  # The numpy runtime serves single models. Heads and replicas are exported
+  # from their <ckpt_name>_<head> and <ckpt_name>_r<i> checkpoints
+  if hasattr(model, 'heads'):
+    print("Exported {} to {}, for weights.npz export its {} checkpoints".format(
+          type(model).__name__, export_dir, ", ".join(model.head_names)))
+    return
+  # The numpy runtime takes no extra inputs such as trigger ids, and only
+  # some RNN models, CNN has no head
+  params = dict(vars(hp), head=getattr(model, 'head_name', None))
+  reason = NumpyModel.unsupported(params)
+  if len(getattr(model, 'extra_inputs', [])) > 0:
+    reason = "extra inputs"
+  if reason is not None:
+    print("Exported model to {}, no weights.npz, the numpy runtime doesn't "
+          "support its {}".format(export_dir, reason))
+    return
+  path = os.path.join(export_dir, 'weights.npz')
+  export_weights(sess, model, hp, postag_size, path)
+  print("Exported model to " + export_dir)
+  diff = check_parity(sess, model, path,
+                      teX[:n_check], teXTags[:n_check], teXlen[:n_check])
+  print("Numpy runtime max abs diff of y_prob: {:.2e}".format(diff))
+
+def is_jsonable(v):
+  """ Only plain values go in the exported hyper params """
+  return v is None or isinstance(v, (bool, int, float, str, list))
@@ -10,38 +10,76 @@ import os
 import tensorflow as tf
 import numpy as np
 from call_model import train_model, examine_attn, save_results
-from utils import HParams, load_model, data_info, print_info
-from CNN_sentence import load_data
-# Control repeatability
-random_seed=1
-tf.set_random_seed(random_seed)
+from call_model import distill_setup, report_distill, run_cascade, prune_curve
+from export import export_model
+from cache import PredictionCache, checkpoint_id
+from quant import quantized_embedding
+from utils import HParams, load_model, data_info, print_info, load_trigger_data
+from utils import frequent_ids, session_config, class_weights, load_data
 
 if __name__=="__main__":
   # Get hyperparams from argparse and defaults
   hp = HParams()
+  # Control repeatability
+  tf.set_random_seed(hp.seed)
   mode = hp.mode
+  export_dir = hp.export_dir
 
-  # Get data
-  emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
+  # Get data, merged over triggers for a single multi-trigger model
+  extra = None
+  if hp.triggers is not None:
+    emb, word_idx_map, data, postag_size, extra = load_trigger_data(hp, load_data)
+  else:
+    emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
   print_info(data)
+  # Codes in place of the float embedding, decoded by batch in the graph
+  if hp.emb_quant is not None:
+    emb = quantized_embedding(hp, emb)
 
   # Inverse vocab
   inv_vocab =  data_info(emb,word_idx_map)
 
+  # Only the most frequent training words get a trainable embedding
+  if hp.emb_trainable and hp.emb_train_top > 0 and not hp.load_saved:
+    hp.update('emb_train_ids', frequent_ids(data[0], hp.emb_train_top))
+
+  # Loss weights making the natural class distribution count as balanced
+  if mode == 1 and hp.balance == 'reweight' and not hp.load_saved:
+    hp.update('class_weights', class_weights(data[3], hp.num_classes, hp.balance_ratio))
+
   # Start tf session
-  with tf.Graph().as_default(), tf.Session() as sess:
+  with tf.Graph().as_default(), tf.Session(config=session_config(hp)) as sess:
     # Get the model
     model, saver, hp, result = load_model(sess, emb, hp, postag_size)
 
     # Check the params
     print(hp)
 
-    # Train the model or examine results
-    if mode == 1:
+    # Teacher soft labels for distillation, from the loaded hp so a distilled
+    # checkpoint resumes training with its teacher
+    if mode == 1 and hp.distill_from is not None:
+      extra, teacher_res = distill_setup(hp, emb, postag_size, data, extra)
+
+    # Train the model, export it or examine results
+    if export_dir is not None:
+      export_model(sess, model, hp, postag_size, export_dir, data)
+    elif mode == 0 and hp.prune_curve is not None:
+      prune_curve(hp, sess, model, data, hp.prune_curve, extra)
+    elif mode == 0 and hp.cascade_cheap is not None:
+      run_cascade(hp, sess, model, emb, postag_size, data, extra)
+    elif mode == 1:
       # Train the model!
-      train_model(hp, sess, saver, model, result, data)
+      train_model(hp, sess, saver, model, result, data, extra)
+      if hp.distill_from is not None:
+        report_distill(hp, emb, postag_size, data, extra, teacher_res)
     else:
-      save_results(sess,data,model, hp)
+      cache = None
+      if hp.cache_mb > 0 and hp.load_saved:
+        cache = PredictionCache(checkpoint_id(hp), hp.cache_mb*2**20, hp.cache_path)
+      save_results(sess,data,model, hp, extra, cache)
+      if cache is not None:
+        print("Prediction cache: {}".format(cache.stats()))
+        cache.close()
       for i in range(50):
         name = 'viz/' + str(i) + '.png'
         # examine_attn(hp, sess, model, word_idx_map, inv_vocab, data, name)
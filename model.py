@@ -1,7 +1,9 @@
 # Author: Andre Cianflone
+import zlib
 import numpy as np
 from pydoc import locate
 import tensorflow as tf
+from quant import QuantizedEmbedding
 
 # Global numerical types
 floatX = tf.float32
@@ -29,6 +31,7 @@ class CNN(object):
 
     # helper variable to keep track of steps
     self.global_step = tf.Variable(0, name='global_step', trainable=False)
+    self.drop_step, self.micro_step = dropout_step(self.global_step)
 
     # Placeholders for input, output and dropout
     self.rnn_in_keep_prob  = tf.placeholder(floatX)
@@ -82,7 +85,8 @@ class CNN(object):
 
     # Add dropout
     with tf.name_scope("dropout"):
-      self.h_drop = tf.nn.dropout(self.h_pool_flat, self.keep_prob)
+      self.h_drop = stateless_dropout(self.h_pool_flat, self.keep_prob,
+                                      self.drop_step, site=0)
 
     # Final (unnormalized) scores and predictions
     with tf.name_scope("output"):
@@ -94,12 +98,16 @@ class CNN(object):
       l2_loss += tf.nn.l2_loss(W)
       l2_loss += tf.nn.l2_loss(b)
       self.scores = tf.nn.xw_plus_b(self.h_drop, W, b, name="scores")
+      self.logits = self.scores
       self.predictions = tf.argmax(self.scores, 1, name="predictions")
 
     # Calculate mean cross-entropy loss
     with tf.name_scope("loss"):
       losses = tf.nn.softmax_cross_entropy_with_logits(logits=self.scores, labels=self.labels)
+      losses = class_weighted(losses, self.labels)
       self.cost = tf.reduce_mean(losses) + l2_reg_lambda * l2_loss
+      if getattr(hp, 'distill_from', None):
+        self.cost = distill_cost(self, self.cost, self.scores)
 
     # Predictions
     self.y_prob, self.y_pred, self.y_true = self.predict(self.labels, self.scores)
@@ -121,7 +129,12 @@ class CNN(object):
     """
     with tf.variable_scope(scope):
       with tf.device("/cpu:0"):
-        inputs = tf.nn.embedding_lookup(embedding_tensor, word_ids)
+        if isinstance(embedding_tensor, QuantizedEmbedding):
+          inputs = embedding_tensor.lookup(word_ids)
+        else:
+          inputs = tf.nn.embedding_lookup(embedding_tensor, word_ids)
+        if self.emb_rows is not None:
+          inputs = lookup_rows(inputs, word_ids, self.emb_rows, self.emb_slot)
 
     # Maybe concat word embeddings with one-hot pos tags
     if hasattr(hp, 'postags') and hp.postags:
@@ -130,11 +143,23 @@ class CNN(object):
     return inputs
 
   def embedding_setup(self, embedding, emb_trainable):
-    """ If trainable, returns variable, otherwise the original embedding """
+    """
+    If trainable, returns variable, otherwise the original embedding. With
+    `hp.emb_train_ids` only those rows are a variable, see `trainable_rows`
+    """
+    self.emb_rows, self.emb_slot = None, None
+    if isinstance(embedding, QuantizedEmbedding):
+      if emb_trainable == True:
+        raise ValueError("--emb_quant needs a frozen embedding, no --emb_trainable")
+      return embedding
+    if emb_trainable == True and getattr(hp, 'emb_train_ids', None) is not None:
+      self.emb_rows, self.emb_slot = trainable_rows(embedding, hp.emb_train_ids)
+      return embedding
     if emb_trainable == True:
-      emb_variable = tf.get_variable(
-          name="embedding_matrix", shape=embedding.shape,
-          initializer = tf.constant_initializer(embedding))
+      with tf.device("/cpu:0"):
+        emb_variable = tf.get_variable(
+            name="embedding_matrix", shape=embedding.shape,
+            initializer = tf.constant_initializer(embedding))
       return emb_variable
     else:
       return embedding
@@ -153,104 +178,425 @@ class CNN(object):
 
   def optimize_step(self, loss, glbl_step):
     """ Locate optimizer from hp, take a step """
-    Opt = locate("tensorflow.train." + hp.optimizer)
-    if Opt is None:
-      raise ValueError("Invalid optimizer: " + hp.optimizer)
-    optimizer = Opt(hp.l_rate)
+    optimizer = locate_optimizer(hp.optimizer)(learning_rate(glbl_step))
     grads_vars = optimizer.compute_gradients(loss)
-    capped_grads = [(None if grad is None else tf.clip_by_value(grad, -1., 1.), var)\
+    capped_grads = [(None if grad is None else clip_grad(grad), var)\
                                                   for grad, var in grads_vars]
-    take_step = optimizer.apply_gradients(capped_grads, global_step=glbl_step)
+    if accum_steps() > 1:
+      return accumulate_gradients(optimizer, capped_grads, glbl_step,
+                                                          self.micro_step)
+    take_step = apply_gradients(optimizer, capped_grads, glbl_step)
+    return take_step
+
+# Names of the trainable embedding variables
+EMB_VARS = ["embedding_matrix", "embedding_rows"]
+# Top level variable scopes of the shared encoder, and of the attention
+# convolutions, for warm starts and encoder freezing
+ENCODER_SCOPES = ["unidirectionalRNN", "biRNN", "rnn_emb", "word_gate"]
+ATTN_SCOPES = ["col_conv", "row_conv"]
+# Input placeholders of RNN_base, shared by the replicas of one graph
+INPUTS = ["keep_prob", "rnn_in_keep_prob", "mode", "inputs", "postags",
+          "input_len", "labels"]
+
+def is_encoder_var(var):
+  name = var.op.name
+  return name.split('/')[0] in ENCODER_SCOPES or name.split('/')[-1] in EMB_VARS
+
+def locate_optimizer(name):
+  """ Optimizer class from tf.train, or tf.contrib.opt such as LazyAdamOptimizer """
+  Opt = locate("tensorflow.train." + name) or locate("tensorflow.contrib.opt." + name)
+  if Opt is None:
+    raise ValueError("Invalid optimizer: " + name)
+  return Opt
+
+def clip_grad(grad):
+  """ Clip to [-1, 1], keeping sparse embedding gradients sparse """
+  if isinstance(grad, tf.IndexedSlices):
+    return tf.IndexedSlices(tf.clip_by_value(grad.values, -1., 1.),
+                                            grad.indices, grad.dense_shape)
+  return tf.clip_by_value(grad, -1., 1.)
+
+def apply_gradients(optimizer, grads_vars, glbl_step):
+  """
+  Apply gradients with `optimizer`. If `hp.emb_optimizer` is set, the
+  embedding goes to that one instead, e.g. LazyAdamOptimizer or
+  GradientDescentOptimizer which only touch the rows in the batch
+  """
+  emb_opt = getattr(hp, 'emb_optimizer', None)
+  if not emb_opt:
+    return optimizer.apply_gradients(grads_vars, global_step=glbl_step)
+  is_emb = lambda var: var.op.name.split('/')[-1] in EMB_VARS
+  emb = [(grad, var) for grad, var in grads_vars if is_emb(var)]
+  rest = [(grad, var) for grad, var in grads_vars if not is_emb(var)]
+  take_step = optimizer.apply_gradients(rest, global_step=glbl_step)
+  if len(emb) == 0:
     return take_step
+  with tf.device("/cpu:0"):
+    emb_step = locate_optimizer(emb_opt)(learning_rate(glbl_step)).apply_gradients(emb)
+  return tf.group(take_step, emb_step)
+
+def accum_steps():
+  return max(getattr(hp, 'accum_steps', 1), 1)
+
+def learning_rate(glbl_step):
+  """
+  `hp.l_rate`, scaled by `hp.lr_scale` for the effective batch of accumulated
+  micro batches: linear or sqrt in accum_steps. Ramped up linearly over the
+  first `hp.warmup_steps` updates
+  """
+  scale = {'none': 1., 'linear': accum_steps(), 'sqrt': accum_steps()**0.5}
+  lr_scale = getattr(hp, 'lr_scale', 'none')
+  if lr_scale not in scale:
+    raise ValueError("Invalid lr_scale: " + lr_scale)
+  l_rate = hp.l_rate * scale[lr_scale]
+  warmup = getattr(hp, 'warmup_steps', 0)
+  if warmup <= 0:
+    return l_rate
+  ramp = tf.cast(glbl_step + 1, tf.float32) / warmup
+  return l_rate * tf.minimum(ramp, 1.)
+
+class AccumStep():
+  """
+  Gradients summed over `hp.accum_steps` micro batches, then applied once as
+  their mean. Run `accumulate` on each micro batch but the last and `apply`
+  on the last. `apply` adds its own batch, updates, increments the global
+  step and zeroes the sums, so global step counts updates
+  """
+  def __init__(self, accumulate, apply):
+    self.accumulate = accumulate
+    self.apply = apply
+
+def accumulate_gradients(optimizer, grads_vars, glbl_step, micro_step=None):
+  """
+  AccumStep over `grads_vars`, with a sum per variable. Sums are local
+  variables, left out of checkpoints, which are saved between updates when
+  they are zero. Sparse embedding gradients are added to their rows only.
+  `micro_step` counts the micro batches accumulated since the last update
+  """
+  grads_vars = [(grad, var) for grad, var in grads_vars if grad is not None]
+  adds, sums = [], []
+  with tf.name_scope("grad_accum"):
+    for grad, var in grads_vars:
+      with tf.device(var.device):
+        total = tf.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype),
+                            trainable=False, name=var.op.name.replace('/', '_'),
+                            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      if isinstance(grad, tf.IndexedSlices):
+        adds.append(tf.scatter_add(total, grad.indices, grad.values))
+      else:
+        adds.append(tf.assign_add(total, grad))
+      sums.append(total)
+    accumulate = tf.group(*adds)
+    if micro_step is not None:
+      with tf.control_dependencies([accumulate]):
+        accumulate = tf.assign_add(micro_step, 1).op
+    with tf.control_dependencies([accumulate]):
+      mean = [(total.read_value() / accum_steps(), var)
+                            for total, (_, var) in zip(sums, grads_vars)]
+    take_step = apply_gradients(optimizer, mean, glbl_step)
+    with tf.control_dependencies([take_step]):
+      zero = [tf.assign(total, tf.zeros_like(total)) for total in sums]
+      if micro_step is not None:
+        zero.append(tf.assign(micro_step, 0))
+      apply = tf.group(*zero)
+  return AccumStep(accumulate, apply)
+
+def trainable_rows(embedding, ids):
+  """
+  Split embedding: rows `ids` become a variable, the rest stays constant.
+  Optimizer slots then only cover those rows
+  Returns:
+    variable of the trainable rows, and a [vocab_size] map from word id to
+    its row in that variable, -1 if frozen
+  """
+  slot = np.full(len(embedding), -1, dtype=np.int32)
+  slot[ids] = np.arange(len(ids), dtype=np.int32)
+  with tf.device("/cpu:0"):
+    rows = tf.get_variable(name="embedding_rows", shape=[len(ids), embedding.shape[1]],
+              initializer=tf.constant_initializer(embedding[ids]))
+  return rows, tf.constant(slot)
+
+def lookup_rows(inputs, word_ids, rows, slot):
+  """ Swap in the trainable rows for the words which have one """
+  word_slot = tf.nn.embedding_lookup(slot, word_ids)
+  trained = tf.nn.embedding_lookup(rows, tf.maximum(word_slot, 0))
+  mask = tf.expand_dims(tf.cast(word_slot >= 0, inputs.dtype), -1)
+  return inputs + mask * (trained - inputs)
+
+def dropout_step(glbl_step):
+  """
+  Step seeding the dropout masks: the global step, times accum_steps plus
+  the count of micro batches accumulated so far. The count is a local
+  variable zeroed by each update, so it is 0 in every checkpoint
+  Returns:
+    the step, and the count variable, None without accumulation
+  """
+  step = tf.cast(glbl_step, tf.int64) * accum_steps()
+  if accum_steps() == 1:
+    return step, None
+  micro_step = tf.Variable(0, trainable=False, name='micro_step',
+                              collections=[tf.GraphKeys.LOCAL_VARIABLES])
+  return step + tf.cast(micro_step, tf.int64), micro_step
+
+def stateless_dropout(x, keep_prob, step, site, noise_shape=None):
+  """
+  tf.nn.dropout with its mask from a stateless random op seeded by
+  `hp.seed`, the op's `site` id and the training `step`. The masks are a
+  function of those only, so a run resumed from a checkpoint draws the same
+  masks as an uninterrupted one, which TF's stateful RNG can't
+  """
+  seed = tf.stack([tf.constant(getattr(hp, 'seed', 1) << 32 | site, tf.int64),
+                   tf.cast(step, tf.int64)])
+  shape = tf.shape(x) if noise_shape is None else noise_shape
+  noise = tf.contrib.stateless.stateless_random_uniform(shape, seed, dtype=x.dtype)
+  # 1 with probability keep_prob, as in tf.nn.dropout
+  keep = tf.floor(keep_prob + noise)
+  return x / keep_prob * keep
+
+# Classifier heads, filled by `register_head`. Maps a head name to a tuple
+# (builder, attn) where builder returns the logits and attn is the attention
+# the head reads: None, 'aoa' for the attn over attn vector only or 'full'
+# for the pair-wise attention matrices
+HEADS = {}
+
+def register_head(name, attn=None):
+  """ Decorator adding a logits builder to the head registry """
+  def add(builder):
+    HEADS[name] = (builder, attn)
+    return builder
+  return add
+
+def get_head(name):
+  """ Returns (builder, attn) for the head `name` """
+  if name not in HEADS:
+    raise ValueError("Invalid head: " + name)
+  return HEADS[name]
 
 class RNN_base():
   """
-  Base RNN model
+  Base RNN model. The classifier head on top of the encoder is picked from
+  `HEADS` by the `head` class attribute, or by `hp.head` if set
   """
-  def __init__(self,params, embedding, postag_size):
+  head = 'mean_pool'
+
+  def __init__(self,params, embedding, postag_size, inputs=None):
     """
     Args:
       params: hyper param instance
+      inputs: model whose input placeholders this one reads, see `Replicas`
     """
     global hp
     hp = params
+    # Variable scope the model is built in, r<i> for a replica
+    self.scope = tf.get_variable_scope().name
 
     # helper variable to keep track of steps
     self.global_step = tf.Variable(0, name='global_step', trainable=False)
-
-    ############################
-    # Inputs
-    ############################
+    self.drop_step, self.micro_step = dropout_step(self.global_step)
+    self.drop_ops = 0
+
+    # Inputs and RNN encoder, shared by all heads
+    self.build_inputs(inputs)
+    self.build_encoder(embedding, postag_size)
+
+    # Head, loss and optimizer
+    self.build_classifier()
+
+  def dropout(self, x, keep_prob, noise_shape=None):
+    """ `stateless_dropout` at this model's step, every call its own mask """
+    self.drop_ops += 1
+    site = zlib.crc32("{}:{}".format(self.scope, self.drop_ops).encode())
+    return stateless_dropout(x, keep_prob, self.drop_step, site, noise_shape)
+
+  def build_inputs(self, source=None):
+    """ Input placeholders, or those of the model `source` """
+    if source is not None:
+      for name in INPUTS:
+        setattr(self, name, getattr(source, name))
+      return
     self.keep_prob = tf.placeholder(floatX)
     self.rnn_in_keep_prob  = tf.placeholder(floatX)
     self.mode = tf.placeholder(tf.bool, name="mode") # 1 stands for training
-    self.vocab_size, _ = embedding.shape
-    # Embedding tensor is of shape [vocab_size x embedding_size]
-    self.embedding_tensor = self.embedding_setup(embedding, hp.emb_trainable)
 
     # RNN inputs
     self.inputs = tf.placeholder(intX, shape=[None, hp.max_seq_len])
     self.postags = tf.placeholder(intX, shape=[None, hp.max_seq_len])
-    self.embedded = self.embedded(self.inputs, self.postags, postag_size, self.embedding_tensor)
-    self.emb_size = self.embedded.shape[2].value
-    # self.embedded = tf.layers.batch_normalization(embedded, training=self.mode)
     self.input_len = tf.placeholder(intX, shape=[None,])
 
     # Targets
     self.labels = tf.placeholder(intX, shape=[None, hp.num_classes])
 
+  def build_encoder(self, embedding, postag_size):
+    """ Embedding and RNN encoder """
+    ############################
+    # Inputs
+    ############################
+    self.vocab_size, _ = embedding.shape
+    # Embedding tensor is of shape [vocab_size x embedding_size]
+    self.embedding_tensor = self.embedding_setup(embedding, hp.emb_trainable)
+    self.embedded = self.embedded(self.inputs, self.postags, postag_size, self.embedding_tensor)
+    self.emb_size = self.embedded.shape[2].value
+    # self.embedded = tf.layers.batch_normalization(embedded, training=self.mode)
+
     self.batch_size = tf.shape(self.inputs)[0]
 
     ############################
     # Encode input with RNN
     ############################
 
+    # Dropout of the RNN inputs
+    rnn_inputs = self.drop_inputs(self.embedded)
+
     # Forward/backward cells
+    self.init_state = None
     if hp.birnn==True:
       self.encoder_h_size = hp.cell_units * 2
       cell_fw, cell_bw = self.build_cell(birnn=True)
       # Get encoded inputs
       self.encoded_outputs, self.encoded_state = self.bi_rnn_encode(
-                               self.embedded, self.input_len,cell_fw, cell_bw)
+                               rnn_inputs, self.input_len,cell_fw, cell_bw)
     else:
       self.encoder_h_size = hp.cell_units
       cell = self.build_cell(birnn=False)
+      # Zero initial state unless fed, to carry the state over from the
+      # previous window of a document, see doc_score.py
+      if hp.cell_type == "LSTMCell":
+        zeros = tf.zeros([self.batch_size, hp.cell_units], floatX)
+        self.init_state = tf.contrib.rnn.LSTMStateTuple(
+          tf.placeholder_with_default(zeros, [None, hp.cell_units], name="init_c"),
+          tf.placeholder_with_default(zeros, [None, hp.cell_units], name="init_h"))
       # Get encoded inputs
       self.encoded_outputs, self.encoded_state = self.rnn_encode(
-                                         self.embedded, self.input_len,cell)
+                       rnn_inputs, self.input_len, cell, self.init_state)
 
     if hp.parallel==True:
       cell_emb = self.build_cell(birnn=False)
       # Get encoded inputs
       self.encoded_outputs_emb, self.encoded_state_emb = self.rnn_encode(
-                         self.embedded, self.input_len,cell, scope="rnn_emb")
+                         rnn_inputs, self.input_len,cell, scope="rnn_emb")
 
     # Word gate
     if hp.word_gate == True:
       self.encoded_outputs = self.word_gate(\
                           self.embedded, self.input_len, self.encoded_outputs)
 
-    # Pair-wise score
-    self.p_w = self.pair_wise_matching(self.encoded_outputs)
+  def build_classifier(self):
+    """ Selected head, its loss, predictions and optimizer """
+    # Head, from the command line or the model default
+    self.head_name = getattr(hp, 'head', None) or self.head
+    build_head, attn = get_head(self.head_name)
+    if getattr(hp, 'prune_tokens', False):
+      if self.head_name != 'attn_sum' or not hp.word_gate:
+        raise ValueError("Token pruning needs the attn_sum head and --word_gate")
+
+    # Pair-wise score and attn matrices, only built if the head reads them
+    self.build_attn(full=attn=='full', aoa=attn=='aoa')
+
+    # Logits from the selected head only
+    self.logits = build_head(self)
 
-    # Attn matrices
-    self.col_attn, self.row_attn = self.attn_matrices(self.p_w, self.input_len,
-                                                          self.batch_size)
-    # Default logits
-    self.logits = self.get_logits(self.col_attn,self.row_attn)
-    # self.logits = None
     ############################
     # Loss/Optimize
     ############################
     # Build loss
     self.loss = self.classification_loss(self.labels, self.logits)
+    self.loss = class_weighted(self.loss, self.labels)
     self.cost = tf.reduce_mean(self.loss) # average across batch
+    if getattr(hp, 'distill_from', None):
+      self.cost = distill_cost(self, self.cost, self.logits)
 
     # Predictions
     self.y_prob, self.y_pred, self.y_true = self.predict(self.labels, self.logits)
 
-    # Optimize
-    self.optimize = self.optimize_step(self.cost,self.global_step)
+    # Optimize, and while the encoder is frozen the rest only, same optimizer
+    optimizer = self.get_optimizer()
+    self.optimize = self.optimize_step(self.cost,self.global_step, optimizer)
+    if getattr(hp, 'freeze_encoder_steps', 0) > 0:
+      head_vars = [v for v in tf.trainable_variables() if not is_encoder_var(v)]
+      self.optimize_head = self.optimize_step(self.cost, self.global_step,
+                                                      optimizer, head_vars)
+
+  def build_attn(self, full=False, aoa=False):
+    """
+    Attention read by the heads. `full` builds the pair-wise matching and both
+    attn matrices, `aoa` the attn over attn vector. Unless the matrices are
+    needed anyway, or kept for visualisation with `hp.full_attn`, the vector
+    comes from the fused op which never builds them. With `hp.attn_chunk`
+    nothing of shape [time, time] is built, heads work on tiles instead
+    """
+    self.p_w, self.col_attn, self.row_attn = None, None, None
+    self.attn_over_attn = None
+    self.attn_lse = None
+    self.pruned_h = None
+    if getattr(hp, 'prune_tokens', False):
+      self.build_pruned_attn()
+      return
+    chunked = getattr(hp, 'attn_chunk', 0) > 0
+    if chunked and not getattr(hp, 'full_attn', False):
+      if full or aoa:
+        self.attn_lse = self.chunked_row_lse(self.encoded_outputs)
+      if aoa:
+        self.attn_over_attn = self.chunked_attn_attn(self.encoded_outputs,
+                                                                self.attn_lse)
+      return
+    if full or (aoa and getattr(hp, 'full_attn', False)):
+      self.p_w = self.pair_wise_matching(self.encoded_outputs)
+      self.col_attn, self.row_attn = self.attn_matrices(self.p_w,
+                                            self.input_len, self.batch_size)
+    if aoa and self.col_attn is not None:
+      self.attn_over_attn = self.attn_attn(self.col_attn, self.row_attn)
+    elif aoa:
+      self.attn_over_attn = self.fused_attn_attn(self.encoded_outputs)
+
+  def build_pruned_attn(self):
+    """
+    Attn over attn on the tokens whose mean word gate is at least
+    `prune_threshold`, compacted to [batch, kept, h_size]. Pruned tokens
+    count as zero encoder outputs, so a threshold of 0 gives the same
+    output as the full attention
+    """
+    self.prune_threshold = tf.placeholder_with_default(
+                    tf.constant(hp.prune_threshold, floatX), shape=[])
+    time = tf.range(hp.max_seq_len)
+    valid = tf.less(time[None,:], self.input_len[:,None])
+    keep = tf.logical_and(valid,
+                  tf.greater_equal(self.word_gate_score, self.prune_threshold))
+    self.kept_tokens = tf.reduce_sum(tf.cast(keep, intX), 1)
+    k = tf.maximum(tf.reduce_max(self.kept_tokens), 1)
+
+    # Kept tokens first in time order, remaining slots are zeroed
+    key = tf.cast(keep, floatX) * tf.cast(hp.max_seq_len - time, floatX)
+    vals, idx = tf.nn.top_k(key, k)
+    batch_idx = tf.tile(tf.range(self.batch_size)[:,None], [1, k])
+    gather_idx = tf.stack([batch_idx, idx], axis=2)
+    slot = tf.cast(vals > 0, floatX)[:,:,None]
+    self.pruned_h = tf.gather_nd(self.encoded_outputs, gather_idx) * slot
+    if hasattr(hp, 'parallel') and hp.parallel==True:
+      self.pruned_h_emb = tf.gather_nd(self.encoded_outputs_emb, gather_idx) * slot
+    self.attn_over_attn = self.pruned_attn_attn(self.pruned_h, k)
+
+  def pruned_attn_attn(self, rnn_h, k):
+    """
+    `fused_attn_attn` of the full max_seq_len sequence from its first `k`
+    positions, the z = max_seq_len - k others having zero outputs. Those have
+    a score of 0 with every token, so they only add z*exp(0) to the row
+    softmax sums, and their rows are uniform 1/max_seq_len
+    Returns:
+      attn over attn of the k positions, [batch, k]
+    """
+    seq_len = float(hp.max_seq_len)
+    z = seq_len - tf.cast(k, floatX)
+    p_w = tf.matmul(rnn_h, rnn_h, transpose_b=True)
+    # Row log sum exp over all max_seq_len columns
+    outside = tf.zeros_like(p_w[:,:,:1]) + tf.log(z)
+    lse = tf.reduce_logsumexp(tf.concat([p_w, outside], axis=2), axis=2,
+                                                              keepdims=True)
+    row_attn = tf.exp(p_w - lse)
+    # Column averages, of a kept column then of any left out column
+    col_av = (tf.reduce_sum(row_attn, axis=1) + z/seq_len) / seq_len
+    col_av_out = (tf.reduce_sum(tf.exp(-lse), axis=1) + z/seq_len) / seq_len
+    attnattn = tf.einsum('akj,ak->aj', row_attn, col_av)
+    return attnattn + z/seq_len * col_av_out
 
   def word_gate(self, embedded, input_len, encoded_outputs):
     """
@@ -265,7 +611,9 @@ class RNN_base():
     # Word gate
     gate = dense(embedded, self.emb_size, self.encoder_h_size, 'word_gate',
 	act=tf.nn.sigmoid)
-    gate = tf.nn.dropout(gate, self.keep_prob)
+    # Mean gate of each token, thresholded for token pruning
+    self.word_gate_score = tf.reshape(tf.reduce_mean(gate, 1), enc_shape[:2])
+    gate = self.dropout(gate, self.keep_prob)
     gated = tf.multiply(gate, encoded_outputs)
 
     # Reshape back to the original tensor shape
@@ -285,7 +633,12 @@ class RNN_base():
     """
     with tf.variable_scope(scope):
       with tf.device("/cpu:0"):
-        inputs = tf.nn.embedding_lookup(embedding_tensor, word_ids)
+        if isinstance(embedding_tensor, QuantizedEmbedding):
+          inputs = embedding_tensor.lookup(word_ids)
+        else:
+          inputs = tf.nn.embedding_lookup(embedding_tensor, word_ids)
+        if self.emb_rows is not None:
+          inputs = lookup_rows(inputs, word_ids, self.emb_rows, self.emb_slot)
 
     # Maybe concat word embeddings with one-hot pos tags
     if hasattr(hp, 'postags') and hp.postags:
@@ -294,11 +647,23 @@ class RNN_base():
     return inputs
 
   def embedding_setup(self, embedding, emb_trainable):
-    """ If trainable, returns variable, otherwise the original embedding """
+    """
+    If trainable, returns variable, otherwise the original embedding. With
+    `hp.emb_train_ids` only those rows are a variable, see `trainable_rows`
+    """
+    self.emb_rows, self.emb_slot = None, None
+    if isinstance(embedding, QuantizedEmbedding):
+      if emb_trainable == True:
+        raise ValueError("--emb_quant needs a frozen embedding, no --emb_trainable")
+      return embedding
+    if emb_trainable == True and getattr(hp, 'emb_train_ids', None) is not None:
+      self.emb_rows, self.emb_slot = trainable_rows(embedding, hp.emb_train_ids)
+      return embedding
     if emb_trainable == True:
-      emb_variable = tf.get_variable(
-          name="embedding_matrix", shape=embedding.shape,
-          initializer = tf.constant_initializer(embedding))
+      with tf.device("/cpu:0"):
+        emb_variable = tf.get_variable(
+            name="embedding_matrix", shape=embedding.shape,
+            initializer = tf.constant_initializer(embedding))
       return emb_variable
     else:
       return embedding
@@ -309,13 +674,15 @@ class RNN_base():
       Cell = locate("tensorflow.contrib.rnn." + cell_type)
       if Cell is None:
         raise ValueError("Invalid cell type " + cell_type)
-      cell_fw = self.drop_wrap(Cell(hp.cell_units))
+      if cell_type == "LSTMCell" and getattr(hp, 'low_rank', None):
+        Cell = LowRankLSTMCell
+      cell_fw = Cell(hp.cell_units)
 
       # If unidirectional, return only forward
       if birnn==False:
         return cell_fw
 
-      cell_bw = self.drop_wrap(Cell(hp.cell_units))
+      cell_bw = Cell(hp.cell_units)
       return cell_fw, cell_bw
 
   def pair_wise_matching(self, rnn_h):
@@ -342,15 +709,16 @@ class RNN_base():
 
     return rows, cols
 
-  def drop_wrap(self, cell):
-    """ adds dropout to a recurrent cell """
-    cell = tf.contrib.rnn.DropoutWrapper(\
-          cell                  = cell,
-          input_keep_prob       = self.rnn_in_keep_prob,
-          variational_recurrent = hp.variational_recurrent,
-          dtype                 = floatX,
-          input_size            = self.emb_size)
-    return cell
+  def drop_inputs(self, x):
+    """
+    Dropout of the RNN inputs, as the input_keep_prob of a DropoutWrapper. A
+    variational mask is the same at every time step of a sequence. Forward
+    and backward RNNs read the same dropped inputs
+    """
+    noise_shape = None
+    if hp.variational_recurrent:
+      noise_shape = tf.stack([tf.shape(x)[0], 1, tf.shape(x)[2]])
+    return self.dropout(x, self.rnn_in_keep_prob, noise_shape)
 
   def rnn_encode(self, x, seq_len, cell_fw, init_state=None, scope="unidirectionalRNN"):
     """
@@ -429,16 +797,28 @@ class RNN_base():
         state.set_shape([None, self.encoder_h_size])
     return outputs, state
 
-  def optimize_step(self, loss, glbl_step):
-    """ Locate optimizer from hp, take a step """
-    Opt = locate("tensorflow.train." + hp.optimizer)
-    if Opt is None:
-      raise ValueError("Invalid optimizer: " + hp.optimizer)
-    optimizer = Opt(hp.l_rate)
-    grads_vars = optimizer.compute_gradients(loss)
-    capped_grads = [(None if grad is None else tf.clip_by_value(grad, -1., 1.), var)\
+  def get_optimizer(self):
+    """ Locate optimizer from hp """
+    return locate_optimizer(hp.optimizer)(learning_rate(self.global_step))
+
+  def optimize_step(self, loss, glbl_step, optimizer=None, var_list=None):
+    """
+    Take a step with `optimizer`, or a new one located from hp, on
+    `var_list` or all trainable variables
+    """
+    if optimizer is None:
+      optimizer = self.get_optimizer()
+    # A replica trains the variables of its scope only
+    if var_list is None and self.scope:
+      var_list = [v for v in tf.trainable_variables()
+                                if v.op.name.startswith(self.scope + '/')]
+    grads_vars = optimizer.compute_gradients(loss, var_list=var_list)
+    capped_grads = [(None if grad is None else clip_grad(grad), var)\
                                                   for grad, var in grads_vars]
-    take_step = optimizer.apply_gradients(capped_grads, global_step=glbl_step)
+    if accum_steps() > 1:
+      return accumulate_gradients(optimizer, capped_grads, glbl_step,
+                                                          self.micro_step)
+    take_step = apply_gradients(optimizer, capped_grads, glbl_step)
     return take_step
 
   def classification_loss(self, classes_true, classes_logits):
@@ -463,161 +843,101 @@ class RNN_base():
 
     return y_prob, y_pred, y_true
 
-  def get_logits(self, col_attn, row_attn):
+
+  ############################
+  # Heads
+  ############################
+
+  @register_head('mean_pool')
+  def mean_pool_logits(self):
     """ Default final layer, mean-pool RNN states, no attention """
     out = tf.reduce_mean(self.encoded_outputs, axis=1)
 
     in_dim = self.encoder_h_size
     # out = dense(mean, in_dim, hp.fc_units, act=tf.nn.relu, scope="h")
-    out = tf.nn.dropout(out, self.keep_prob)
+    out = self.dropout(out, self.keep_prob)
 
     # Output layer
-    logits = dense(out, in_dim, hp.num_classes, act=None, scope="class_log")
+    logits = self.output_layer(out, in_dim, scope="class_log")
     return logits
 
-class PairWiseAttn(RNN_base):
-  """ Pair-wise Attn """
-  def __init__(self,params, embedding, postag_size):
-    super().__init__(params, embedding, postag_size)
-
-    # Override logits method
-    self.logits = self.get_logits(self.col_attn,self.row_attn)
-
-  def flat_concat(self, col_attn, row_attn):
-    """ Reshape and concat the normalized attention """
-    flat_col_dim = tf.shape(col_attn)[1]*tf.shape(col_attn)[2]
-    flat_col = tf.reshape(col_attn, [-1, flat_col_dim])
-    flat_row_dim = tf.shape(row_attn)[1]*tf.shape(row_attn)[2]
-    flat_row = tf.reshape(row_attn, [-1, flat_row_dim])
-    concat = tf.concat([flat_col, flat_row], 1)
-    return concat
-
-  def get_logits(self, col_attn, row_attn):
+  @register_head('pair_wise', attn='full')
+  def pair_wise_logits(self):
     """
     Simply concat the attn matrices and connect to output
     """
-    self.concat = self.flat_concat(col_attn, row_attn)
+    if self.col_attn is None:
+      raise ValueError("pair_wise head needs the full attn matrices, "
+                       "it can't be used with --attn_chunk")
+    self.concat = self.flat_concat(self.col_attn, self.row_attn)
     in_dim = hp.max_seq_len**2*2
-    logits = dense(self.concat, in_dim, hp.num_classes, act=None, scope="class_log")
+    logits = self.output_layer(self.concat, in_dim, scope="class_log")
     return logits
 
-class AttnAttn(RNN_base):
-  """
-  Attn over attn, based mostly on https://arxiv.org/pdf/1607.04423.pdf,
-  except for final layer which is fully connected to number of classes
-  """
-  def __init__(self, params, embedding, postag_size, fc_layer=True):
-    super().__init__(params, embedding, postag_size)
-
-    # Override logits method
-    self.logits = self.get_logits(self.col_attn,self.row_attn)
-
-  def get_logits(self, col_attn, row_attn):
-    # Get attn over attn
-    self.attn_over_attn = self.attn_attn(col_attn, row_attn)
-
+  @register_head('attn_attn', attn='aoa')
+  def attn_attn_logits(self):
     # FC layer before output
     in_dim = hp.max_seq_len
     attnattn = dense(self.attn_over_attn, in_dim, hp.fc_units, act=tf.nn.relu, scope="h")
-    attnattn = tf.nn.dropout(attnattn, self.keep_prob)
+    attnattn = self.dropout(attnattn, self.keep_prob)
 
     in_dim=hp.fc_units
     # Optional fc layer
     for i in range(hp.h_layers):
       name = "dense{}".format(i)
       attnattn = dense(attnattn, in_dim, hp.fc_units,act=tf.nn.relu,scope=name)
-      attnattn = tf.nn.dropout(attnattn, self.keep_prob)
+      attnattn = self.dropout(attnattn, self.keep_prob)
       in_dim=hp.fc_units
 
     # Output layer
-    logits = dense(attnattn, in_dim, hp.num_classes, act=None, scope="class_log")
+    logits = self.output_layer(attnattn, in_dim, scope="class_log")
     return logits
 
-  def attn_attn(self, col_attn, row_attn):
-    """
-    Average the softmax matrices
-    """
-    # For the row-wise softmax tensor, we want column-wise average -> dim 1
-    # This results in a vector shape [sequence len]
-    col_av = tf.reduce_mean(row_attn, axis=1)
-
-    # Attn-over-attn -> a dot product between column average vector and
-    # column-wise softmax matrix. Result is a single vector [sequence len]
-    # per sample
-    attnattn = tf.einsum('ajk,ak->aj',col_attn,col_av)
-    return attnattn
-
-class AttnAttnSum(RNN_base):
-  """
-  Self-attention-over-attention for weighted sum of encoded input
-  """
-  def __init__(self, params, embedding, postag_size, fc_layer=True):
-    super().__init__(params, embedding, postag_size)
-
-    # Override logits method
-    self.logits = self.get_sum_logits(self.col_attn,self.row_attn)
-
-  # Override logits function
-  def get_sum_logits(self, col_attn, row_attn):
-    # Get attn over attn vector
-    self.attn_over_attn = self.attn_attn(col_attn, row_attn)
-
+  @register_head('attn_sum', attn='aoa')
+  def attn_sum_logits(self):
+    """ Attn over attn vector as weights for a sum of the encoded input """
     # Multiply the attention vector by encoded outputs (broadcast) and sum across time
     if hasattr(hp, 'parallel') and hp.parallel==False:
-      self.weighted_encoded = tf.einsum('ajk,aj->ak',self.encoded_outputs,self.attn_over_attn)
+      encoded = self.encoded_outputs if self.pruned_h is None else self.pruned_h
     else:
-      self.weighted_encoded = tf.einsum('ajk,aj->ak',self.encoded_outputs_emb,self.attn_over_attn)
+      encoded = self.encoded_outputs_emb if self.pruned_h is None else self.pruned_h_emb
+    self.weighted_encoded = tf.einsum('ajk,aj->ak',encoded,self.attn_over_attn)
 
     # FC layer before output
     in_dim = self.encoder_h_size
     attnattn = dense(self.weighted_encoded, in_dim, hp.fc_units, act=tf.nn.relu, scope="h_sum")
-    attnattn = tf.nn.dropout(attnattn, self.keep_prob)
+    attnattn = self.dropout(attnattn, self.keep_prob)
 
     in_dim=hp.fc_units
     # Optional fc layer
     for i in range(hp.h_layers):
       name = "dense_sum{}".format(i)
       attnattn = dense(attnattn, in_dim, hp.fc_units,act=tf.nn.relu,scope=name)
-      attnattn = tf.nn.dropout(attnattn, self.keep_prob)
+      attnattn = self.dropout(attnattn, self.keep_prob)
       in_dim=hp.fc_units
 
     # Output layer
-    logits = dense(attnattn, in_dim, hp.num_classes, act=None, scope="class_log_sum")
+    logits = self.output_layer(attnattn, in_dim, scope="class_log_sum")
     return logits
 
-  def attn_attn(self, col_attn, row_attn):
-    """
-    Average the softmax matrices
-    """
-    # For the row-wise softmax tensor, we want column-wise average -> dim 1
-    # This results in a vector shape [sequence len]
-    col_av = tf.reduce_mean(row_attn, axis=1)
-
-    # Attn-over-attn -> a dot product between column average vector and
-    # column-wise softmax matrix. Result is a single vector [sequence len]
-    # per sample
-    attnattn = tf.einsum('ajk,ak->aj',col_attn,col_av)
-    return attnattn
-
-class ConvAttn(PairWiseAttn):
-  """
-  Given pair-wise matching score tensors, we convolve over them. Intuition
-  is to detect clusters of local attention
-  """
-  def __init__(self, params, embedding, postag_size, fc_layer=True):
-    super().__init__(params, embedding, postag_size)
-
-  # Override logits function
-  def get_logits(self, col_attn, row_attn):
+  @register_head('conv', attn='full')
+  def conv_logits(self):
+    """ 2D convolution over the attn matrices, max-pooled """
     # Convolve + non-linearity
-    self.col_conv = self.convolution(col_attn, scope='col_conv')
-    self.row_conv = self.convolution(row_attn, scope='row_conv')
+    # Kernel of shape [filter_height, filter_width, in_channels, out_channels]
+    k_shape = [hp.filt_height, hp.filt_width, 1, hp.out_channels]
+    if self.col_attn is None:
+      # Chunked attention, convolve and pool tile by tile
+      self.col_pool, self.row_pool = self.chunked_conv_pool(k_shape)
+    else:
+      self.col_conv = self.convolution(self.col_attn, k_shape, scope='col_conv')
+      self.row_conv = self.convolution(self.row_attn, k_shape, scope='row_conv')
 
-    # Pool
-    self.col_pool = self.max_pool(self.col_conv, scope='col_pool')
-    self.col_pool = tf.nn.dropout(self.col_pool, self.keep_prob)
-    self.row_pool = self.max_pool(self.row_conv, scope='row_pool')
-    self.row_pool = tf.nn.dropout(self.row_pool, self.keep_prob)
+      # Pool
+      self.col_pool = self.max_pool(self.col_conv, scope='col_pool')
+      self.row_pool = self.max_pool(self.row_conv, scope='row_pool')
+    self.col_pool = self.dropout(self.col_pool, self.keep_prob)
+    self.row_pool = self.dropout(self.row_pool, self.keep_prob)
 
     # Flatten and concat the two
     self.final = tf.concat([self.col_pool, self.row_pool], 1)
@@ -627,83 +947,100 @@ class ConvAttn(PairWiseAttn):
     for i in range(hp.h_layers):
       name = "dense{}".format(i)
       self.final = dense(self.final, in_dim, hp.fc_units,act=tf.nn.relu,scope=name)
-      self.final = tf.nn.dropout(self.final, self.keep_prob)
+      self.final = self.dropout(self.final, self.keep_prob)
       in_dim=hp.fc_units
 
     # Output layer
-    logits = dense(self.final, in_dim, hp.num_classes, act=None, scope="class_log")
+    logits = self.output_layer(self.final, in_dim, scope="class_log")
     return logits
 
-  def convolution(self, x, scope):
-    """
-    Args:
-      x: a [batch_size, seq_len, seq_len] pair-wise score tensor
-      scope: need a scope name, otherwise variable naming error
-    Returns:
-      activated tensor. If x is shape [32,60,60], kernel has h/w 2, stride 2
-      and output 32, then returns tensor shape [32,29,29,32]
-    """
-    # Expand last dim for convolution operation
-    x = tf.expand_dims(x,-1)
-    with tf.variable_scope(scope):
-      # Kernel of shape [filter_height, filter_width, in_channels, out_channels]
-      k_shape = [hp.filt_height, hp.filt_width, 1, hp.out_channels]
-      kernel = tf.get_variable("c_w", shape=k_shape, dtype=floatX)
-      bias = tf.get_variable("c_b", hp.out_channels, dtype=floatX)
-      conv = tf.nn.conv2d( x, kernel, hp.conv_strides, hp.padding, name="conv")
-
-      # Batch-norm
-      if hp.batch_norm == True:
-        conv = tf.layers.batch_normalization(conv, training=self.mode)
-
-      # Activation
-      h = tf.nn.relu(tf.nn.bias_add(conv, bias))
-    return h
-
-class ConvAttn2(PairWiseAttn):
-  """
-  1D convolve rows and cols
-  Given pair-wise matching score tensors, we convolve over them. Intuition
-  is to detect clusters of local attention
-  """
-  def __init__(self, params, embedding, postag_size, fc_layer=True):
-    super().__init__(params, embedding, postag_size)
-
-  # Override logits function
-  def get_logits(self, col_attn, row_attn):
+  @register_head('conv1d', attn='full')
+  def conv1d_logits(self):
+    """ 1D convolve rows and cols of the attn matrices """
     # Convolve col attn matrix as 1D over columns
     # Kernel of shape [filter_height, filter_width, in_channels, out_channels]
-    # Col
-    k_shape = [hp.max_seq_len, 1, 1, 1]
-    self.col_conv = self.convolution(col_attn, k_shape, scope='col_conv')
-    self.col_conv = tf.nn.dropout(self.col_conv, self.keep_prob)
-    self.col_conv = tf.squeeze(self.col_conv, [1,3])
-    # Row
-    k_shape = [1, hp.max_seq_len, 1, 1]
-    self.row_conv = self.convolution(row_attn, k_shape, scope='row_conv')
-    self.row_conv = tf.nn.dropout(self.row_conv, self.keep_prob)
-    self.row_conv = tf.squeeze(self.row_conv, [2,3])
+    col_shape = [hp.max_seq_len, 1, 1, 1]
+    row_shape = [1, hp.max_seq_len, 1, 1]
+    if self.col_attn is None:
+      # Chunked attention, accumulate the convolutions over tiles
+      self.col_conv, self.row_conv = self.chunked_conv1d(col_shape, row_shape)
+    else:
+      # Col
+      self.col_conv = self.convolution(self.col_attn, col_shape, scope='col_conv')
+      self.col_conv = tf.squeeze(self.col_conv, [1,3])
+      # Row
+      self.row_conv = self.convolution(self.row_attn, row_shape, scope='row_conv')
+      self.row_conv = tf.squeeze(self.row_conv, [2,3])
+    self.col_conv = self.dropout(self.col_conv, self.keep_prob)
+    self.row_conv = self.dropout(self.row_conv, self.keep_prob)
 
     # Flatten and concat the two
     self.final = tf.concat([self.col_conv, self.row_conv], 1)
 
     # Optional Hidden layers
-    in_dim = hp.max_seq_len*2
     in_dim = self.final.get_shape()[1]
     for i in range(hp.h_layers):
       name = "dense{}".format(i)
       self.final = dense(self.final, in_dim, hp.fc_units,act=tf.nn.relu,scope=name)
-      self.final = tf.nn.dropout(self.final, self.keep_prob)
+      self.final = self.dropout(self.final, self.keep_prob)
       in_dim=hp.fc_units
 
     # Output layer
-    logits = dense(self.final, in_dim, hp.num_classes, act=None, scope="class_log")
+    logits = self.output_layer(self.final, in_dim, scope="class_log")
     return logits
 
+  ############################
+  # Head helpers
+  ############################
+
+  def output_layer(self, x, in_dim, scope):
+    """ Final layer of every head, unnormalized class scores """
+    return dense(x, in_dim, hp.num_classes, act=None, scope=scope)
+
+  def flat_concat(self, col_attn, row_attn):
+    """ Reshape and concat the normalized attention """
+    flat_col_dim = tf.shape(col_attn)[1]*tf.shape(col_attn)[2]
+    flat_col = tf.reshape(col_attn, [-1, flat_col_dim])
+    flat_row_dim = tf.shape(row_attn)[1]*tf.shape(row_attn)[2]
+    flat_row = tf.reshape(row_attn, [-1, flat_row_dim])
+    concat = tf.concat([flat_col, flat_row], 1)
+    return concat
+
+  def attn_attn(self, col_attn, row_attn):
+    """
+    Average the softmax matrices
+    """
+    # For the row-wise softmax tensor, we want column-wise average -> dim 1
+    # This results in a vector shape [sequence len]
+    col_av = tf.reduce_mean(row_attn, axis=1)
+
+    # Attn-over-attn -> a dot product between column average vector and
+    # column-wise softmax matrix. Result is a single vector [sequence len]
+    # per sample
+    attnattn = tf.einsum('ajk,ak->aj',col_attn,col_av)
+    return attnattn
+
+  def fused_attn_attn(self, rnn_h):
+    """
+    Attn over attn from the encoder outputs with a single [batch, time, time]
+    softmax. p_w = H.H^T is symmetric, so the column-wise softmax is the
+    transpose of the row-wise one:
+      row_attn[k,j] = softmax_j(p_w[k,:])
+      col_av[j] = mean_k row_attn[k,j]
+      attn_over_attn[j] = sum_k col_attn[j,k]*col_av[k]
+                        = sum_k row_attn[k,j]*col_av[k]
+    """
+    p_w = tf.matmul(rnn_h, rnn_h, transpose_b=True)
+    row_attn = tf.nn.softmax(p_w)
+    col_av = tf.reduce_mean(row_attn, axis=1)
+    attnattn = tf.einsum('akj,ak->aj', row_attn, col_av)
+    return attnattn
+
   def convolution(self, x, k_shape, scope):
     """
     Args:
       x: a [batch_size, seq_len, seq_len] pair-wise score tensor
+      k_shape: kernel shape [filter_height, filter_width, 1, out_channels]
       scope: need a scope name, otherwise variable naming error
     Returns:
       activated tensor. If x is shape [32,60,60], kernel has h/w 2, stride 2
@@ -711,9 +1048,8 @@ class ConvAttn2(PairWiseAttn):
     """
     # Expand last dim for convolution operation
     x = tf.expand_dims(x,-1)
+    kernel, bias = self.conv_weights(k_shape, scope)
     with tf.variable_scope(scope):
-      kernel = tf.get_variable("c_w", shape=k_shape, dtype=floatX)
-      bias = tf.get_variable("c_b", k_shape[-1], dtype=floatX)
       conv = tf.nn.conv2d( x, kernel, hp.conv_strides, hp.padding, name="conv")
 
       # Batch-norm
@@ -724,48 +1060,436 @@ class ConvAttn2(PairWiseAttn):
       h = tf.nn.relu(tf.nn.bias_add(conv, bias))
     return h
 
+  def conv_weights(self, k_shape, scope):
+    """ Kernel and bias of a convolution """
+    with tf.variable_scope(scope):
+      kernel = tf.get_variable("c_w", shape=k_shape, dtype=floatX)
+      bias = tf.get_variable("c_b", k_shape[-1], dtype=floatX)
+    return kernel, bias
+
   def max_pool(self, x, scope):
     """
-    If say input is shape [32,29,29,32], pool shape is [1,29,29,1] with stride 1,
-    then output is [32, 32]
+    Max over the whole feature map, whatever its size. If say input is shape
+    [32,29,29,32], then output is [32, 32]
     """
     with tf.variable_scope(scope):
-      p_shape = [1, 29, 29, 1]
-      stride = [1,1,1,1]
-      pooled = tf.nn.max_pool(
-          x,
-          p_shape,
-          stride,
-          hp.padding,
-          data_format='NHWC')
-      pooled = tf.squeeze(pooled, [1,2]) # squeeze single elem dimensions
+      pooled = tf.reduce_max(x, axis=[1,2])
       return pooled
-  def max_pool(self, x, scope):
+
+  ############################
+  # Chunked attention
+  ############################
+
+  def attn_tiles(self, length):
+    """ (start, end) of the tiles over `length` time steps """
+    size = hp.attn_chunk
+    return [(i, min(i+size, length)) for i in range(0, length, size)]
+
+  def tile_scores(self, rnn_h, rows, cols):
+    """ Tile of the pair-wise matching p_w, [batch, rows, cols] """
+    return tf.matmul(rnn_h[:, rows[0]:rows[1]], rnn_h[:, cols[0]:cols[1]],
+                                                            transpose_b=True)
+
+  def chunked_row_lse(self, rnn_h):
+    """
+    Log-sum-exp of every row of p_w, shape [batch, time]. Accumulated over
+    column tiles with an online max, so only one tile is alive at a time. By
+    symmetry of p_w it is also the log-sum-exp of every column
+    """
+    tiles = self.attn_tiles(hp.max_seq_len)
+    lse = []
+    for rows in tiles:
+      run_max, run_sum = None, None
+      for cols in tiles:
+        p_w = self.tile_scores(rnn_h, rows, cols)
+        tile_max = tf.reduce_max(p_w, axis=2)
+        if run_max is None:
+          new_max = tile_max
+          run_sum = 0.
+        else:
+          new_max = tf.maximum(run_max, tile_max)
+          run_sum = run_sum * tf.exp(run_max - new_max)
+        run_sum += tf.reduce_sum(tf.exp(p_w - tf.expand_dims(new_max, 2)), 2)
+        run_max = new_max
+      lse.append(run_max + tf.log(run_sum))
+    return tf.concat(lse, 1)
+
+  def row_attn_tile(self, rnn_h, lse, rows, cols):
+    """ Tile of the row-wise softmax """
+    p_w = self.tile_scores(rnn_h, rows, cols)
+    return tf.exp(p_w - tf.expand_dims(lse[:, rows[0]:rows[1]], 2))
+
+  def chunked_attn_attn(self, rnn_h, lse):
+    """
+    Same as `fused_attn_attn`, from tiles of the row-wise softmax rebuilt from
+    the row log-sum-exp. Tiles are recomputed rather than kept
+    """
+    tiles = self.attn_tiles(hp.max_seq_len)
+    col_av = []
+    for cols in tiles:
+      col_av.append(tf.add_n([tf.reduce_sum(
+                self.row_attn_tile(rnn_h, lse, rows, cols), 1) for rows in tiles]))
+    col_av = tf.concat(col_av, 1) / hp.max_seq_len
+
+    attnattn = []
+    for cols in tiles:
+      attnattn.append(tf.add_n([tf.einsum('akj,ak->aj',
+                self.row_attn_tile(rnn_h, lse, rows, cols),
+                col_av[:, rows[0]:rows[1]]) for rows in tiles]))
+    return tf.concat(attnattn, 1)
+
+  def check_chunked_conv(self):
+    """ Tiled convolutions need stride 1, VALID padding, no batch norm """
+    if [int(s) for s in hp.conv_strides] != [1,1,1,1] or hp.padding != 'VALID'\
+                                                      or hp.batch_norm == True:
+      raise ValueError("--attn_chunk with conv heads needs conv_strides "
+                       "1 1 1 1, VALID padding and no batch_norm")
+
+  def chunked_conv_pool(self, k_shape):
+    """
+    `conv` head over tiles. Each output tile of the VALID convolution reads an
+    input tile of the col and row attn with a halo of the filter size. Both
+    come from the same p_w tile: row_attn[j,k] = exp(p_w[j,k] - lse[j]) and,
+    by symmetry, col_attn[j,k] = exp(p_w[j,k] - lse[k]). Each tile is
+    max-pooled and the running max kept
+    Returns:
+      col_pool, row_pool of shape [batch, out_channels]
     """
-    If say input is shape [32,29,29,32], pool shape is [1,29,29,1] with stride 1,
-    then output is [32, 32]
+    self.check_chunked_conv()
+    rnn_h, lse = self.encoded_outputs, self.attn_lse
+    col_kernel, col_bias = self.conv_weights(k_shape, 'col_conv')
+    row_kernel, row_bias = self.conv_weights(k_shape, 'row_conv')
+    out_h = hp.max_seq_len - hp.filt_height + 1
+    out_w = hp.max_seq_len - hp.filt_width + 1
+    col_pool, row_pool = None, None
+    for out_rows in self.attn_tiles(out_h):
+      for out_cols in self.attn_tiles(out_w):
+        rows = (out_rows[0], out_rows[1] + hp.filt_height - 1)
+        cols = (out_cols[0], out_cols[1] + hp.filt_width - 1)
+        p_w = self.tile_scores(rnn_h, rows, cols)
+        row_attn = tf.exp(p_w - tf.expand_dims(lse[:, rows[0]:rows[1]], 2))
+        col_attn = tf.exp(p_w - tf.expand_dims(lse[:, cols[0]:cols[1]], 1))
+        pools = []
+        for x, kernel, bias in [(col_attn, col_kernel, col_bias),
+                                (row_attn, row_kernel, row_bias)]:
+          conv = tf.nn.conv2d(tf.expand_dims(x, -1), kernel, [1,1,1,1], 'VALID')
+          pools.append(tf.reduce_max(tf.nn.relu(tf.nn.bias_add(conv, bias)), [1,2]))
+        if col_pool is None:
+          col_pool, row_pool = pools
+        else:
+          col_pool = tf.maximum(col_pool, pools[0])
+          row_pool = tf.maximum(row_pool, pools[1])
+    return col_pool, row_pool
+
+  def chunked_conv1d(self, col_shape, row_shape):
     """
+    `conv1d` head over tiles. The col kernel sums col_attn over rows and the
+    row kernel sums row_attn over columns; by symmetry of p_w both are sums
+    over the columns of row_attn, so both are accumulated from the same tiles
+    Returns:
+      col_conv, row_conv of shape [batch, time]
+    """
+    self.check_chunked_conv()
+    rnn_h, lse = self.encoded_outputs, self.attn_lse
+    col_kernel, col_bias = self.conv_weights(col_shape, 'col_conv')
+    row_kernel, row_bias = self.conv_weights(row_shape, 'row_conv')
+    # Both kernels as columns of one [time, 2] matrix
+    kernels = tf.stack([tf.reshape(col_kernel, [-1]),
+                        tf.reshape(row_kernel, [-1])], axis=1)
+    tiles = self.attn_tiles(hp.max_seq_len)
+    convs = []
+    for rows in tiles:
+      convs.append(tf.add_n([tf.einsum('ajk,kc->ajc',
+                self.row_attn_tile(rnn_h, lse, rows, cols),
+                kernels[cols[0]:cols[1]]) for cols in tiles]))
+    convs = tf.concat(convs, 1)
+    col_conv = tf.nn.relu(convs[:, :, 0] + col_bias)
+    row_conv = tf.nn.relu(convs[:, :, 1] + row_bias)
+    return col_conv, row_conv
+
+class PairWiseAttn(RNN_base):
+  """ Pair-wise Attn """
+  head = 'pair_wise'
+
+class AttnAttn(RNN_base):
+  """
+  Attn over attn, based mostly on https://arxiv.org/pdf/1607.04423.pdf,
+  except for final layer which is fully connected to number of classes
+  """
+  head = 'attn_attn'
+
+class AttnAttnSum(RNN_base):
+  """
+  Self-attention-over-attention for weighted sum of encoded input
+  """
+  head = 'attn_sum'
+
+class ConvAttn(RNN_base):
+  """
+  Given pair-wise matching score tensors, we convolve over them. Intuition
+  is to detect clusters of local attention
+  """
+  head = 'conv'
+
+class ConvAttn2(RNN_base):
+  """
+  1D convolve rows and cols
+  Given pair-wise matching score tensors, we convolve over them. Intuition
+  is to detect clusters of local attention
+  """
+  head = 'conv1d'
+
+class MultiTrigger(RNN_base):
+  """
+  One model for several triggers. The encoder, attention and hidden layers of
+  the head are shared, the output layer has weights per trigger, picked for
+  each sample by the `trigger_ids` input
+  """
+  head = 'attn_sum'
+
+  def build_inputs(self, source=None):
+    if source is not None:
+      self.trigger_ids = source.trigger_ids
+    else:
+      self.trigger_ids = tf.placeholder(intX, shape=[None,])
+    # Fed by call_model from the extra arrays of each batch, in order
+    self.extra_inputs = [self.trigger_ids]
+    super().build_inputs(source)
+
+  def output_layer(self, x, in_dim, scope):
+    """ Per trigger output layer, gathered by trigger id """
     with tf.variable_scope(scope):
-      p_shape = [1, 29, 29, 1]
-      stride = [1,1,1,1]
-      pooled = tf.nn.max_pool(
-          x,
-          p_shape,
-          stride,
-          hp.padding,
-          data_format='NHWC')
-      pooled = tf.squeeze(pooled, [1,2]) # squeeze single elem dimensions
-      return pooled
+      weights = tf.get_variable("weights",
+                shape=[hp.num_triggers, in_dim, hp.num_classes],
+                dtype=floatX, initializer=tf.orthogonal_initializer())
+      biases = tf.get_variable("biases", [hp.num_triggers, hp.num_classes],
+                dtype=floatX, initializer=tf.constant_initializer(0.0))
+      # [batch, in_dim, classes] weights, one matrix per sample
+      w = tf.gather(weights, self.trigger_ids)
+      b = tf.gather(biases, self.trigger_ids)
+      logits = tf.einsum('ai,aic->ac', x, w) + b
+    return logits
+
+class Head():
+  """ Logits, loss and predictions of one head of a `MultiHead` model """
+  def __init__(self, name, logits, loss, cost, y_prob, y_pred, y_true):
+    self.name = name
+    self.logits = logits
+    self.loss = loss
+    self.cost = cost
+    self.y_prob = y_prob
+    self.y_pred = y_pred
+    self.y_true = y_true
+    self.optimize = None
+
+class MultiHead(RNN_base):
+  """
+  Several heads from `HEADS` over a single encoder pass. Each head is built in
+  a variable scope named after it. With `hp.multi_loss` "sum" one step
+  minimizes the sum of the head losses, with "alternate" each head has its
+  own step and the training loop cycles through them
+  """
+  def build_classifier(self):
+    self.head_names = hp.heads
+    if not self.head_names:
+      raise ValueError("MultiHead needs --heads")
+    if getattr(hp, 'prune_tokens', False):
+      raise ValueError("Token pruning needs the attn_sum head and --word_gate")
+    builders = [get_head(name) for name in self.head_names]
+
+    # Attention once for all heads which read it
+    reads = [attn for _, attn in builders]
+    self.build_attn(full='full' in reads, aoa='aoa' in reads)
+
+    # Heads, each in its own scope so variables don't collide
+    self.heads = []
+    for name, (build_head, _) in zip(self.head_names, builders):
+      with tf.variable_scope(name):
+        logits = build_head(self)
+      loss = class_weighted(self.classification_loss(self.labels, logits),
+                                                                self.labels)
+      cost = tf.reduce_mean(loss)
+      y_prob, y_pred, y_true = self.predict(self.labels, logits)
+      self.heads.append(Head(name, logits, loss, cost, y_prob, y_pred, y_true))
+
+    # First head stands for the model where a single output is expected
+    first = self.heads[0]
+    self.head_name = first.name
+    self.logits, self.loss = first.logits, first.loss
+    self.y_prob, self.y_pred, self.y_true = first.y_prob, first.y_pred, first.y_true
+    self.cost = tf.add_n([head.cost for head in self.heads])
+
+    # A single optimizer so all heads share its slots for the encoder
+    optimizer = self.get_optimizer()
+    if getattr(hp, 'multi_loss', 'sum') == 'alternate':
+      for head in self.heads:
+        head.optimize = self.optimize_step(head.cost, self.global_step, optimizer)
+      self.optimize = self.heads[0].optimize
+    else:
+      self.optimize = self.optimize_step(self.cost, self.global_step, optimizer)
+
+  def head_var_list(self, name):
+    """
+    Variables for a standalone model with head `name`, keyed by their name in
+    that model: shared variables as is, the head's without its scope prefix,
+    other heads' left out
+    """
+    prefixes = [head + '/' for head in self.head_names]
+    var_list = {}
+    for var in tf.global_variables():
+      var_name = var.op.name
+      if var_name.startswith(name + '/'):
+        var_list[var_name[len(name)+1:]] = var
+      elif not any(var_name.startswith(p) for p in prefixes):
+        var_list[var_name] = var
+    return var_list
+
+class Replicas():
+  """
+  `hp.replicas` copies of the model `hp.replica_model` trained together in one
+  graph, for seed studies and ensembles at about the cost of one run. Each
+  replica is a whole model in variable scope r<i>, with its own initial
+  weights, dropout and optimizer, all reading the input placeholders of the
+  first. One step trains every replica on the same batch. y_prob averages
+  the replicas' probabilities, the ensemble, and each replica is a `Head`
+  so the MultiHead training loop scores and exports it on its own
+  """
+  def __init__(self, params, embedding, postag_size):
+    global hp
+    hp = params
+    model_class = globals().get(hp.replica_model)
+    if not isinstance(model_class, type) or not issubclass(model_class, RNN_base)\
+                                        or issubclass(model_class, MultiHead):
+      raise ValueError("Replicas of an RNN_base model with one head, not {}"
+                                                  .format(hp.replica_model))
+    if hp.replicas < 2:
+      raise ValueError("Replicas needs --replicas 2 or more")
+    for flag in ['distill_from', 'freeze_encoder_steps', 'warm_start']:
+      if getattr(hp, flag, None):
+        raise ValueError("Replicas don't support --" + flag)
+    # Replicas step together, model.global_step is the first one's
+    if getattr(hp, 'multi_loss', 'sum') == 'alternate':
+      raise ValueError("Replicas train together, no --multi_loss alternate")
+
+    # A frozen embedding is one constant for all replicas, not a copy each
+    if not hp.emb_trainable and isinstance(embedding, np.ndarray):
+      with tf.device("/cpu:0"):
+        embedding = tf.constant(embedding, name="embedding")
+
+    self.replicas = []
+    for i in range(hp.replicas):
+      with tf.variable_scope('r{}'.format(i)):
+        source = self.replicas[0] if i > 0 else None
+        self.replicas.append(model_class(hp, embedding, postag_size, source))
+    first = self.replicas[0]
+    for name in INPUTS + ['batch_size', 'embedding_tensor']:
+      setattr(self, name, getattr(first, name))
+    self.extra_inputs = getattr(first, 'extra_inputs', [])
+    self.head_name = first.head_name
+    # Replicas take their steps together
+    self.global_step = first.global_step
+
+    self.heads = [Head('r{}'.format(i), m.logits, m.loss, m.cost, m.y_prob,
+                    m.y_pred, m.y_true) for i, m in enumerate(self.replicas)]
+    self.head_names = [head.name for head in self.heads]
+
+    # Ensemble of the averaged probabilities, its log for the logits
+    self.y_prob = tf.add_n([m.y_prob for m in self.replicas]) / hp.replicas
+    self.y_pred = tf.argmax(self.y_prob, axis=1)
+    self.y_true = first.y_true
+    self.logits = tf.log(self.y_prob)
+    self.cost = tf.add_n([m.cost for m in self.replicas]) / hp.replicas
+
+    steps = [m.optimize for m in self.replicas]
+    if isinstance(steps[0], AccumStep):
+      self.optimize = AccumStep(tf.group(*[step.accumulate for step in steps]),
+                                tf.group(*[step.apply for step in steps]))
+    else:
+      self.optimize = tf.group(*steps)
+
+  # Variables of replica `name` as the standalone model names them
+  head_var_list = MultiHead.head_var_list
+
+class LowRankLSTMCell(tf.contrib.rnn.LSTMCell):
+  """
+  LSTMCell whose kernel is the product of two factors, `kernel_u` and
+  `kernel_v`, of rank `hp.low_rank[<cell scope>]`. Without an entry for its
+  scope it is a plain LSTMCell. Peepholes, projection and clipping are not
+  supported
+  """
+  def build(self, inputs_shape):
+    rank = low_rank(tf.get_variable_scope().name)
+    self._rank = rank
+    if not rank:
+      return super(LowRankLSTMCell, self).build(inputs_shape)
+    in_depth = inputs_shape[-1].value
+    h_depth = self._num_units
+    self._kernel_u = self.add_variable("kernel_u", shape=[in_depth + h_depth, rank])
+    self._kernel_v = self.add_variable("kernel_v", shape=[rank, 4 * h_depth])
+    self._bias = self.add_variable("bias", shape=[4 * h_depth],
+                          initializer=tf.zeros_initializer(dtype=self.dtype))
+    self.built = True
+
+  def call(self, inputs, state):
+    if not self._rank:
+      return super(LowRankLSTMCell, self).call(inputs, state)
+    c, h = state
+    gates = tf.matmul(tf.concat([inputs, h], 1), self._kernel_u)
+    gates = tf.matmul(gates, self._kernel_v) + self._bias
+    # Gate order of LSTMCell: input, new input, forget, output
+    i, j, f, o = tf.split(gates, 4, axis=1)
+    new_c = tf.sigmoid(f + self._forget_bias) * c + tf.sigmoid(i) * self._activation(j)
+    new_h = tf.sigmoid(o) * self._activation(new_c)
+    return new_h, tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
+
+def class_weighted(loss, labels):
+  """ Per sample loss times the weight of its class, `hp.class_weights` """
+  weights = getattr(hp, 'class_weights', None)
+  if not weights:
+    return loss
+  weights = tf.gather(tf.constant(weights, floatX), tf.argmax(labels, axis=1))
+  return loss * weights
+
+def distill_cost(model, hard_cost, logits):
+  """
+  Knowledge distillation cost, Hinton et al. 2015. Adds a `soft_labels` input
+  to `model` for the teacher's temperature softened probabilities
+  """
+  temp = hp.distill_temp
+  model.soft_labels = tf.placeholder(floatX, shape=[None, hp.num_classes])
+  model.extra_inputs = getattr(model, 'extra_inputs', []) + [model.soft_labels]
+  soft_loss = tf.nn.softmax_cross_entropy_with_logits(
+                                labels=model.soft_labels, logits=logits/temp)
+  # temp^2 keeps the soft gradients on the scale of the hard ones
+  soft_cost = tf.reduce_mean(soft_loss) * temp**2
+  return hp.distill_alpha*soft_cost + (1-hp.distill_alpha)*hard_cost
+
+def low_rank(scope):
+  """ Rank of the factored weights of variable scope `scope`, or None """
+  return (getattr(hp, 'low_rank', None) or {}).get(scope)
 
 def dense(x, in_dim, out_dim, scope, act=None):
-  """ Fully connected layer builder"""
+  """
+  Fully connected layer builder. With a `hp.low_rank` entry for its scope,
+  the weights are the product of two factors of that rank
+  """
   with tf.variable_scope(scope):
-    weights = tf.get_variable("weights", shape=[in_dim, out_dim],
-              dtype=floatX, initializer=tf.orthogonal_initializer())
+    rank = low_rank(tf.get_variable_scope().name)
+    if rank:
+      weights_u = tf.get_variable("weights_u", shape=[in_dim, rank],
+                dtype=floatX, initializer=tf.orthogonal_initializer())
+      weights_v = tf.get_variable("weights_v", shape=[rank, out_dim],
+                dtype=floatX, initializer=tf.orthogonal_initializer())
+    else:
+      weights = tf.get_variable("weights", shape=[in_dim, out_dim],
+                dtype=floatX, initializer=tf.orthogonal_initializer())
     biases = tf.get_variable("biases", out_dim,
               dtype=floatX, initializer=tf.constant_initializer(0.0))
     # Pre activation
-    h = tf.matmul(x,weights) + biases
+    if rank:
+      h = tf.matmul(tf.matmul(x, weights_u), weights_v) + biases
+    else:
+      h = tf.matmul(x,weights) + biases
     # Post activation
     if act:
       h = act(h)
@@ -0,0 +1,157 @@
+# Numpy only forward pass of the RNN models, no TensorFlow needed
+import json
+import numpy as np
+
+class NumpyModel():
+  """
+  Batched inference for a model exported with `export.export_weights`.
+  Mirrors the TF graph: embedding (+ one-hot POS tags) -> LSTM -> word gate ->
+  pair-wise matching -> row/col softmax -> attn over attn -> dense layers.
+  Supports the mean_pool, attn_attn and attn_sum heads, uni or bidirectional
+  LSTMCell encoders
+  """
+  heads = ['mean_pool', 'attn_attn', 'attn_sum']
+
+  def __init__(self, path):
+    weights = np.load(path)
+    self.hp = json.loads(str(weights['__hp__']))
+    self.w = {k: weights[k] for k in weights.files if k != '__hp__'}
+    self.head = self.hp['head']
+    reason = self.unsupported(self.hp)
+    if reason is not None:
+      raise ValueError("Not supported by the numpy runtime: " + reason)
+    # Output layers with weights per trigger are [triggers, in, classes]
+    for k, v in self.w.items():
+      scope, _, name = k.rpartition('/')
+      if scope.split('/')[-1].startswith('class_log') and \
+                                  v.ndim != (1 if name == 'biases' else 2):
+        raise ValueError("Not supported by the numpy runtime: {} of shape {}"
+                                                        .format(k, v.shape))
+
+  @classmethod
+  def unsupported(cls, hp):
+    """ Why the model of the hyper params `hp` can't be run, None if it can """
+    if hp.get('head') not in cls.heads:
+      return "head {}".format(hp.get('head'))
+    if hp.get('cell_type') != 'LSTMCell' or hp.get('parallel'):
+      return "encoder other than a single LSTMCell"
+    if hp.get('prune_tokens'):
+      return "token pruning"
+    return None
+
+  def var(self, scope, name):
+    """
+    Weights `name` from the only variable scope containing the scope names
+    `scope`, e.g. 'h' or '/fw/'. Low rank weights of compress.py, `name`_u
+    and `name`_v, are multiplied back
+    """
+    scope = '/' + scope.strip('/') + '/'
+    keys = [k for k in self.w if scope in '/' + k and k.endswith('/' + name)]
+    if len(keys) == 0 and name in ('weights', 'kernel'):
+      return self.var(scope, name + '_u').dot(self.var(scope, name + '_v'))
+    if len(keys) != 1:
+      raise KeyError("Expected one {} in {}, found {}".format(name, scope, keys))
+    return self.w[keys[0]]
+
+  def predict(self, x, postags, x_len):
+    """
+    Args:
+      x: word ids [batch, max_seq_len]
+      postags: pos tag ids [batch, max_seq_len]
+      x_len: sequence lengths [batch]
+    Returns:
+      class probabilities [batch, num_classes]
+    """
+    hp = self.hp
+    inputs = self.w['embedding'][x]
+    if hp['postags']:
+      tags = np.eye(hp['postag_size'], dtype=np.float32)[postags]
+      inputs = np.concatenate([inputs, tags], axis=2)
+
+    # Encoder
+    if hp['birnn']:
+      fw = lstm(inputs, x_len, self.var('/fw/', 'kernel'), self.var('/fw/', 'bias'))
+      bw = lstm(reverse(inputs, x_len), x_len,
+                self.var('/bw/', 'kernel'), self.var('/bw/', 'bias'))
+      h = np.concatenate([fw, reverse(bw, x_len)], axis=2)
+    else:
+      h = lstm(inputs, x_len, self.var('unidirectionalRNN/', 'kernel'),
+                              self.var('unidirectionalRNN/', 'bias'))
+
+    if hp['word_gate']:
+      gate = sigmoid(self.dense(inputs, 'word_gate'))
+      h = gate * h
+
+    # Heads
+    if self.head == 'mean_pool':
+      out = h.mean(axis=1)
+      return softmax(self.dense(out, 'class_log'), axis=1)
+
+    aoa = attn_over_attn(h)
+    if self.head == 'attn_attn':
+      out, hidden, final = aoa, ['h'] + ['dense{}'.format(i) for i in
+                                        range(hp['h_layers'])], 'class_log'
+    else:
+      out = np.einsum('ajk,aj->ak', h, aoa)
+      hidden = ['h_sum'] + ['dense_sum{}'.format(i) for i in range(hp['h_layers'])]
+      final = 'class_log_sum'
+    for scope in hidden:
+      out = relu(self.dense(out, scope))
+    return softmax(self.dense(out, final), axis=1)
+
+  def dense(self, x, scope):
+    """ Dense layer of variable scope `scope`, low rank or not """
+    return dense(x, self.var(scope, 'weights'), self.var(scope, 'biases'))
+
+def lstm(x, seq_len, kernel, bias, forget_bias=1.0):
+  """
+  tf.contrib.rnn.LSTMCell over time as in dynamic_rnn: outputs past seq_len
+  are zero and the state is carried unchanged
+  Returns:
+    outputs of shape [batch, time, units]
+  """
+  batch, time, _ = x.shape
+  units = kernel.shape[1] // 4
+  c = np.zeros((batch, units), dtype=np.float32)
+  h = np.zeros((batch, units), dtype=np.float32)
+  outputs = np.zeros((batch, time, units), dtype=np.float32)
+  for t in range(time):
+    z = np.concatenate([x[:, t], h], axis=1).dot(kernel) + bias
+    i, j, f, o = np.split(z, 4, axis=1)
+    new_c = sigmoid(f + forget_bias) * c + sigmoid(i) * np.tanh(j)
+    new_h = sigmoid(o) * np.tanh(new_c)
+    alive = (t < seq_len)[:, None]
+    c = np.where(alive, new_c, c)
+    h = np.where(alive, new_h, h)
+    outputs[:, t] = np.where(alive, new_h, 0)
+  return outputs
+
+def reverse(x, seq_len):
+  """ Reverse the first seq_len steps of each sample, like tf.reverse_sequence """
+  out = x.copy()
+  for b, length in enumerate(seq_len):
+    out[b, :length] = x[b, :length][::-1]
+  return out
+
+def attn_over_attn(h):
+  """
+  Attn over attn vector [batch, time] from encoder outputs. The pair-wise
+  matrix is symmetric so the column softmax is the row softmax transposed
+  """
+  p_w = np.matmul(h, h.transpose(0, 2, 1))
+  row_attn = softmax(p_w, axis=2)
+  col_av = row_attn.mean(axis=1)
+  return np.einsum('akj,ak->aj', row_attn, col_av)
+
+def dense(x, weights, biases):
+  return np.dot(x, weights) + biases
+
+def relu(x):
+  return np.maximum(x, 0)
+
+def sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+def softmax(x, axis):
+  e = np.exp(x - x.max(axis=axis, keepdims=True))
+  return e / e.sum(axis=axis, keepdims=True)
@@ -0,0 +1,222 @@
+# Raw text to the processed dataset read by load_data
+#
+# Raw shards are text files --raw_dir/{train,valid,test}/*.txt with one
+# sample per line: "<label>\t<sentence>". The label is the trigger, or
+# --neg_label for negative samples. Output goes to --data_dir, the vocab and
+# embedding subset to --pickle. Shards processed on an earlier run are
+# skipped and word ids are only ever appended, so adding raw shards only
+# processes those:
+# python preprocess.py --raw_dir raw/ --emb_path glove.840B.300d.txt --data_dir processed/ --pickle processed/processed.pkl --postags --remove_words again
+import os, glob, pickle, re
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+from utils import HParams
+try:
+  import nltk
+except ImportError:
+  nltk = None
+
+SPLITS = ['train', 'valid', 'test']
+PAD, UNK = 0, 1
+TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+def tokenize(sent):
+  """ nltk word tokens if available, else words and single punctuation """
+  if nltk is not None:
+    return nltk.word_tokenize(sent)
+  return TOKEN_RE.findall(sent)
+
+def tag(tokens):
+  """ Penn treebank POS tags with nltk, 'X' for every token without it """
+  if nltk is not None and len(tokens) > 0:
+    return [t for _, t in nltk.pos_tag(tokens)]
+  return ['X'] * len(tokens)
+
+def shard_path(directory, stage, split, raw_path, ext):
+  name = os.path.splitext(os.path.basename(raw_path))[0] + ext
+  return os.path.join(directory, stage, split, name)
+
+def write_atomic(path, write):
+  """ Write through a temp file, so a shard on disk is always complete """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path + ".tmp", "wb") as f: write(f)
+  os.replace(path + ".tmp", path)
+
+def tokenize_shard(args):
+  """
+  Tokenise, drop `remove` words and tag a raw shard. Writes the samples and
+  the word and tag counts of the shard
+  """
+  raw_path, out_path, remove, tagged = args
+  samples, words, tags = [], Counter(), Counter()
+  with open(raw_path, encoding='utf-8') as f:
+    for line in f:
+      label, _, sent = line.rstrip('\n').partition('\t')
+      tokens = [w for w in tokenize(sent) if w.lower() not in remove]
+      pos = tag(tokens) if tagged else []
+      words.update(tokens)
+      tags.update(pos)
+      samples.append((tokens, pos, label))
+  write_atomic(out_path, lambda f: pickle.dump((samples, words, tags), f))
+  return out_path
+
+# Vocab of the mapping workers, sent once per process by init_mapper
+mapper = {}
+
+def init_mapper(word_idx_map, tag_idx_map):
+  mapper.update(word_idx_map=word_idx_map, tag_idx_map=tag_idx_map)
+
+def map_shard(args):
+  """ Word and tag ids of a tokenised shard, padded to max_seq_len """
+  tok_path, out_path, max_seq_len, neg_label = args
+  word_idx_map, tag_idx_map = mapper['word_idx_map'], mapper['tag_idx_map']
+  samples, _, _ = pickle.load(open(tok_path, "rb"))
+  n = len(samples)
+  X = np.zeros((n, max_seq_len), dtype=np.int32)
+  XTags = np.zeros((n, max_seq_len), dtype=np.int32)
+  Xlen = np.zeros(n, dtype=np.int32)
+  Y = np.zeros(n, dtype=np.int32)
+  YActual = []
+  for i, (tokens, pos, label) in enumerate(samples):
+    tokens, pos = tokens[:max_seq_len], pos[:max_seq_len]
+    X[i, :len(tokens)] = [word_idx_map.get(w, UNK) for w in tokens]
+    XTags[i, :len(pos)] = [tag_idx_map.get(t, PAD) for t in pos]
+    Xlen[i] = len(tokens)
+    Y[i] = int(label != neg_label)
+    YActual.append(label)
+  cols = {'X': X, 'XTags': XTags, 'Xlen': Xlen, 'Y': Y,
+          'YActual': np.array(YActual)}
+  write_atomic(out_path, lambda f: np.savez(f, **cols))
+  return out_path
+
+def read_vectors(path, words):
+  """
+  Vectors of `words` from a text embedding file, one pass, others skipped.
+  Lines are split from the right, glove.840B has words with spaces such as
+  ". . .", the vector size is that of the first line
+  """
+  vectors, dim = {}, None
+  with open(path, encoding='utf-8', errors='ignore') as f:
+    for line in f:
+      if dim is None:
+        dim = len(line.rstrip().split(' ')) - 1
+      parts = line.rstrip().rsplit(' ', dim)
+      if len(parts) == dim + 1 and parts[0] in words:
+        vectors[parts[0]] = np.array(parts[1:], dtype=np.float32)
+  return vectors
+
+def update_vocab(vocab_path, emb_path, counts, tag_counts, min_count, seed=1):
+  """
+  Append words of `counts` not yet in the vocab. Words in the embedding file
+  get their vector, others seen at least `min_count` times a random one, the
+  rest map to UNK. Existing ids never change, so mapped shards stay valid
+  Returns:
+    emb, word_idx_map, tag_idx_map
+  """
+  if os.path.exists(vocab_path):
+    emb, word_idx_map, tag_idx_map = pickle.load(open(vocab_path, "rb"))
+    rows = list(emb)
+  else:
+    emb, word_idx_map, tag_idx_map, rows = None, {}, {}, None
+
+  new = set(w for w in counts if w not in word_idx_map)
+  vectors = read_vectors(emb_path, new) if len(new) > 0 else {}
+  if rows is None:
+    if len(vectors) == 0:
+      raise ValueError("No word of the corpus found in " + emb_path)
+    dim = len(next(iter(vectors.values())))
+    rows = [np.zeros(dim, dtype=np.float32), np.zeros(dim, dtype=np.float32)]
+  dim = len(rows[0])
+  rnd = np.random.RandomState(seed + len(rows))
+  # Sorted so ids don't depend on shard order
+  for w in sorted(new):
+    if w in vectors:
+      vec = vectors[w]
+    elif counts[w] >= min_count:
+      vec = rnd.uniform(-0.25, 0.25, dim).astype(np.float32)
+    else:
+      continue
+    word_idx_map[w] = len(rows)
+    rows.append(vec)
+  for t in sorted(tag_counts):
+    if t not in tag_idx_map: tag_idx_map[t] = len(tag_idx_map) + 1
+
+  emb = np.asarray(rows, dtype=np.float32)
+  os.makedirs(os.path.dirname(os.path.abspath(vocab_path)), exist_ok=True)
+  write_atomic(vocab_path, lambda f: pickle.dump((emb, word_idx_map, tag_idx_map),
+                                                          f, protocol=4))
+  return emb, word_idx_map, tag_idx_map
+
+def preprocess(hp):
+  """ Run all stages, only on raw shards without output yet """
+  workers = hp.workers or os.cpu_count()
+  remove = set(w.lower() for w in (hp.remove_words or []))
+  raw = [(split, p) for split in SPLITS
+              for p in sorted(glob.glob(os.path.join(hp.raw_dir, split, "*.txt")))]
+
+  # Tokenise and tag
+  todo = [(p, shard_path(hp.data_dir, 'tokens', split, p, '.pkl'), remove, hp.postags)
+              for split, p in raw]
+  todo = [args for args in todo if not os.path.exists(args[1])]
+  print("Tokenising {} of {} shards".format(len(todo), len(raw)))
+  with Pool(workers) as pool:
+    for path in pool.imap_unordered(tokenize_shard, todo): print(path)
+
+  # Vocab from the counts of new shards only, ids are append only
+  new_ids = [(split, p) for split, p in raw if not
+              os.path.exists(shard_path(hp.data_dir, 'ids', split, p, '.npz'))]
+  counts, tag_counts = Counter(), Counter()
+  for split, p in new_ids:
+    _, words, tags = pickle.load(open(shard_path(hp.data_dir, 'tokens', split, p, '.pkl'), "rb"))
+    counts.update(words)
+    tag_counts.update(tags)
+  emb, word_idx_map, tag_idx_map = update_vocab(hp.pickle, hp.emb_path,
+                                      counts, tag_counts, hp.min_count)
+  print("Vocab: {} words, {} tags".format(len(word_idx_map), len(tag_idx_map)))
+
+  # Map to ids
+  todo = [(shard_path(hp.data_dir, 'tokens', split, p, '.pkl'),
+           shard_path(hp.data_dir, 'ids', split, p, '.npz'),
+           hp.max_seq_len, hp.neg_label) for split, p in new_ids]
+  print("Mapping {} shards".format(len(todo)))
+  with Pool(workers, initializer=init_mapper,
+                          initargs=(word_idx_map, tag_idx_map)) as pool:
+    for path in pool.imap_unordered(map_shard, todo): print(path)
+
+def load_vocab(pickle_path):
+  """ emb, word_idx_map, tag_idx_map of a vocab pickle written by update_vocab """
+  vocab = pickle.load(open(pickle_path, "rb"))
+  if not (isinstance(vocab, tuple) and len(vocab) == 3 and isinstance(vocab[2], dict)):
+    raise ValueError("{} is not a vocab written by preprocess.py".format(pickle_path))
+  return vocab
+
+def load_data(data_dir, pickle_path, tagged=False, tag_map=False):
+  """
+  Processed dataset as emb, word_idx_map, data, postag_size, where data is
+  (trX, trXTags, trXlen, trY, vaX, vaXTags, vaXlen, vaY, teX, teXTags, teXlen,
+  teY, teYActual) from the id shards of each split. With `tag_map` the
+  {tag: id} map follows
+  """
+  emb, word_idx_map, tag_idx_map = load_vocab(pickle_path)
+  data = []
+  for split in SPLITS:
+    shards = [np.load(p) for p in
+                  sorted(glob.glob(os.path.join(data_dir, 'ids', split, "*.npz")))]
+    if len(shards) == 0:
+      raise ValueError("No {} shards in {}, run preprocess.py with {} raw "
+                       "shards".format(split, os.path.join(data_dir, 'ids', split), split))
+    cols = {k: np.concatenate([s[k] for s in shards])
+                  for k in ['X', 'XTags', 'Xlen', 'Y', 'YActual']}
+    data += [cols['X'], cols['XTags'], cols['Xlen'], cols['Y']]
+  data.append(cols['YActual'])
+  postag_size = len(tag_idx_map) + 1 if tagged else 0
+  if tag_map:
+    return emb, word_idx_map, tuple(data), postag_size, tag_idx_map
+  return emb, word_idx_map, tuple(data), postag_size
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.raw_dir is None or hp.emb_path is None:
+    raise ValueError("Set --raw_dir and --emb_path")
+  preprocess(hp)
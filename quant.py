@@ -0,0 +1,191 @@
+# Quantized frozen embedding, int8 or product quantization
+#
+# With --emb_quant the models get a QuantizedEmbedding in place of the float
+# embedding matrix. It holds int8 codes with a scale per row (about 4x
+# smaller), or product quantization codes (8x by default), and only the rows
+# of a batch are decoded in the graph. Codes are cached next to --pickle.
+# Score a checkpoint with its float and quantized embeddings:
+# python quant.py --ckpt_name wsj_natural --data_dir ... --pickle ... --emb_quant pq
+import os, pickle, hashlib
+import numpy as np
+import tensorflow as tf
+
+class QuantizedEmbedding():
+  """
+  Stand in for the [vocab_size, emb_size] embedding matrix of the models.
+    int8: row i is codes[i] * scales[i]
+    pq: rows are cut in `subspaces` sub vectors, each coded by the uint8 id
+        of the nearest centroid of its subspace's codebook,
+        codebooks [subspaces, centroids, emb_size/subspaces]
+  """
+  def __init__(self, method, codes, scales=None, codebooks=None):
+    self.method = method
+    self.codes = codes
+    self.scales = scales
+    self.codebooks = codebooks
+    if method == 'int8':
+      self.shape = codes.shape
+    else:
+      self.shape = (codes.shape[0], codebooks.shape[0] * codebooks.shape[2])
+
+  @property
+  def nbytes(self):
+    return sum(a.nbytes for a in [self.codes, self.scales, self.codebooks]
+                                                          if a is not None)
+
+  def lookup(self, word_ids):
+    """ Decoded rows of the int tensor `word_ids`, float32 [..., emb_size] """
+    if self.method == 'int8':
+      codes = tf.gather(tf.constant(self.codes), word_ids)
+      scales = tf.gather(tf.constant(self.scales), word_ids)
+      return tf.cast(codes, tf.float32) * tf.expand_dims(scales, -1)
+    subspaces, centroids, sub_dim = self.codebooks.shape
+    # Codebooks stacked, the code of subspace j is offset by j*centroids
+    flat = tf.constant(self.codebooks.reshape(subspaces * centroids, sub_dim))
+    codes = tf.cast(tf.gather(tf.constant(self.codes), word_ids), tf.int32)
+    sub = tf.gather(flat, codes + tf.range(subspaces) * centroids)
+    rows = tf.reshape(sub, tf.concat([tf.shape(word_ids), [self.shape[1]]], 0))
+    rows.set_shape(word_ids.shape.concatenate([self.shape[1]]))
+    return rows
+
+  def decode(self, ids=None):
+    """ Float rows `ids`, all by default, as a numpy array """
+    ids = np.arange(self.shape[0]) if ids is None else ids
+    if self.method == 'int8':
+      return self.codes[ids].astype(np.float32) * self.scales[ids, None]
+    subspaces = self.codebooks.shape[0]
+    sub = self.codebooks[np.arange(subspaces)[None, :], self.codes[ids]]
+    return sub.reshape(len(ids), self.shape[1])
+
+def quantize_int8(emb):
+  """ Symmetric int8 codes, each row scaled by its max absolute value """
+  scales = np.abs(emb).max(axis=1) / 127.
+  scales[scales == 0] = 1.
+  codes = np.clip(np.round(emb / scales[:, None]), -127, 127).astype(np.int8)
+  return QuantizedEmbedding('int8', codes, scales=scales.astype(np.float32))
+
+def nearest(x, centroids, chunk=2**16):
+  """ Index of the nearest centroid of each row of `x` """
+  sq = (centroids**2).sum(axis=1)
+  out = np.empty(len(x), dtype=np.int64)
+  for start in range(0, len(x), chunk):
+    part = x[start:start+chunk]
+    out[start:start+chunk] = np.argmin(sq[None, :] - 2 * part.dot(centroids.T), axis=1)
+  return out
+
+def kmeans(x, k, iters, rnd):
+  """ Lloyd's k-means from `k` random rows, empty clusters keep their centroid """
+  centroids = x[rnd.choice(len(x), k, replace=False)].astype(np.float64)
+  for _ in range(iters):
+    assign = nearest(x, centroids)
+    counts = np.bincount(assign, minlength=k)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assign, x)
+    filled = counts > 0
+    centroids[filled] = sums[filled] / counts[filled, None]
+  return centroids
+
+def default_subspaces(dim):
+  """ Sub vectors of 2 dims where possible: one byte per 2 floats, 8x smaller """
+  return max(m for m in range(1, max(dim // 2, 1) + 1) if dim % m == 0)
+
+def quantize_pq(emb, subspaces=0, centroids=256, sample=50000, iters=20, seed=1):
+  """
+  Product quantization, the codebook of each subspace from k-means over a
+  sample of `sample` rows
+  """
+  vocab_size, dim = emb.shape
+  subspaces = subspaces or default_subspaces(dim)
+  if dim % subspaces != 0:
+    raise ValueError("Embedding size {} not divisible in {} subspaces"
+                                                    .format(dim, subspaces))
+  if not 1 < centroids <= 256:
+    raise ValueError("PQ codes are uint8, 2 to 256 centroids")
+  rnd = np.random.RandomState(seed)
+  train = emb[rnd.choice(vocab_size, min(vocab_size, sample), replace=False)]
+  centroids = min(centroids, len(train))
+  sub_dim = dim // subspaces
+  codebooks = np.zeros((subspaces, centroids, sub_dim), dtype=np.float32)
+  codes = np.zeros((vocab_size, subspaces), dtype=np.uint8)
+  for j in range(subspaces):
+    cols = slice(j * sub_dim, (j + 1) * sub_dim)
+    codebooks[j] = kmeans(train[:, cols].astype(np.float64), centroids, iters, rnd)
+    codes[:, j] = nearest(emb[:, cols], codebooks[j])
+  return QuantizedEmbedding('pq', codes, codebooks=codebooks)
+
+def quantized_embedding(hp, emb):
+  """
+  `emb` quantized by `hp.emb_quant`, from the cache next to `hp.pickle`
+  unless it was built from another matrix or with other params
+  """
+  if hp.emb_quant == 'int8':
+    path = hp.pickle + ".int8.pkl"
+    params = ('int8',)
+  elif hp.emb_quant == 'pq':
+    path = "{}.pq{}x{}.pkl".format(hp.pickle, hp.pq_subspaces, hp.pq_centroids)
+    params = ('pq', hp.pq_subspaces, hp.pq_centroids)
+  else:
+    raise ValueError("Invalid emb_quant: " + hp.emb_quant)
+  key = embedding_key(emb, params)
+  if os.path.exists(path):
+    cached = pickle.load(open(path, "rb"))
+    # Caches without their key are from before it was stored
+    if isinstance(cached, tuple) and cached[0] == key: return cached[1]
+    print("{} built from another embedding, rebuilding".format(path))
+  if hp.emb_quant == 'int8':
+    quant = quantize_int8(emb)
+  else:
+    quant = quantize_pq(emb, hp.pq_subspaces, hp.pq_centroids)
+  pickle.dump((key, quant), open(path, "wb"), protocol=4)
+  return quant
+
+def embedding_key(emb, params):
+  """ sha1 of the matrix, its dtype and shape, and the quantization params """
+  emb = np.ascontiguousarray(emb)
+  h = hashlib.sha1(repr((emb.dtype.str, emb.shape, params)).encode())
+  h.update(memoryview(emb).cast('B'))
+  return h.hexdigest()
+
+def relative_error(emb, quant):
+  """ Squared reconstruction error relative to the squared norm of the rows """
+  err = 0.
+  for start in range(0, len(emb), 2**16):
+    ids = np.arange(start, min(start + 2**16, len(emb)))
+    err += ((emb[ids] - quant.decode(ids))**2).sum()
+  return err / max((emb.astype(np.float64)**2).sum(), 1e-12)
+
+if __name__=="__main__":
+  # Tool imports here, the models import this module. Quantized embeddings
+  # come from the module, not __main__, to match its class in the models
+  import copy
+  from quant import quantized_embedding, relative_error
+  from utils import HParams, load_saved_model, session_config, load_trigger_data
+  from utils import load_data
+  from call_model import compression_scores
+  hp = HParams()
+  if hp.triggers is not None:
+    emb, word_idx_map, data, postag_size, extra = load_trigger_data(hp, load_data)
+  else:
+    emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
+    extra = None
+
+  report = []
+  for method in [None] + ([hp.emb_quant] if hp.emb_quant else ['int8', 'pq']):
+    run_hp = copy.deepcopy(hp)
+    run_hp.update('emb_quant', method)
+    run_emb = emb if method is None else quantized_embedding(run_hp, emb)
+    sess, model, model_hp, _ = load_saved_model(run_emb, run_hp, postag_size,
+                                        hp.ckpt_name, session_config(hp))
+    with sess.graph.as_default():
+      row = compression_scores(model_hp, sess, model, data, extra)
+    sess.close()
+    row.update(method=method or 'float', emb_mb=run_emb.nbytes / 2**20,
+        rel_err=0. if method is None else relative_error(emb, run_emb))
+    report.append(row)
+
+  print("{:>6} {:>8} {:>8} {:>8} {:>8} {:>12}".format(
+          'emb', 'MB', 'rel err', 'va', 'te', 'samples/sec'))
+  for row in report:
+    print("{:>6} {:>8.1f} {:>8.4f} {:>8.4f} {:>8.4f} {:>12.0f}".format(
+          row['method'], row['emb_mb'], row['rel_err'], row['va_acc'],
+          row['te_acc'], row['samples_sec']))
@@ -0,0 +1,113 @@
+# Bulk scoring of sharded corpora with a pool of worker processes
+#
+# Each input shard is an npz with `x` word ids [N, max_seq_len], `postags`
+# [N, max_seq_len], `x_len` [N] and, for models with extra inputs such as
+# MultiTrigger, `extra0`, `extra1`... Each output shard has the same name in
+# --score_out with columns `y_pred`, `y_prob` and, with --score_attn, `attn`.
+# Finished shards are skipped, so an interrupted run is resumed by rerunning
+# the same command:
+# python score.py --ckpt_name giga_again --data_dir ... --pickle ... --score_in shards/ --score_out scored/
+import os, glob, time
+from multiprocessing import Pool
+import tensorflow as tf
+import numpy as np
+from utils import HParams, load_saved_model, load_data, eval_batch_size
+from cache import PredictionCache, checkpoint_id
+from quant import quantized_embedding
+
+# Session and model of this worker process, set by init_worker
+worker = {}
+
+def init_worker(hp, emb, postag_size):
+  """ Load the checkpoint once per process, with bounded intra op threads """
+  config = tf.ConfigProto(intra_op_parallelism_threads=hp.worker_threads,
+                          inter_op_parallelism_threads=1)
+  sess, model, model_hp, _ = load_saved_model(emb, hp, postag_size,
+                                                    hp.ckpt_name, config)
+  fetch = {'y_pred': model.y_pred, 'y_prob': model.y_prob}
+  if hp.score_attn:
+    if getattr(model, 'attn_over_attn', None) is None:
+      raise ValueError("--score_attn needs an attn over attn head")
+    fetch['attn'] = model.attn_over_attn
+  # Duplicate sentences in the corpus are scored once per worker
+  cache = None
+  if hp.cache_mb > 0:
+    cache = PredictionCache(checkpoint_id(hp) + ':' + ','.join(sorted(fetch)),
+                                                          hp.cache_mb*2**20)
+  worker.update(sess=sess, model=model, fetch=fetch, cache=cache,
+                batch_size=eval_batch_size(model_hp))
+
+def score_arrays(sess, model, fetch, batch_size, x, postags, x_len, extra=(),
+                                                                  cache=None):
+  """ Run `fetch` dict over all samples, returns a dict of stacked columns """
+  names = sorted(fetch)
+  cols = {k: [] for k in names}
+  run = lambda batch: run_fetch(sess, model, [fetch[k] for k in names], batch)
+  for start in range(0, len(x), batch_size):
+    end = start + batch_size
+    # Laid out like make_batches batches, labels are not needed
+    batch = (x[start:end], postags[start:end], x_len[start:end],
+          np.zeros(len(x[start:end]))) + tuple(e[start:end] for e in extra)
+    result = run(batch) if cache is None else cache.run(batch, run)
+    for k, r in zip(names, result):
+      cols[k].append(r)
+  return {k: np.concatenate(v) for k, v in cols.items()}
+
+def run_fetch(sess, model, fetch, batch):
+  feed = {
+           model.keep_prob        : 1,
+           model.rnn_in_keep_prob : 1,
+           model.mode             : 0,
+           model.inputs           : batch[0],
+           model.postags          : batch[1],
+           model.input_len        : batch[2]
+         }
+  for placeholder, e in zip(getattr(model, 'extra_inputs', []), batch[4:]):
+    feed[placeholder] = e
+  return sess.run(fetch, feed)
+
+def score_shard(paths):
+  """ Score one input shard, output written under a temp name then renamed """
+  in_path, out_path = paths
+  t1 = time.time()
+  shard = np.load(in_path)
+  extra = [shard[k] for k in sorted(k for k in shard.files
+                                      if k.startswith('extra'))]
+  cols = score_arrays(worker['sess'], worker['model'], worker['fetch'],
+                      worker['batch_size'], shard['x'], shard['postags'],
+                      shard['x_len'], extra, worker['cache'])
+  tmp_path = out_path + ".tmp"
+  with open(tmp_path, "wb") as f: np.savez(f, **cols)
+  os.replace(tmp_path, out_path)
+  return out_path, len(shard['x']), time.time() - t1
+
+def pending_shards(in_dir, out_dir):
+  """ (input, output) paths of shards without a finished output """
+  shards = []
+  for in_path in sorted(glob.glob(os.path.join(in_dir, "*.npz"))):
+    out_path = os.path.join(out_dir, os.path.basename(in_path))
+    if not os.path.exists(out_path): shards.append((in_path, out_path))
+  return shards
+
+if __name__=="__main__":
+  hp = HParams()
+  if hp.score_in is None or hp.score_out is None:
+    raise ValueError("Set --score_in and --score_out")
+  if not os.path.exists(hp.score_out): os.makedirs(hp.score_out)
+  todo = pending_shards(hp.score_in, hp.score_out)
+  print("{} shards to score".format(len(todo)))
+
+  # Embedding and POS tag size to build the model, shared by forked workers
+  emb, word_idx_map, data, postag_size = load_data(hp.data_dir, hp.pickle, tagged=hp.postags)
+  del data
+  if hp.emb_quant is not None:
+    emb = quantized_embedding(hp, emb)
+  workers = hp.workers or max(1, os.cpu_count() // hp.worker_threads)
+
+  total, t1 = 0, time.time()
+  with Pool(workers, initializer=init_worker,
+                                initargs=(hp, emb, postag_size)) as pool:
+    for i, (out_path, n, sec) in enumerate(pool.imap_unordered(score_shard, todo)):
+      total += n
+      print("{}/{} {}: {} samples in {:.1f} sec, {:.0f} samples/sec overall"
+            .format(i+1, len(todo), out_path, n, sec, total/(time.time()-t1)))
@@ -0,0 +1,38 @@
+# Shared fixtures. Modules are imported from the repo root, tests that build
+# graphs skip without tensorflow
+import os, sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture
+def make_hp(tmp_path, monkeypatch):
+  """ HParams of the defaults, not of the test runner's argv, in a temp dir """
+  from utils import HParams
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(sys, 'argv', ['test'])
+  def make(**overrides):
+    hp = HParams()
+    hp.update('ckpt_dir', str(tmp_path / 'ckpt'))
+    for k, v in overrides.items():
+      hp.update(k, v)
+    return hp
+  return make
+
+@pytest.fixture
+def tiny_data():
+  """ Random dataset in the layout of load_data: emb, data of 13 arrays """
+  import numpy as np
+  def make(n=32, max_seq_len=10, vocab=20, emb_size=8, seed=0):
+    rnd = np.random.RandomState(seed)
+    emb = rnd.randn(vocab, emb_size).astype(np.float32)
+    data = []
+    for _ in range(3):
+      x_len = rnd.randint(2, max_seq_len + 1, n).astype(np.int32)
+      x = rnd.randint(2, vocab, (n, max_seq_len)).astype(np.int32)
+      x[np.arange(max_seq_len)[None, :] >= x_len[:, None]] = 0
+      data += [x, np.zeros_like(x), x_len, rnd.randint(0, 2, n)]
+    data.append(np.array(['x'] * n))
+    return emb, tuple(data)
+  return make
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import model
+import np_model
+
+
+def run(t):
+  with tf.Session() as sess:
+    return sess.run(t)
+
+
+def encoder_outputs(batch=3, time=8, units=5, seed=0):
+  rng = np.random.RandomState(seed)
+  h = rng.randn(batch, time, units).astype(np.float32)
+  h[1, 5:] = 0 # zero outputs past seq_len
+  return h
+
+
+def test_fused_attn_attn_matches_full_and_numpy():
+  h = encoder_outputs()
+  with tf.Graph().as_default():
+    rnn_h = tf.constant(h)
+    p_w = tf.matmul(rnn_h, rnn_h, transpose_b=True)
+    col_attn, row_attn = model.RNN_base.attn_matrices(None, p_w, None, None)
+    full = model.RNN_base.attn_attn(None, col_attn, row_attn)
+    fused = model.RNN_base.fused_attn_attn(None, rnn_h)
+    full, fused = run([full, fused])
+  np.testing.assert_allclose(fused, full, rtol=1e-5, atol=1e-6)
+  np.testing.assert_allclose(np_model.attn_over_attn(h), fused, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('k', [1, 5, 8])
+def test_pruned_attn_attn_closed_form(monkeypatch, k):
+  # Kept tokens first, then zero outputs up to max_seq_len. A sample keeping
+  # less than k has zero slots among the first k too
+  h = encoder_outputs(time=8)
+  h[:, k:] = 0
+  h[2, max(k - 2, 0):] = 0
+  monkeypatch.setattr(model, 'hp', type('HP', (), {'max_seq_len': 8}), raising=False)
+  with tf.Graph().as_default():
+    pruned = run(model.RNN_base.pruned_attn_attn(None, tf.constant(h[:, :k]), k))
+  np.testing.assert_allclose(pruned, np_model.attn_over_attn(h)[:, :k],
+                             rtol=1e-5, atol=1e-6)
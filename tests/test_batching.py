@@ -0,0 +1,42 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+from numpy.random import RandomState
+from utils import bucket_batches
+
+
+def test_bucket_batches_one_bucket_per_batch():
+  x_len = RandomState(0).randint(1, 20, 100)
+  indices = RandomState(1).permutation(100)
+  batches = bucket_batches(indices, x_len, 8, [5, 10])
+  # Every sample once, batches within one bucket and at most batch_size
+  np.testing.assert_array_equal(np.sort(np.concatenate(batches)), np.arange(100))
+  for b in batches:
+    assert 0 < len(b) <= 8
+    assert len(set(np.digitize(x_len[b], [5, 10]))) == 1
+  # Order within a bucket is the order of `indices`
+  flat = np.concatenate(batches)
+  for bucket in range(3):
+    mine = flat[np.digitize(x_len[flat], [5, 10]) == bucket]
+    np.testing.assert_array_equal(mine, indices[np.digitize(x_len[indices], [5, 10]) == bucket])
+
+
+def test_bucket_batches_shuffled_batch_order():
+  x_len = RandomState(0).randint(1, 20, 100)
+  plain = bucket_batches(np.arange(100), x_len, 8, [10])
+  shuffled = bucket_batches(np.arange(100), x_len, 8, [10], RandomState(2))
+  key = lambda bs: sorted(tuple(b) for b in bs)
+  assert key(plain) == key(shuffled)
+  assert [tuple(b) for b in plain] != [tuple(b) for b in shuffled]
+
+
+def test_tuned_file_leaves_training_alone(make_hp, tmp_path):
+  with open(tmp_path / 'autotune.json', 'w') as f:
+    json.dump({'buckets': [10, 20], 'batch_size': 512, 'eval_buckets': [10],
+               'eval_batch_size': 256, 'intra_threads': 2}, f)
+  hp = make_hp()
+  assert hp.buckets is None and hp.batch_size != 512
+  assert hp.eval_buckets == [10] and hp.eval_batch_size == 256
+  assert hp.intra_threads == 2
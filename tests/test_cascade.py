@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+from call_model import calibrate_threshold, margin
+
+
+def cascade(cheap_prob, cheap_pred, exp_pred, y_true, threshold):
+  """ Accuracy and routed fraction of the cascade at `threshold` """
+  routed = margin(cheap_prob) < threshold
+  pred = np.where(routed, exp_pred, cheap_pred)
+  return (pred == y_true).mean(), routed.mean()
+
+
+def predictions(n=200, seed=0):
+  rnd = np.random.RandomState(seed)
+  p = rnd.rand(n)
+  # Rounded so margins tie
+  cheap_prob = np.round(np.stack([p, 1 - p], axis=1), 2)
+  y_true = rnd.randint(0, 2, n)
+  cheap_pred = cheap_prob.argmax(axis=1)
+  # Cheap right on confident samples, expensive right more often
+  cheap_pred = np.where(margin(cheap_prob) > 0.6, y_true, cheap_pred)
+  exp_pred = np.where(rnd.rand(n) < 0.9, y_true, 1 - y_true)
+  return cheap_prob, cheap_pred, exp_pred, y_true
+
+
+@pytest.mark.parametrize('max_loss', [0., 0.01, 0.05, 1.])
+def test_fewest_routed_within_max_loss(max_loss):
+  preds = predictions()
+  threshold, frac = calibrate_threshold(*preds, max_loss=max_loss)
+  acc, routed = cascade(*preds, threshold)
+  exp_acc = (preds[2] == preds[3]).mean()
+  assert routed == frac
+  assert exp_acc - acc <= max_loss + 1e-12
+  # No threshold routing fewer samples meets the bound
+  for t in np.unique(margin(preds[0])):
+    acc_t, routed_t = cascade(*preds, t)
+    if routed_t < frac:
+      assert exp_acc - acc_t > max_loss
+
+
+def test_no_loss_allowed_when_cheap_is_worse_everywhere():
+  cheap_prob = np.array([[0.6, 0.4], [0.9, 0.1], [0.7, 0.3]])
+  y_true = np.array([1, 1, 1])
+  threshold, frac = calibrate_threshold(cheap_prob, np.zeros(3, int), y_true,
+                                        y_true, max_loss=0.)
+  assert frac == 1. and threshold == np.inf
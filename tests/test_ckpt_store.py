@@ -0,0 +1,77 @@
+import os, time
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+from ckpt_store import CheckpointStore, same_variables, manifest_keys
+
+
+def save_checkpoint(directory, seed):
+  """ save_model's layout: variables, meta graph and an hp pickle """
+  os.makedirs(directory, exist_ok=True)
+  rnd = np.random.RandomState(seed)
+  with tf.Graph().as_default(), tf.Session() as sess:
+    tf.Variable(rnd.randn(300, 40).astype(np.float32), name='dense/weights')
+    tf.Variable(np.arange(5), name='global_step')
+    # Constant big enough to be cut out of the meta graph
+    tf.constant(np.ones((200, 100), np.float32), name='embedding')
+    sess.run(tf.global_variables_initializer())
+    prefix = tf.train.Saver().save(sess, os.path.join(directory, 'model.ckpt'))
+  with open(os.path.join(directory, 'hp.pkl'), 'wb') as f: f.write(b'hp %d' % seed)
+  return prefix
+
+
+def test_put_extract_round_trip(tmp_path):
+  prefix = save_checkpoint(str(tmp_path / 'a'), seed=0)
+  store = CheckpointStore(str(tmp_path / 'store'))
+  store.put('a', str(tmp_path / 'a'))
+  out = tmp_path / 'out'
+  out.mkdir()
+  extracted = store.extract('a', str(out))
+  assert same_variables(prefix, extracted)
+  assert (out / 'hp.pkl').read_bytes() == (tmp_path / 'a' / 'hp.pkl').read_bytes()
+  meta = tf.MetaGraphDef()
+  meta.ParseFromString((out / 'model.ckpt.meta').read_bytes())
+  expected = tf.MetaGraphDef()
+  expected.ParseFromString((tmp_path / 'a' / 'model.ckpt.meta').read_bytes())
+  assert meta == expected
+  # The same checkpoint again writes no new chunk
+  written = store.written
+  store.put('b', str(tmp_path / 'a'))
+  assert store.written == written
+
+
+def age(store, keys, seconds):
+  for key in keys:
+    path = store.chunk_path(key)
+    t = os.path.getmtime(path) - seconds
+    os.utime(path, (t, t))
+
+
+def test_overwrite_keeps_recent_chunks(tmp_path):
+  store = CheckpointStore(str(tmp_path / 'store'))
+  save_checkpoint(str(tmp_path / 'a'), seed=0)
+  old = manifest_keys(store.put('a', str(tmp_path / 'a')))
+  save_checkpoint(str(tmp_path / 'b'), seed=1)
+  # Old chunks of a, written just now, may be reused by a concurrent put
+  new = manifest_keys(store.put('a', str(tmp_path / 'b')))
+  dropped = old - new
+  assert dropped and all(os.path.exists(store.chunk_path(k)) for k in dropped)
+  assert store.gc() == 0
+  age(store, dropped, 2 * 3600)
+  assert store.gc() > 0
+  assert not any(os.path.exists(store.chunk_path(k)) for k in dropped)
+  assert all(os.path.exists(store.chunk_path(k)) for k in new)
+
+
+def test_put_touches_reused_chunks(tmp_path):
+  store = CheckpointStore(str(tmp_path / 'store'))
+  save_checkpoint(str(tmp_path / 'a'), seed=0)
+  keys = manifest_keys(store.put('a', str(tmp_path / 'a')))
+  age(store, keys, 2 * 3600)
+  # Reused by another put: removing a keeps them
+  store.put_bytes(open(str(tmp_path / 'a' / 'hp.pkl'), 'rb').read())
+  store.remove('a')
+  left = [k for k in keys if os.path.exists(store.chunk_path(k))]
+  assert len(left) == 1
+  assert time.time() - os.path.getmtime(store.chunk_path(left[0])) < 60
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+from compress import variable_shapes, choose_ranks
+from export import export_weights, check_parity
+from utils import load_model
+
+
+def test_compressed_model_parity(make_hp, tiny_data, tmp_path):
+  emb, data = tiny_data()
+  hp = make_hp(model='AttnAttnSum', max_seq_len=10, cell_units=8, fc_units=8,
+               h_layers=1, word_gate=True)
+  hp.update('low_rank', choose_ranks(variable_shapes(hp, emb, 0), 0.25, hp.cell_type))
+  assert any(scope.endswith('lstm_cell') for scope in hp.low_rank)
+  assert 'word_gate' in hp.low_rank and 'h_sum' in hp.low_rank
+  path = str(tmp_path / 'weights.npz')
+  with tf.Graph().as_default(), tf.Session() as sess:
+    model, _, _, _ = load_model(sess, emb, hp, 0)
+    export_weights(sess, model, hp, 0, path)
+    diff = check_parity(sess, model, path, *data[8:11])
+  assert any(k.endswith('weights_u') for k in np.load(path).files)
+  assert diff < 1e-5
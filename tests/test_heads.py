@@ -0,0 +1,24 @@
+import pytest
+tf = pytest.importorskip("tensorflow")
+import model
+
+def test_default_heads_registered():
+  for cls in [model.RNN_base, model.PairWiseAttn, model.AttnAttn,
+              model.AttnAttnSum, model.ConvAttn, model.ConvAttn2]:
+    builder, attn = model.get_head(cls.head)
+    assert attn in (None, 'aoa', 'full')
+
+def test_unknown_head():
+  with pytest.raises(ValueError):
+    model.get_head('no_such_head')
+
+@pytest.mark.parametrize('head', ['mean_pool', 'attn_attn', 'attn_sum'])
+def test_only_selected_head_built(make_hp, tiny_data, head):
+  emb, _ = tiny_data()
+  hp = make_hp(head=head, max_seq_len=10, cell_units=8, fc_units=8)
+  with tf.Graph().as_default():
+    m = model.RNN_base(hp, emb, 0)
+    assert m.head_name == head
+    scopes = set(v.op.name.split('/')[0] for v in tf.trainable_variables())
+    # Conv heads read the full attention, none of them is built
+    assert 'col_conv' not in scopes and 'row_conv' not in scopes
@@ -0,0 +1,83 @@
+import json
+import numpy as np
+import pytest
+
+from np_model import NumpyModel
+
+HP = {'head': 'attn_sum', 'cell_type': 'LSTMCell', 'parallel': False,
+      'postags': False, 'birnn': False, 'word_gate': False, 'h_layers': 0}
+
+
+def save(path, hp, **weights):
+  np.savez(path, __hp__=np.array(json.dumps(hp)), **weights)
+  return path
+
+
+@pytest.mark.parametrize("hp", [dict(HP, head=None), dict(HP, head='col_conv'),
+                                dict(HP, cell_type='GRUCell'),
+                                dict(HP, prune_tokens=True)])
+def test_unsupported_models_rejected(tmp_path, hp):
+  with pytest.raises(ValueError):
+    NumpyModel(save(tmp_path / 'w.npz', hp))
+
+
+def test_per_trigger_output_layer_rejected(tmp_path):
+  # MultiTrigger's class_log has weights per trigger
+  path = save(tmp_path / 'w.npz', HP, **{
+      'class_log_sum/weights': np.zeros((3, 4, 2), np.float32),
+      'class_log_sum/biases': np.zeros((3, 2), np.float32)})
+  with pytest.raises(ValueError):
+    NumpyModel(path)
+
+
+def test_attn_over_attn_matches_both_softmaxes():
+  # The full path of model.attn_matrices and attn_attn: softmax over each
+  # dimension of p_w, no symmetry shortcut
+  from np_model import attn_over_attn, softmax
+  rng = np.random.RandomState(0)
+  h = rng.randn(3, 7, 5).astype(np.float32)
+  h[0, 4:] = 0 # zero outputs past seq_len
+  p_w = np.matmul(h, h.transpose(0, 2, 1))
+  col_attn, row_attn = softmax(p_w, axis=1), softmax(p_w, axis=2)
+  expected = np.einsum('ajk,ak->aj', col_attn, row_attn.mean(axis=1))
+  np.testing.assert_allclose(attn_over_attn(h), expected, rtol=1e-5, atol=1e-6)
+  np.testing.assert_allclose(attn_over_attn(h).sum(axis=1), 1, rtol=1e-5)
+
+
+def attn_sum_weights(rnd, vocab=12, emb=6, units=4, classes=2):
+  return {
+      'embedding': rnd.randn(vocab, emb).astype(np.float32),
+      'unidirectionalRNN/rnn/lstm_cell/kernel': rnd.randn(emb + units, 4 * units).astype(np.float32),
+      'unidirectionalRNN/rnn/lstm_cell/bias': rnd.randn(4 * units).astype(np.float32),
+      'word_gate/weights': rnd.randn(emb, units).astype(np.float32),
+      'word_gate/biases': rnd.randn(units).astype(np.float32),
+      'h_sum/weights': rnd.randn(units, 5).astype(np.float32),
+      'h_sum/biases': rnd.randn(5).astype(np.float32),
+      'class_log_sum/weights': rnd.randn(5, classes).astype(np.float32),
+      'class_log_sum/biases': rnd.randn(classes).astype(np.float32)}
+
+
+def test_low_rank_weights_multiplied_back(tmp_path):
+  rnd = np.random.RandomState(0)
+  hp = dict(HP, word_gate=True)
+  low = attn_sum_weights(rnd)
+  # Factors of compress.py in place of the weights of each layer
+  for scope, rank in [('word_gate', 2), ('h_sum', 2)]:
+    w = low.pop(scope + '/weights')
+    low[scope + '/weights_u'] = rnd.randn(w.shape[0], rank).astype(np.float32)
+    low[scope + '/weights_v'] = rnd.randn(rank, w.shape[1]).astype(np.float32)
+  cell = 'unidirectionalRNN/rnn/lstm_cell/kernel'
+  k = low.pop(cell)
+  low[cell + '_u'] = rnd.randn(k.shape[0], 3).astype(np.float32)
+  low[cell + '_v'] = rnd.randn(3, k.shape[1]).astype(np.float32)
+  full = {k: v for k, v in low.items() if not k.endswith(('_u', '_v'))}
+  for name in ['word_gate/weights', 'h_sum/weights', cell]:
+    full[name] = low[name + '_u'].dot(low[name + '_v'])
+
+  x = rnd.randint(1, 12, (4, 7))
+  x_len = np.array([7, 5, 3, 1])
+  x[np.arange(7)[None, :] >= x_len[:, None]] = 0
+  tags = np.zeros_like(x)
+  p_low = NumpyModel(save(tmp_path / 'low.npz', hp, **low)).predict(x, tags, x_len)
+  p_full = NumpyModel(save(tmp_path / 'full.npz', hp, **full)).predict(x, tags, x_len)
+  np.testing.assert_allclose(p_low, p_full, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+import quant
+
+
+def test_cache_keyed_on_embedding_and_params(make_hp, tmp_path, monkeypatch):
+  hp = make_hp(emb_quant='int8', pickle=str(tmp_path / 'processed.pkl'))
+  emb = np.random.RandomState(0).randn(50, 8).astype(np.float32)
+  built = []
+  int8 = quant.quantize_int8
+  monkeypatch.setattr(quant, 'quantize_int8', lambda e: built.append(1) or int8(e))
+  first = quant.quantized_embedding(hp, emb)
+  again = quant.quantized_embedding(hp, emb.copy())
+  assert len(built) == 1
+  np.testing.assert_array_equal(first.codes, again.codes)
+  # Same shape, other values: rebuilt, not the stale codes
+  other = emb[::-1].copy()
+  codes = quant.quantized_embedding(hp, other).codes
+  assert len(built) == 2
+  np.testing.assert_array_equal(codes, int8(other).codes)
+
+
+def test_embedding_key():
+  emb = np.arange(12, dtype=np.float32).reshape(3, 4)
+  key = quant.embedding_key(emb, ('int8',))
+  assert key == quant.embedding_key(np.asfortranarray(emb), ('int8',))
+  assert key != quant.embedding_key(emb, ('pq', 0, 256))
+  assert key != quant.embedding_key(emb.reshape(4, 3), ('int8',))
+  assert key != quant.embedding_key(emb.astype(np.float64), ('int8',))
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+import call_model
+from utils import make_batches, load_model, BalancedSampler
+
+
+def batches(data, **kwargs):
+  x, tags, x_len, y = data[:4]
+  return list(make_batches(x, tags, x_len, y, 5, seed=3, **kwargs))
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'buckets': [4, 7]}, {'shuffle': False},
+                                    {'extra': (np.arange(32),)}])
+def test_make_batches_start_skips_batches(tiny_data, kwargs):
+  _, data = tiny_data()
+  full, resumed = batches(data, **kwargs), batches(data, start=2, **kwargs)
+  assert len(resumed) == len(full) - 2
+  for a, b in zip(full[2:], resumed):
+    for x, y in zip(a, b):
+      np.testing.assert_array_equal(x, y)
+
+
+def test_make_batches_start_with_sampler(tiny_data):
+  _, data = tiny_data()
+  sampler = BalancedSampler(data[3])
+  full = batches(data, sampler=sampler)
+  resumed = batches(data, sampler=sampler, start=3)
+  np.testing.assert_array_equal(np.concatenate([b[2] for b in full[3:]]),
+                                np.concatenate([b[2] for b in resumed]))
+
+
+class Killed(Exception):
+  pass
+
+
+def train(hp, emb, data, monkeypatch, kill_at=None):
+  """
+  train_model in a new graph, trainable weights at the end. Killed at the
+  training batch `kill_at` if set
+  """
+  run, steps = call_model.call_model, []
+  def killing(sess, model, batch, fetch, keep_prob, rnn_keep_prob, mode, **kw):
+    if mode == 1:
+      steps.append(1)
+      if len(steps) == kill_at: raise Killed()
+    return run(sess, model, batch, fetch, keep_prob, rnn_keep_prob, mode, **kw)
+  config = tf.ConfigProto(intra_op_parallelism_threads=1,
+                          inter_op_parallelism_threads=1)
+  with monkeypatch.context() as m, tf.Graph().as_default(), \
+                                          tf.Session(config=config) as sess:
+    m.setattr(call_model, 'call_model', killing)
+    tf.set_random_seed(hp.seed)
+    model, saver, hp, result = load_model(sess, emb, hp, 0)
+    try:
+      call_model.train_model(hp, sess, saver, model, result, data)
+    except Killed:
+      return None
+    return {v.op.name: sess.run(v) for v in tf.trainable_variables()}
+
+
+@pytest.mark.parametrize('accum_steps', [1, 2])
+def test_resumed_run_matches_uninterrupted(make_hp, tiny_data, monkeypatch, accum_steps):
+  emb, data = tiny_data()
+  flags = dict(model='AttnAttnSum', max_seq_len=10, cell_units=8, fc_units=8,
+               batch_size=4, max_epochs=2, eval_every=10**6, latest_every=2,
+               keep_prob=0.5, rnn_in_keep_prob=0.5, word_gate=True,
+               accum_steps=accum_steps)
+  expected = train(make_hp(ckpt_name='full', **flags), emb, data, monkeypatch)
+  # Killed a few batches past a latest checkpoint, mid update with accum_steps
+  kill_at = 4 * accum_steps + 3
+  assert train(make_hp(ckpt_name='run', **flags), emb, data, monkeypatch,
+                                                            kill_at) is None
+  resumed = train(make_hp(ckpt_name='run', resume=True, **flags), emb, data,
+                                                            monkeypatch)
+  assert sorted(resumed) == sorted(expected)
+  for name in expected:
+    np.testing.assert_array_equal(resumed[name], expected[name], err_msg=name)
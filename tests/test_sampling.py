@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+from utils import stratified_subsample
+
+
+def test_stratified_subsample_keeps_class_shares():
+  y = np.array([0] * 90 + [1] * 10)
+  idx = stratified_subsample(y, 0.2, seed=3)
+  assert np.all(np.diff(idx) > 0)
+  np.testing.assert_array_equal(np.bincount(y[idx]), [18, 2])
+  np.testing.assert_array_equal(idx, stratified_subsample(y, 0.2, seed=3))
+
+
+def test_stratified_subsample_keeps_rare_classes():
+  y = np.array([0] * 200 + [1, 2])
+  idx = stratified_subsample(y, 0.01)
+  np.testing.assert_array_equal(np.bincount(y[idx]), [2, 1, 1])
+
+
+def test_balanced_sampler_ratio_and_repeatable():
+  from utils import BalancedSampler
+  y = np.array([0] * 90 + [1] * 10)
+  sampler = BalancedSampler(y, ratio=[1, 3], epoch_size=40)
+  counts = sampler.class_counts()
+  np.testing.assert_array_equal(counts, [10, 30])
+  epoch = sampler.epoch(5)
+  np.testing.assert_array_equal(np.bincount(y[epoch]), counts)
+  np.testing.assert_array_equal(epoch, sampler.epoch(5))
+  assert not np.array_equal(epoch, sampler.epoch(6))
+
+
+def test_balanced_sampler_cycles_minority_without_replacement():
+  from utils import BalancedSampler
+  y = np.array([0] * 90 + [1] * 10)
+  epoch = BalancedSampler(y).epoch(0)
+  assert len(epoch) == 100
+  minority = epoch[y[epoch] == 1]
+  # 50 draws of 10 samples: whole shuffled passes, each sample 5 times
+  np.testing.assert_array_equal(np.bincount(minority)[90:], [5] * 10)
+  majority = epoch[y[epoch] == 0]
+  assert len(np.unique(majority)) == 50
+
+
+def test_balanced_sampler_counts_sum_to_epoch_size():
+  from utils import BalancedSampler
+  sampler = BalancedSampler(np.array([0, 1, 2] * 5), epoch_size=16)
+  assert sampler.class_counts().sum() == 16
+  with pytest.raises(ValueError):
+    BalancedSampler(np.array([0, 1, 2]), ratio=[1, 1])
+
+
+def test_class_weights():
+  from utils import class_weights
+  y = np.array([0] * 30 + [1] * 10)
+  w = class_weights(y, 2)
+  # Weighted class totals are equal, the mean weight per sample is 1
+  assert w[0] * 30 == pytest.approx(w[1] * 10)
+  assert (w[0] * 30 + w[1] * 10) / 40 == pytest.approx(1)
+  with pytest.raises(ValueError):
+    class_weights(np.array([0, 0, 2]), 3)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+from utils import merge_trigger_data
+
+
+def dataset(words, tags, tag_rows):
+  """ One trigger's load_data output, all splits the same two samples """
+  emb = np.arange(len(words) + 1, dtype=np.float32)[:, None].repeat(2, 1)
+  w_map = {w: i + 1 for i, w in enumerate(words)}
+  t_map = {t: i + 1 for i, t in enumerate(tags)}
+  x = np.array([[1, 2, 0], [2, 1, 0]])
+  x_tags = np.array(tag_rows)
+  split = (x, x_tags, np.array([2, 2]), np.array([0, 1]))
+  return emb, w_map, split * 3 + (np.array([0, 1]),), len(t_map) + 1, t_map
+
+
+def test_tags_remapped_onto_merged_map():
+  a = dataset(['a', 'b'], ['NN', 'VB'], [[1, 2, 0], [2, 1, 0]])
+  # Same tags, other ids, and one new tag
+  b = dataset(['b', 'c'], ['JJ', 'NN', 'VB'], [[2, 3, 0], [1, 2, 0]])
+  emb, w_map, data, postag_size, (trT, _, _) = merge_trigger_data([a, b])
+  assert postag_size == 4
+  x, x_tags = data[0], data[1]
+  # NN=1, VB=2, JJ=3 in the merged map
+  np.testing.assert_array_equal(x_tags, [[1, 2, 0], [2, 1, 0], [1, 2, 0], [3, 1, 0]])
+  assert x[2, 0] == w_map['b'] and x[2, 1] == w_map['c']
+  np.testing.assert_array_equal(emb[x[:, 0]], emb[[w_map[w] for w in 'abbc']])
+  np.testing.assert_array_equal(trT, [0, 0, 1, 1])
+
+
+def test_mixed_tag_maps_rejected():
+  a = dataset(['a'], ['NN'], [[1, 1, 0], [1, 1, 0]])
+  b = a[:4] + (None,)
+  with pytest.raises(ValueError):
+    merge_trigger_data([a, b])
@@ -1,11 +1,13 @@
 # Author: Andre Cianflone
 from datetime import datetime
 from pprint import pformat, pprint
-import os, argparse, pickle, json, tarfile, copy, sys
+import os, argparse, pickle, json, tarfile, copy, sys, tempfile, shutil
 from pydoc import locate
 import tensorflow as tf
 import numpy as np
 from numpy.random import RandomState
+from model import ENCODER_SCOPES, ATTN_SCOPES, EMB_VARS
+from ckpt_store import CheckpointStore
 
 class Progress():
   """ Pretty print progress for neural net training """
@@ -33,14 +35,14 @@ class Progress():
   def train_end(self):
     print()
 
-  def print_train(self, loss):
+  def print_train(self, loss, batches=1):
     t2 = datetime.now()
     epoch_time = (t2 - self.t1).total_seconds()
     total_time = (t2 - self.train_start_time).total_seconds()/60
     self.last_train='{:2.0f}: sec: {:>5.0f} | total min: {:>5.1f} | train loss: {:>3.4f} '.format(
         self.epoch, epoch_time, total_time, loss)
     print(self.last_train, end='')
-    self.print_bar()
+    self.print_bar(batches)
     print(self.last_eval, end='\r')
 
   def print_cust(self, msg):
@@ -64,8 +66,17 @@ class Progress():
       self.last_eval += '| best val: {:>3.4f} | test on best model: {:>3.4f}'.format(self.best_val, self.test_val)
     print(self.last_eval, end='\r')
 
-  def print_bar(self):
-    self.current_batch += 1
+  def print_eval_heads(self, values, best_vals, test_vals):
+    """ Print last and best validation, test on best, for each head """
+    print(self.last_train, end='')
+    self.last_eval = ''
+    for name in values:
+      self.last_eval += '| {}: {:>3.4f} best {:>3.4f} test {:>3.4f} '.format(
+                        name, values[name], best_vals[name], test_vals[name])
+    print(self.last_eval, end='\r')
+
+  def print_bar(self, batches=1):
+    self.current_batch += batches
     bars_full = int(self.current_batch/self.batches*self.bar_length)
     bars_empty = self.bar_length - bars_full
     progress ="| [{}{}] ".format(u"\u2586"*bars_full, '-'*bars_empty)
@@ -79,20 +90,130 @@ def seq_length(sequence):
   length = tf.cast(length, tf.int32)
   return length
 
-def make_batches(x, postags, x_len, y, batch_size, shuffle=True, seed=0):
-  """ Yields the data object with all properties sliced """
+def make_batches(x, postags, x_len, y, batch_size, shuffle=True, seed=0,
+                              extra=(), start=0, buckets=None, sampler=None):
+  """
+  Yields the data object with all properties sliced. Arrays in `extra`, such
+  as trigger ids, are sliced the same way and appended to each batch. Batches
+  before `start` are skipped without slicing, the order is unchanged. With
+  `buckets` length boundaries, batches only hold samples of one bucket. A
+  `BalancedSampler` draws the epoch's samples instead of a plain shuffle
+  """
   y = one_hot(y)
-  data_size = len(x)
-  indices = np.arange(0, data_size)
-  num_batches = data_size//batch_size+(data_size%batch_size>0)
+  indices = np.arange(0, len(x))
+  rnd = None
   if shuffle:
     rnd = RandomState(seed) # repeatable shuffle
     rnd.shuffle(indices)
-  for batch_num in range(num_batches):
-    start_index = batch_num * batch_size
-    end_index = min((batch_num + 1) * batch_size, data_size)
-    new_indices = indices[start_index:end_index]
-    yield (x[new_indices], postags[new_indices], x_len[new_indices], y[new_indices])
+  if sampler is not None:
+    indices = sampler.epoch(seed)
+  data_size = len(indices)
+  num_batches = data_size//batch_size+(data_size%batch_size>0)
+  if buckets:
+    batches = bucket_batches(indices, x_len, batch_size, buckets, rnd)
+  else:
+    batches = [indices[i*batch_size:(i+1)*batch_size] for i in range(num_batches)]
+  for new_indices in batches[start:]:
+    yield (x[new_indices], postags[new_indices], x_len[new_indices], y[new_indices])\
+                                + tuple(e[new_indices] for e in extra)
+
+class BalancedSampler():
+  """
+  Draw an epoch of sample indices to a target class ratio, from per class
+  index arrays built once. Without replacement each class is walked in
+  shuffled passes, cycled if it must be oversampled
+  """
+  def __init__(self, y, ratio=None, replace=False, epoch_size=None):
+    self.classes = np.unique(y)
+    self.by_class = [np.where(y == c)[0] for c in self.classes]
+    ratio = np.ones(len(self.classes)) if ratio is None else np.asarray(ratio, float)
+    if len(ratio) != len(self.classes):
+      raise ValueError("Need one ratio per class, {}".format(len(self.classes)))
+    self.ratio = ratio / ratio.sum()
+    self.replace = replace
+    self.epoch_size = epoch_size or len(y)
+
+  def class_counts(self):
+    """ Samples of each class per epoch, summing to epoch_size """
+    counts = np.floor(self.ratio * self.epoch_size).astype(int)
+    counts[:self.epoch_size - counts.sum()] += 1
+    return counts
+
+  def epoch(self, seed):
+    """ Shuffled indices of one epoch, repeatable for a given `seed` """
+    rnd = RandomState(seed)
+    drawn = []
+    for members, count in zip(self.by_class, self.class_counts()):
+      if self.replace:
+        drawn.append(rnd.choice(members, count, replace=True))
+      else:
+        passes = -(-count // len(members))
+        cycle = np.concatenate([rnd.permutation(members) for _ in range(passes)])
+        drawn.append(cycle[:count])
+    indices = np.concatenate(drawn)
+    rnd.shuffle(indices)
+    return indices
+
+def class_weights(y, num_classes, ratio=None):
+  """
+  Loss weight of each of `num_classes` classes so the natural distribution of
+  `y` weighs like the target `ratio`, uniform by default
+  """
+  counts = np.bincount(y, minlength=num_classes).astype(float)
+  if len(counts) != num_classes:
+    raise ValueError("Labels above num_classes {}".format(num_classes))
+  if (counts == 0).any():
+    raise ValueError("No training sample of classes {}, can't reweight".format(
+                                            list(np.nonzero(counts == 0)[0])))
+  ratio = np.ones(num_classes) if ratio is None else np.asarray(ratio, float)
+  if len(ratio) != num_classes:
+    raise ValueError("balance_ratio needs {} values".format(num_classes))
+  return list(ratio / ratio.sum() * len(y) / counts)
+
+def bucket_batches(indices, x_len, batch_size, buckets, rnd=None):
+  """
+  Split `indices` in batches of samples from the same length bucket. The
+  dynamic RNN stops at the longest sequence of a batch, so less steps are
+  wasted on padding. Order within buckets is kept, batch order shuffled
+  with `rnd` if given
+  """
+  bucket = np.digitize(x_len[indices], buckets)
+  order = np.argsort(bucket, kind='mergesort')
+  indices, bucket = indices[order], bucket[order]
+  batches = []
+  for b in np.unique(bucket):
+    idx = indices[bucket == b]
+    batches += [idx[i:i+batch_size] for i in range(0, len(idx), batch_size)]
+  if rnd is not None:
+    batches = [batches[i] for i in rnd.permutation(len(batches))]
+  return batches
+
+def eval_batch_size(hp):
+  """ Batch size at inference, the training one unless tuned apart """
+  return getattr(hp, 'eval_batch_size', 0) or hp.batch_size
+
+def session_config(hp):
+  """ Session thread pools from hp, 0 leaves the TF default """
+  return tf.ConfigProto(
+            intra_op_parallelism_threads=getattr(hp, 'intra_threads', 0),
+            inter_op_parallelism_threads=getattr(hp, 'inter_threads', 0))
+
+def stratified_subsample(y, frac, seed=0):
+  """ Sorted indices of a fixed `frac` of every class of labels `y` """
+  rnd = RandomState(seed)
+  idx = []
+  for c in np.unique(y):
+    members = np.where(y == c)[0]
+    n = max(1, int(round(frac * len(members))))
+    idx.append(rnd.choice(members, n, replace=False))
+  return np.sort(np.concatenate(idx))
+
+def frequent_ids(x, top):
+  """ Ids of the `top` most frequent words in `x`, padding id 0 excluded """
+  counts = np.bincount(x.ravel())
+  counts[0] = 0
+  ids = np.argsort(-counts, kind='mergesort')[:top]
+  return np.sort(ids[counts[ids] > 0])
 
 def calc_num_batches(x, batch_size):
   """ Return number of batches for this set """
@@ -102,7 +223,8 @@ def calc_num_batches(x, batch_size):
 
 def one_hot(arr):
   """ One-hot encode, where values interpreted as index of non-zero column """
-  mat = np.zeros((arr.size, arr.max()+1))
+  # At least binary, a batch or subset may hold class 0 only
+  mat = np.zeros((arr.size, max(arr.max()+1, 2)))
   mat[np.arange(arr.size),arr] = 1
   return mat
 
@@ -113,6 +235,19 @@ def decoder_mask():
   np.repeat(d[:, :, np.newaxis], 2, axis=2)
 
 
+# Flags which only change how a model runs, not what it learned. They are
+# taken from the command line even when hyper params come from a checkpoint
+RUNTIME_ARGS = ['full_attn', 'attn_chunk', 'latest_every', 'resume',
+                      'cache_mb', 'cache_path', 'cascade_cheap', 'cascade_loss',
+                      'prune_tokens', 'prune_threshold', 'prune_curve',
+                      'eval_batch_size', 'intra_threads', 'inter_threads',
+                      'buckets', 'eval_buckets', 'stage_frac', 'stage_z', 'ckpt_store',
+                      'emb_quant', 'pq_subspaces', 'pq_centroids']
+
+# Flags autotune.py writes to --tuned, read as defaults. None of them changes
+# the batches a model is trained on
+TUNED_ARGS = ['intra_threads', 'inter_threads', 'eval_batch_size', 'eval_buckets']
+
 class HParams():
   def __init__(self):
     parser = argparse.ArgumentParser(description='Presupposition attention')
@@ -123,29 +258,147 @@ class HParams():
     add('--pickle', type=str, default="/home/rldata/new_presup_data/wsj_balanced/all/processed.pkl")
     # add('--pickle', type=str, default="processed_singleUnk.pkl")
     add('--model', type=str, default="AttnAttn")
+    add('--head', type=str, default=None,
+        help='classifier head from model.HEADS, overrides the model default')
+    # MultiHead model: heads over one encoder, summed or alternated losses
+    add('--heads', nargs='+', default=None)
+    add('--multi_loss', type=str, default='sum', help='sum or alternate')
+    # Replicas model: copies of one model with their own seeds in one graph
+    add('--replicas', type=int, default=0)
+    add('--replica_model', type=str, default='AttnAttnSum')
+    # MultiTrigger model: one dataset dir/pickle per trigger, merged corpus
+    add('--triggers', nargs='+', default=None)
+    add('--trigger_dirs', nargs='+', default=None)
+    add('--trigger_pickles', nargs='+', default=None)
+    add('--multi_pickle', type=str, default='multi_trigger.pkl')
     add('--load_saved', action='store_true', default=False)
+    # Warm start a new model from another checkpoint's matching variables
+    add('--warm_start', type=str, default=None, help='source ckpt_name')
+    add('--warm_policy', type=str, default='encoder',
+        help='encoder, encoder_attn or all')
+    add('--freeze_encoder_steps', type=int, default=0,
+        help='train all but the encoder for this many steps')
     add('--ckpt_dir', type=str, default='ckpt')
     add('--ckpt_name', type=str, default='ckpt')
+    # Save and load checkpoints in a deduplicated ckpt_store.py store
+    add('--ckpt_store', type=str, default=None, help='store dir, tars if unset')
     add('--mode', type=int, default=1, help='train: 1, test:0')
     add('--score', type=str, default='acc', help='accuracy or f1')
+    # Distillation: train on soft labels of this teacher checkpoint
+    add('--distill_from', type=str, default=None, help='teacher ckpt_name')
+    add('--distill_temp', type=float, default=2.0)
+    add('--distill_alpha', type=float, default=0.9, help='weight of soft loss')
+    add('--export_dir', type=str, default=None,
+        help='export the loaded model as SavedModel + numpy weights here')
+    # Bulk scoring with score.py: npz shards in, npz shards out
+    add('--score_in', type=str, default=None, help='dir of input npz shards')
+    add('--score_out', type=str, default=None, help='dir of output npz shards')
+    add('--score_attn', action='store_true', default=False,
+        help='also write the attn over attn vector of each sample')
+    add('--workers', type=int, default=0, help='0: cores / worker_threads')
+    add('--worker_threads', type=int, default=1, help='intra op threads')
+    # Raw text preprocessing with preprocess.py, into --data_dir and --pickle
+    add('--raw_dir', type=str, default=None, help='raw {train,valid,test}/*.txt')
+    add('--emb_path', type=str, default=None, help='text word vectors')
+    add('--remove_words', nargs='+', default=None, help='e.g. the triggers')
+    add('--neg_label', type=str, default='none', help='label of negatives')
+    add('--min_count', type=int, default=5,
+        help='random vector for words without one seen this often, else unk')
+    # Prediction cache for repeated inputs at test and scoring time
+    add('--cache_mb', type=int, default=0, help='memory budget, 0 no cache')
+    add('--cache_path', type=str, default=None, help='shelve file disk tier')
+    # Cascade: this cheap checkpoint scores everything, the loaded model only
+    # the samples with a low margin
+    add('--cascade_cheap', type=str, default=None, help='cheap ckpt_name')
+    add('--cascade_loss', type=float, default=0.005,
+        help='max validation accuracy lost against the expensive model')
 
     # Hyperparams
     add('--emb_trainable', action='store_true', default=False)
+    # Frozen embedding held as int8 or product quantization codes, see quant.py
+    add('--emb_quant', type=str, default=None, help='int8 or pq')
+    add('--pq_subspaces', type=int, default=0, help='0: a byte per 2 dims')
+    add('--pq_centroids', type=int, default=256)
+    # Sparse embedding updates: optimizer for the embedding only, e.g.
+    # LazyAdamOptimizer, and train only the N most frequent training words
+    add('--emb_optimizer', type=str, default=None)
+    add('--emb_train_top', type=int, default=0)
     add('--birnn', action='store_true', default=False)
     add('--parallel', action='store_true', default=False)
     add('--postags', action='store_true', default=False) # Add POS tags to network
     add('--batch_size', type=int, default=64)
+    # Class balance of the natural training split: sample batches to the
+    # ratio, or reweight the loss as if it were
+    add('--balance', type=str, default=None, help='sample or reweight')
+    add('--balance_ratio', nargs='+', type=float, default=None,
+        help='target share of each class, uniform by default')
+    add('--balance_replace', action='store_true', default=False)
+    # Throughput knobs, written to --tuned by autotune.py
+    add('--eval_batch_size', type=int, default=0, help='0: batch_size')
+    add('--intra_threads', type=int, default=0, help='0: TF default')
+    add('--inter_threads', type=int, default=0, help='0: TF default')
+    add('--buckets', nargs='+', type=int, default=None,
+        help='length boundaries, training batches hold samples of one bucket')
+    add('--eval_buckets', nargs='+', type=int, default=None,
+        help='length boundaries, inference runs grouped by bucket')
+    add('--tuned', type=str, default='autotune.json',
+        help='json of flag defaults from autotune.py, used if present')
+    add('--tune_for', type=str, default='eval', help='train or eval')
+    add('--tune_steps', type=int, default=20, help='timed batches per run')
+    add('--tune_max_rss', type=int, default=0, help='MB, 0 no limit')
     add('--max_seq_len', type=int, default=60)
     add('--max_epochs', type=int, default= 100)
     add('--early_stop', type=int, default= 10)
     add('--rnn_in_keep_prob', type=float, default=1.0)
     add('--word_gate', action='store_true', default=False)
+    # Build the full attn matrices for visualisation instead of the fused op
+    add('--full_attn', action='store_true', default=False)
+    # Tile size for chunked attention over long inputs, 0 for full matrices
+    add('--attn_chunk', type=int, default=0)
+    # Attn over the tokens whose mean word gate is >= threshold only, attn_sum
+    # head. --prune_curve scores the test set at each threshold
+    add('--prune_tokens', action='store_true', default=False)
+    add('--prune_threshold', type=float, default=0.0)
+    add('--prune_curve', nargs='+', type=float, default=None)
     # Variational recurrent: if true, same rnn drop mask at each step
     add('--variational_recurrent', action='store_true', default = False)
     add('--keep_prob', type=float, default=0.5)
+    # Graph seed of the initial weights, and of the stateless dropout masks
+    add('--seed', type=int, default=1)
     add('--eval_every', type=int, default=300)
+    # Staged validation: score a stratified fraction of the validation set
+    # first, the full set only if the upper confidence bound reaches the best
+    add('--stage_frac', type=float, default=0.0,
+        help='0: always full set, else needs --score acc')
+    add('--stage_z', type=float, default=2.58, help='z of the bound')
+    # Preemption: save a latest checkpoint every N steps, 0 never, and resume
+    # training from it
+    add('--latest_every', type=int, default=0)
+    add('--resume', action='store_true', default=False)
     add('--num_classes', type=int, default=2)
     add('--l_rate', type=float, default= 0.001)
+    # compress.py: fraction of hidden units and of kernel ranks kept, one
+    # checkpoint per level, and epochs of fine tuning of each
+    add('--compress_levels', nargs='+', type=float, default=[0.75, 0.5, 0.25])
+    add('--compress_methods', nargs='+', type=str, default=['units', 'low_rank'])
+    add('--compress_finetune', type=int, default=0)
+    # doc_score.py: sliding windows over the documents of a text file
+    add('--doc_in', type=str, default=None, help='one document per line')
+    add('--doc_out', type=str, default=None, help='json line per document')
+    add('--doc_stride', type=int, default=0, help='0: half max_seq_len')
+    add('--doc_batch', type=int, default=64, help='documents encoded at once')
+    add('--doc_stateless', action='store_true', default=False,
+        help='encode each window anew, no state carry')
+    # analytics.py: attn over attn statistics of a whole split in one pass
+    add('--analytics_split', type=str, default='test', choices=['train', 'valid', 'test'])
+    add('--analytics_out', type=str, default=None, help='directory of the tables')
+    add('--analytics_topk', type=int, default=20, help='examples kept per kind')
+    add('--analytics_min_count', type=int, default=20, help='rarer words left out')
+    # Large batches: sum gradients over N micro batches per update, scale the
+    # l_rate for it (none, linear or sqrt in N) and warm it up over M updates
+    add('--accum_steps', type=int, default=1)
+    add('--lr_scale', type=str, default='none')
+    add('--warmup_steps', type=int, default=0)
     add('--cell_units', type=int, default=128)
     add('--cell_type', type=str, default='LSTMCell')
     add('--optimizer', type=str, default='AdamOptimizer')
@@ -163,6 +416,14 @@ class HParams():
     add('--padding', type=str, default="VALID")
     add('--out_channels', type=int, default=32)
 
+    # Tuned values replace the defaults, the command line still wins. Only
+    # knobs which leave training batches unchanged are read
+    args, _ = parser.parse_known_args()
+    if args.tuned and os.path.exists(args.tuned):
+      with open(args.tuned) as f: tuned = json.load(f)
+      for k in sorted(set(tuned) - set(TUNED_ARGS)):
+        print("Ignored {} of {}, it changes training".format(k, args.tuned))
+      parser.set_defaults(**{k: v for k, v in tuned.items() if k in TUNED_ARGS})
     args = parser.parse_args()
     self._init_attributes(args)
 
@@ -176,6 +437,116 @@ class HParams():
   def __str__(self):
     return pformat(vars(self),indent=0)
 
+def merge_trigger_data(loaded):
+  """
+  Merge per trigger datasets into one corpus over a shared vocab and tag map.
+  Args:
+    loaded: list of (emb, word_idx_map, data, postag_size, tag_idx_map) as
+      returned by load_data with tag_map, one per trigger
+  Returns:
+    emb, word_idx_map, data, postag_size like load_data, plus
+    (trT, vaT, teT) the trigger index of every sample in each split
+  """
+  word_idx_map = {}
+  rows = [loaded[0][0][0]] # padding row
+  splits = [[[] for _ in range(4)] for _ in range(3)]
+  trig_ids = [[], [], []]
+  te_actual = []
+  tag_maps = [l[4] for l in loaded]
+  # Tag ids of each preprocess.py dataset are its own, CNN_sentence data has
+  # no tag map and its ids are taken as shared
+  if any(m is None for m in tag_maps) and not all(m is None for m in tag_maps):
+    raise ValueError("Can't merge datasets with and without a POS tag map")
+  merged_tags = {} if tag_maps[0] is not None else None
+  postag_size = 0
+  for t, (emb, w_map, data, tag_size, tag_map) in enumerate(loaded):
+    # Map this trigger's word ids to the merged ids, 0 stays padding
+    remap = np.zeros(len(emb), dtype=np.int64)
+    for word, idx in w_map.items():
+      if word not in word_idx_map:
+        word_idx_map[word] = len(rows)
+        rows.append(emb[idx])
+      remap[idx] = word_idx_map[word]
+    # Tag ids the same way, from 1 as in preprocess.py
+    tag_remap = None
+    if merged_tags is not None:
+      tag_remap = np.zeros(max(tag_map.values(), default=0) + 1, dtype=np.int64)
+      for tag, idx in sorted(tag_map.items(), key=lambda item: item[1]):
+        if tag not in merged_tags:
+          merged_tags[tag] = len(merged_tags) + 1
+        tag_remap[idx] = merged_tags[tag]
+    postag_size = max(postag_size, tag_size)
+
+    # Splits are (X, XTags, Xlen, Y) for train/valid/test, then teYActual
+    for i in range(3):
+      X, XTags, Xlen, Y = data[4*i:4*i+4]
+      if tag_remap is not None:
+        XTags = tag_remap[XTags]
+      for j, arr in enumerate([remap[X], XTags, Xlen, Y]):
+        splits[i][j].append(arr)
+      trig_ids[i].append(np.full(len(Y), t, dtype=np.int32))
+    te_actual.append(np.asarray(data[12]))
+
+  if merged_tags is not None and postag_size > 0:
+    postag_size = len(merged_tags) + 1
+  emb = np.asarray(rows, dtype=loaded[0][0].dtype)
+  data = []
+  for i in range(3):
+    data += [np.concatenate(arrs) for arrs in splits[i]]
+  data.append(np.concatenate(te_actual))
+  extra = tuple(np.concatenate(ids) for ids in trig_ids)
+  return emb, word_idx_map, tuple(data), postag_size, extra
+
+def load_data(data_dir, pickle_path, tagged=False, tag_map=False):
+  """
+  emb, word_idx_map, data, postag_size of a dataset, read by CNN_sentence if
+  installed, else by preprocess.py for data built by the in repo pipeline.
+  With `tag_map` the {tag: id} map follows, None for CNN_sentence data
+  """
+  try:
+    from CNN_sentence import load_data as load
+  except ImportError:
+    # Imported here, preprocess.py imports this module
+    from preprocess import load_data as load
+    return load(data_dir, pickle_path, tagged=tagged, tag_map=tag_map)
+  loaded = load(data_dir, pickle_path, tagged=tagged)
+  return loaded + (None,) if tag_map else loaded
+
+def load_trigger_data(hp, load_data):
+  """
+  Load the datasets of `hp.triggers` merged into one corpus, cached in
+  `hp.multi_pickle` along with the triggers and datasets it was built from,
+  rebuilt if those differ. Sets `hp.num_triggers`
+  Returns:
+    emb, word_idx_map, data, postag_size, and the per split extra arrays
+    ((trT,), (vaT,), (teT,)) for train_model
+  """
+  # The pickles hold the vocabs and tag maps, a regenerated one has another
+  # size or mtime
+  key = {'triggers': list(hp.triggers), 'trigger_dirs': list(hp.trigger_dirs),
+         'trigger_pickles': list(hp.trigger_pickles), 'postags': hp.postags,
+         'pickle_stats': [(os.path.getsize(p), os.path.getmtime(p))
+                                              for p in hp.trigger_pickles]}
+  cached = None
+  if os.path.exists(hp.multi_pickle):
+    cached = pickle.load(open(hp.multi_pickle, "rb"))
+    # Caches without their key are from before it was stored
+    if len(cached) != 6 or cached[5] != key:
+      print("{} built from other triggers or datasets, rebuilding".format(
+                                                            hp.multi_pickle))
+      cached = None
+  if cached is not None:
+    emb, word_idx_map, data, postag_size, trig_ids, _ = cached
+  else:
+    loaded = [load_data(d, p, tagged=hp.postags, tag_map=True)
+                      for d, p in zip(hp.trigger_dirs, hp.trigger_pickles)]
+    emb, word_idx_map, data, postag_size, trig_ids = merge_trigger_data(loaded)
+    pickle.dump((emb, word_idx_map, data, postag_size, trig_ids, key),
+                            open(hp.multi_pickle, "wb"), protocol=4)
+  hp.update('num_triggers', len(hp.triggers))
+  extra = tuple((ids,) for ids in trig_ids)
+  return emb, word_idx_map, data, postag_size, extra
+
 def save_model(sess, saver, hp, result, step, if_global_best=1):
   """
   Args:
@@ -188,6 +559,9 @@ def save_model(sess, saver, hp, result, step, if_global_best=1):
   """
   directory = hp.ckpt_dir
   name = hp.ckpt_name
+  store = getattr(hp, 'ckpt_store', None)
+  # Files go to the store from a private temp dir instead of a tar
+  if store: directory = tempfile.mkdtemp()
   if not os.path.exists(directory): os.makedirs(directory)
   path = directory + "/" + name
   hp_path = path+"_hp.pkl"
@@ -200,6 +574,10 @@ def save_model(sess, saver, hp, result, step, if_global_best=1):
   pickle.dump(result, open(result_pkl, "wb"))
   with open(path+"_info.json", "w") as f: json.dump(info, f)
   model_path = saver.save(sess, path+"_model.ckpt", global_step=step)
+  if store:
+    CheckpointStore(store).put(name, directory)
+    shutil.rmtree(directory)
+    return
 
   # Tar the data
   tar_name = path+".tar"
@@ -207,6 +585,7 @@ def save_model(sess, saver, hp, result, step, if_global_best=1):
   tar = tarfile.open(tar_name, "w")
   for f in os.listdir(directory):
     if '.tar' in f:continue # don't delete tar!
+    if os.path.isdir(directory+"/"+f):continue # latest checkpoint dir
     if name in f:
       tar.add(directory+"/"+f)
       os.remove(directory+"/"+f)
@@ -215,6 +594,36 @@ def save_model(sess, saver, hp, result, step, if_global_best=1):
   os.remove(ckpt_file) if os.path.exists(ckpt_file) else None
   tar.close()
 
+def latest_dir(hp):
+  """ Directory of the latest checkpoint, apart from the best model tar """
+  return os.path.join(hp.ckpt_dir, hp.ckpt_name + "_latest")
+
+def save_latest(sess, saver, hp, state):
+  """
+  Untarred checkpoint of the current variables, optimizer slots included,
+  plus the training `state` dict as json. The json is written last and
+  renamed into place, so after a preemption it always points to complete
+  variables: `saver` must keep at least 2 checkpoints for that
+  """
+  directory = latest_dir(hp)
+  if not os.path.exists(directory): os.makedirs(directory)
+  state = dict(state)
+  state['model_path'] = saver.save(sess, directory+"/model.ckpt",
+                                          global_step=state['step'])
+  state_path = directory+"/state.json"
+  with open(state_path+".tmp", "w") as f: json.dump(state, f)
+  os.replace(state_path+".tmp", state_path)
+
+def load_latest(sess, saver, hp):
+  """ Restore the latest checkpoint, returns its state or None if absent """
+  state_path = latest_dir(hp)+"/state.json"
+  if not os.path.exists(state_path): return None
+  with open(state_path) as f: state = json.load(f)
+  saver.restore(sess, state['model_path'])
+  print("Resumed at step {}, epoch {}, batch {}".format(
+                          state['step'], state['epoch']+1, state['batch']))
+  return state
+
 def data_info(emb,word_idx_map):
   # Create inverse vocab, mapping integer to word
   inv_vocab = {}
@@ -237,53 +646,119 @@ def load_model(sess, emb, hp, postag_size):
     model = model(hp, emb, postag_size)
     saver = tf.train.Saver()
     tf.global_variables_initializer().run()
+    tf.local_variables_initializer().run()
     print("New model initialized")
+    if getattr(hp, 'warm_start', None):
+      warm_start(sess, hp)
     return model, saver, hp, None
 
   # Find saved weights
-  tar_path = dirt + "/" + name + ".tar"
-  tar = tarfile.open(tar_path)
-  # Get paths
-  for member in tar.getmembers():
-    if 'hp.pkl' in member.name: hparams = member
-    if 'result.pkl' in member.name: result = member
-    if 'meta' in member.name: meta = member
-    if 'data' in member.name: variables = member
-  tar.extractall()
+  tmp_dir, paths = extract_checkpoint(hp, name)
 
   # Get params
   # postags = hp.postags
   # parallel = hp.parallel
-  hp = pickle.load(open(hparams.name, "rb"))
+  runtime = {k: getattr(hp, k) for k in RUNTIME_ARGS if hasattr(hp, k)}
+  hp = pickle.load(open(paths['hp'], "rb"))
   hp.update('ckpt_dir', dirt)
   hp.update('name', name)
+  for k, v in runtime.items():
+    hp.update(k, v)
   # hp.update('postags', postags)
   # hp.update('parallel', parallel)
 
   # Get previous results
-  result = pickle.load(open(result.name, "rb"))
+  result = pickle.load(open(paths['result'], "rb"))
   # result = None
 
   # Restore model
   model = locate("model." + hp.model)
   model = model(hp, emb, postag_size)
   tf.global_variables_initializer().run()
+  tf.local_variables_initializer().run()
 
   # Restore variables
-  model_path = variables.name.split('.data')[0]
   saver = tf.train.Saver()
-  saver.restore(sess, model_path)
+  saver.restore(sess, paths['model'])
   print("*"*79)
   print("Successfully restored previous model")
   print("*"*79)
 
   # Remove temp files
-  for member in tar.getmembers():
-    os.remove(member.name) if os.path.exists(member.name) else None
-  tar.close()
+  shutil.rmtree(tmp_dir)
 
   return model, saver, hp, result
 
+def extract_checkpoint(hp, name):
+  """
+  Files of checkpoint `name` from its tar, or the store with --ckpt_store, in
+  a private temp dir as several processes may load the same checkpoint.
+  Returns the dir to remove after use, and the paths of the hp and result
+  pickles and the prefix of the variables
+  """
+  tmp_dir = tempfile.mkdtemp()
+  if getattr(hp, 'ckpt_store', None):
+    CheckpointStore(hp.ckpt_store).extract(name, tmp_dir)
+  else:
+    with tarfile.open(hp.ckpt_dir + "/" + name + ".tar") as tar:
+      tar.extractall(tmp_dir)
+  paths = {}
+  for root, _, files in os.walk(tmp_dir):
+    for f in files:
+      if f.endswith('hp.pkl'): paths['hp'] = os.path.join(root, f)
+      if f.endswith('result.pkl'): paths['result'] = os.path.join(root, f)
+      if '.data-' in f: paths['model'] = os.path.join(root, f.split('.data-')[0])
+  return tmp_dir, paths
+
+def warm_start(sess, hp):
+  """
+  Restore the variables selected by `hp.warm_policy` from the checkpoint
+  `hp.warm_start`, where names and shapes match. Others, such as a class_log
+  layer of another size, keep their initial values. Embeddings are never
+  restored, word ids differ between datasets
+    encoder: RNN encoder and word gate
+    encoder_attn: plus the attention convolutions
+    all: every trainable variable
+  """
+  scopes = {'encoder': ENCODER_SCOPES,
+            'encoder_attn': ENCODER_SCOPES + ATTN_SCOPES}.get(hp.warm_policy)
+  if scopes is None and hp.warm_policy != 'all':
+    raise ValueError("Invalid warm policy: " + hp.warm_policy)
+  tmp_dir, paths = extract_checkpoint(hp, hp.warm_start)
+  model_path = paths['model']
+
+  shapes = tf.train.NewCheckpointReader(model_path).get_variable_to_shape_map()
+  restore, skipped = {}, []
+  for var in tf.trainable_variables():
+    name = var.op.name
+    if name.split('/')[-1] in EMB_VARS: continue
+    if scopes is not None and name.split('/')[0] not in scopes: continue
+    if shapes.get(name) == var.shape.as_list():
+      restore[name] = var
+    else:
+      skipped.append(name)
+  if len(restore) > 0:
+    tf.train.Saver(restore).restore(sess, model_path)
+  shutil.rmtree(tmp_dir)
+  print("Warm start from {}: {} variables restored".format(hp.warm_start, len(restore)))
+  if len(skipped) > 0:
+    print("Not in checkpoint or other shape, initialized: {}".format(skipped))
+
+def load_saved_model(emb, hp, postag_size, ckpt_name, config=None):
+  """
+  Load checkpoint `ckpt_name` in its own graph and session, so several
+  models can live in one process. Returns sess, model, hp, result
+  """
+  hp = copy.deepcopy(hp)
+  hp.update('ckpt_name', ckpt_name)
+  hp.update('load_saved', True)
+  graph = tf.Graph()
+  with graph.as_default():
+    sess = tf.Session(graph=graph, config=config)
+    with sess.as_default():
+      model, _, hp, result = load_model(sess, emb, hp, postag_size)
+  return sess, model, hp, result
+
 def prf1(test, gold):
   '''
   N.B.: This function comes from Yulan Feng